@@ -0,0 +1,40 @@
+from config import get_config
+from utils import Vocab, load_conv_store, PAD_TOKEN, EOS_TOKEN, SOS_TOKEN, SEP_TOKEN
+from transformers import OpenAIGPTTokenizer, GPT2Tokenizer
+
+
+def main():
+    """Convert the train/valid/test pickles of a dataset into memory-mapped conversation stores"""
+    config = get_config(mode='valid')
+
+    if config.data_name == "cornell":
+        vocab = Vocab()
+        vocab.load(config.word2id_path, config.id2word_path, ptb=(config.model == "PTB"))
+    elif config.model == "DialoGPT":
+        vocab = GPT2Tokenizer.from_pretrained(config.user_vocab_path or 'gpt2')
+    else:
+        vocab = OpenAIGPTTokenizer.from_pretrained('openai-gpt')
+        vocab.add_special_tokens({
+            'pad_token': PAD_TOKEN,
+            'bos_token': SOS_TOKEN,
+            'eos_token': EOS_TOKEN,
+            'sep_token': SEP_TOKEN,
+        })
+
+    for split in ['train', 'valid', 'test']:
+        split_dir = config.dataset_dir.joinpath(split)
+        convs_path = split_dir.joinpath('convs.pkl')
+        if not convs_path.exists():
+            continue
+
+        if isinstance(vocab, Vocab):
+            store = load_conv_store(convs_path, vocab, split_dir.joinpath('conversations_length.pkl'),
+                                    split_dir.joinpath('utterances_length.pkl'),
+                                    split_dir.joinpath('convs_users.pkl') if config.users else None)
+        else:
+            store = load_conv_store(convs_path, vocab)
+        print(f'{split}: {len(store)} conversations, {len(store.tokens)} tokens')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+from config import get_config
+from utils import DialoGPTDataset, load_pickle, load_token_cache
+from transformers import GPT2Tokenizer
+
+
+def main():
+    """Compile the train/valid/test conversations of a DialoGPT dataset into token caches"""
+    config = get_config(mode='valid')
+    vocab = GPT2Tokenizer.from_pretrained('gpt2')
+
+    for split in ['train', 'valid', 'test']:
+        convs_path = config.dataset_dir.joinpath(split, 'convs.pkl')
+        if not convs_path.exists():
+            continue
+
+        # export_test_responses.py reads the test split with export_test on
+        config.export_test = split == 'test'
+        convs = load_pickle(convs_path)
+        dataset = DialoGPTDataset(convs, vocab, config)
+        token_cache = load_token_cache(convs_path, dataset.cache_meta(), dataset.encode_utterance, convs=convs)
+        print(f'{split}: {len(token_cache)} conversations, {len(token_cache.tokens)} tokens')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import os
+import time
+from config import get_config
+from utils import Vocab, load_pickle
+
+
+def main():
+    """
+    Build word2id.pkl and id2word.pkl of a word-level dataset (tokenized convs.pkl, e.g. cornell)
+    from its train conversations, counting words in --vocab_workers processes
+    """
+    config = get_config(mode='train')
+
+    start = time.time()
+    convs = load_pickle(config.dataset_dir.joinpath('train', 'convs.pkl'))
+    vocab = Vocab()
+    vocab.add_conversations(convs, num_workers=config.vocab_workers)
+    vocab.update(max_size=config.max_vocab_size, min_freq=config.min_vocab_frequency)
+    vocab.pickle(config.word2id_path, config.id2word_path)
+    print(f'{len(vocab)} words from {vocab.freqdist.N()} tokens of {len(convs)} conversations '
+          f'written to {config.word2id_path} in {time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -53,7 +53,9 @@ class Config(object):
             time_now = datetime.now().strftime('%Y%m%d_%H%M%S')
             self.save_path = save_dir.joinpath(self.data_name, self.model, time_now)
             self.logdir = str(self.save_path)
-            os.makedirs(self.save_path, exist_ok=True)
+            if int(os.environ.get('RANK', 0)) == 0:
+                # other ranks of a distributed run write nothing
+                os.makedirs(self.save_path, exist_ok=True)
         elif self.checkpoint is not None:
             assert os.path.exists(self.checkpoint)
             self.save_path = os.path.dirname(self.checkpoint)
@@ -87,7 +89,8 @@ def get_config(parse=True, **optional_kwargs):
     parser.add_argument('--mode', type=str, default='train')
 
     parser.add_argument('--batch_size', type=int, default=80)
-    parser.add_argument('--eval_batch_size', type=int, default=80)
+    parser.add_argument('--eval_batch_size', type=int, default=80,
+                        help='batch size of validation, which keeps no activations for a backward pass')
     parser.add_argument('--n_epoch', type=int, default=30)
     parser.add_argument('--learning_rate', type=float, default=1e-4)
     parser.add_argument('--optimizer', type=str, default='Adam')
@@ -102,7 +105,12 @@ def get_config(parse=True, **optional_kwargs):
                         help='if false, use beam search for decoding')
     parser.add_argument('--temperature', type=float, default=1.0)
     parser.add_argument('--beam_size', type=int, default=2)
+    parser.add_argument('--beam_export', type=str2bool, default=False,
+                        help='export the Transformer and DialoGPT test responses with beam search of --beam_size '
+                             'beams instead of greedy decoding and sampling')
     parser.add_argument('--max_seq_len', type=int, default=512)
+    parser.add_argument('--truncation_side', type=str, default='left', choices=['left', 'right'],
+                        help='which end of a sequence longer than max_seq_len is dropped')
 
     parser.add_argument('--model', type=str, default='HRED')
     parser.add_argument('--rnn', type=str, default='gru')
@@ -154,6 +162,73 @@ def get_config(parse=True, **optional_kwargs):
     parser.add_argument('--export_test', type=bool, default=False)
     parser.add_argument('--user_vocab_path', type=str, default='')
     parser.add_argument('--reversed_pretrained_path', type=str, default='')
+    parser.add_argument('--token_cache', type=str2bool, default=False,
+                        help='tokenize DialoGPT conversations once into {split}/cache and reuse them')
+    parser.add_argument('--conv_store', type=str2bool, default=False,
+                        help='convert convs.pkl once into a memory-mapped store in {split}/cache and read from it')
+    parser.add_argument('--bucket_batching', type=str2bool, default=False,
+                        help='batch training conversations of similar length together')
+    parser.add_argument('--bucket_size', type=int, default=100,
+                        help='number of batches sorted together by bucket_batching and max_tokens_per_batch')
+    parser.add_argument('--max_tokens_per_batch', type=int, default=0,
+                        help='if positive, fill training batches up to this many padded tokens instead of batch_size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pack_sequences', type=str2bool, default=False,
+                        help='pack several DialoGPT training conversations into each row of max_seq_len tokens')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of DataLoader worker processes, 0 loads in the main process')
+    parser.add_argument('--pin_memory', type=str2bool, default=False)
+    parser.add_argument('--persistent_workers', type=str2bool, default=False,
+                        help='keep the DataLoader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='number of batches loaded in advance by each worker')
+    parser.add_argument('--prefetch_to_device', type=str2bool, default=False,
+                        help='copy the next batch to the GPU while the current step runs')
+    parser.add_argument('--streaming', type=str2bool, default=False,
+                        help='stream DialoGPT/ZHENG/Transformer conversations from {split}/shards (or convs.pkl) '
+                             'instead of loading the whole split')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help='number of conversations shuffled together by streaming')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='autocast precision of the DialoGPT/ZHENG training forward pass and loss, '
+                             'fp16 also scales the loss')
+    parser.add_argument('--grad_accum_steps', type=int, default=1,
+                        help='number of batches whose gradients are accumulated into each DialoGPT/ZHENG/Transformer '
+                             'optimizer step')
+    parser.add_argument('--activation_checkpointing', type=int, default=0,
+                        help='if positive, keep the activations of every n-th GPT-2 (DialoGPT) or GPT (ZHENG) block '
+                             'only while training and recompute the others in the backward pass')
+    parser.add_argument('--distributed', type=str2bool, default=False,
+                        help='DistributedDataParallel training of DialoGPT/ZHENG/Transformer, one process per GPU '
+                             '(or per CPU worker) launched with torchrun')
+    parser.add_argument('--dist_backend', type=str, default='',
+                        help='torch.distributed backend, nccl on GPUs and gloo on CPU by default')
+    parser.add_argument('--shard_optimizer', type=str2bool, default=False,
+                        help='shard the optimizer state across the ranks of distributed training (ZeRO stage 1)')
+    parser.add_argument('--loss_chunk_size', type=int, default=1024,
+                        help='number of labeled DialoGPT positions and RNN decoder target words projected to the '
+                             'vocabulary at a time by the loss, 0 computes the logits of every DialoGPT position '
+                             'and of all the target words at once')
+    parser.add_argument('--eval_every', type=int, default=0,
+                        help='if positive, also validate DialoGPT/ZHENG/Transformer every n optimizer steps')
+    parser.add_argument('--eval_subset', type=int, default=0,
+                        help='if positive, validate (and early stop) on a fixed random subset of this many '
+                             'validation batches instead of all of them')
+    parser.add_argument('--save_every_steps', type=int, default=0,
+                        help='if positive, also save the DialoGPT/ZHENG/Transformer training state every n optimizer '
+                             'steps, resumed with --checkpoint at the next batch')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='if positive, keep only this many checkpoints of lowest validation loss and the latest one')
+    parser.add_argument('--async_checkpoint', type=str2bool, default=True,
+                        help='write checkpoints in a background thread while training goes on')
+    parser.add_argument('--batched_export', type=str2bool, default=False,
+                        help='generate the DialoGPT test responses of batch_size conversations at once, '
+                             'the same samples as one at a time for a given --seed')
+    parser.add_argument('--max_vocab_size', type=int, default=20000,
+                        help='number of words of the vocabulary built by build_vocab.py, special tokens included')
+    parser.add_argument('--min_vocab_frequency', type=int, default=5)
+    parser.add_argument('--vocab_workers', type=int, default=1,
+                        help='number of processes counting words in build_vocab.py')
 
     if parse:
         kwargs = parser.parse_args()
@@ -1,5 +1,5 @@
 from config import get_config
-from utils import Vocab, get_loader, load_pickle, PAD_TOKEN, UNK_TOKEN, EOS_TOKEN, SOS_TOKEN, UNK_TOKEN, SEP_TOKEN
+from utils import Vocab, get_loader, load_pickle, load_conversations, count_users, PAD_TOKEN, UNK_TOKEN, EOS_TOKEN, SOS_TOKEN, UNK_TOKEN, SEP_TOKEN
 import solvers
 import torch
 from transformers import OpenAIGPTTokenizer, GPT2Tokenizer
@@ -13,18 +13,14 @@ def main():
         print(f'Vocabulary size: {vocab.vocab_size}')
         config.vocab_size = vocab.vocab_size
 
+        test_convs = load_conversations(config, vocab)
         if config.users:
-            test_users = load_pickle(config.convs_users_path)
-            config.user_size = max([x for xx in test_users for x in xx]) + 1
+            config.user_size = count_users(test_convs)
             print(f'User size: {config.user_size}')
-        else:
-            test_users = None
 
-        data_loader = get_loader(convs=load_pickle(config.convs_path),
-                                convs_length=load_pickle(config.conversations_length_path),
-                                utterances_length=load_pickle(config.utterances_length_path),
-                                vocab=vocab, batch_size=config.batch_size, shuffle=False, convs_users=test_users,
-                                is_ptb_model=(config.model=="PTB"))
+        data_loader = get_loader(**test_convs,
+                                vocab=vocab, batch_size=config.batch_size, shuffle=False,
+                                config=config)
     
     elif config.model == "DialoGPT":
         if config.users:
@@ -34,13 +30,15 @@ def main():
         config.vocab_size = len(vocab)
         config.vocab = vocab
         config.export_test = True
-        data_loader = get_loader(convs=load_pickle(config.convs_path),
+        data_loader = get_loader(**load_conversations(config, vocab),
                                     vocab=vocab, 
                                     batch_size=config.batch_size,
                                     model=config.model,
                                     dataset=config.data_name,
                                     config=config,
-                                    shuffle=False)
+                                    shuffle=False,
+                                    sort_by_length=config.batched_export,
+                                    convs_path=config.convs_path)
 
     elif config.data_name == "cornell2" or config.data_name == "ubuntu" or config.data_name == "twitter_s":
         vocab = OpenAIGPTTokenizer.from_pretrained('openai-gpt')
@@ -57,7 +55,7 @@ def main():
         config.eos_id = vocab.eos_token_id 
         config.sos_id = vocab.bos_token_id 
 
-        data_loader = get_loader(convs=load_pickle(config.convs_path),
+        data_loader = get_loader(**load_conversations(config, vocab),
                                     vocab=vocab, 
                                     batch_size=config.batch_size,
                                     model=config.model,
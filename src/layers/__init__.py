@@ -4,3 +4,5 @@ from .rnncells import *
 from .loss import *
 from .feedforward import *
 from .attention import *
+from .activation_checkpoint import *
+from .beam_search import *
@@ -0,0 +1,27 @@
+import inspect
+from torch.utils.checkpoint import checkpoint
+
+# the non-reentrant implementation also backpropagates into tensors that are not inputs of the segment,
+# e.g. the encoder states attended to by a decoder block
+CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def checkpoint_blocks(blocks, forward_block, hidden_states, *inputs, interval=1):
+    """
+    Run hidden_states through blocks with activation checkpointing: only the input of every interval-th block
+    is kept for the backward pass, which recomputes the activations of the blocks in between
+    :param blocks: nn.ModuleList of blocks, applied in order
+    :param forward_block: function(block, hidden_states, *inputs) -> hidden_states
+    :param inputs: other inputs of every block, e.g. the attention mask
+    :param interval: number of blocks recomputed together, 1 checkpoints every block
+    """
+    def segment(start):
+        def run(hidden_states, *inputs):
+            for block in blocks[start:start + interval]:
+                hidden_states = forward_block(block, hidden_states, *inputs)
+            return hidden_states
+        return run
+
+    for start in range(0, len(blocks), interval):
+        hidden_states = checkpoint(segment(start), hidden_states, *inputs, **CHECKPOINT_KWARGS)
+    return hidden_states
@@ -82,7 +82,13 @@ class MultiheadAttention(nn.Module):
         else:
             return x.permute(0, 2, 1, 3)  # (batch, head, seq_length, head_features)
     
-    def forward(self, query, key, value, attn_mask=None, head_mask=None, qkv_same=True):
+    def forward(self, query, key, value, attn_mask=None, head_mask=None, qkv_same=True, layer_past=None, use_cache=False):
+        """
+        :param layer_past: (key, value) returned by a previous call with use_cache. Self-attention (qkv_same) appends
+            the key and value of the new positions to them, attention over another sequence (not qkv_same) uses them
+            instead of projecting key and value again
+        :param use_cache: also return the (key, value) to pass as layer_past for the next positions
+        """
         if qkv_same:
             query, key, value = self.c_attn(query).split(self.n_features, dim=-1)
             apply_future_mask = True 
@@ -92,18 +98,26 @@ class MultiheadAttention(nn.Module):
             q_w, q_b = self.c_attn.weight[:, :self.n_features], self.c_attn.bias[:self.n_features]
             query = torch.addmm(q_b, query.view(-1, query.size(-1)), q_w).view(size_out)
 
-            size_out = key.size()[:-1] + (self.n_features,)
-            k_w, k_b = self.c_attn.weight[:, self.n_features:self.n_features * 2], self.c_attn.bias[self.n_features:self.n_features * 2]
-            key = torch.addmm(k_b, key.view(-1, key.size(-1)), k_w).view(size_out)
+            if layer_past is None:
+                size_out = key.size()[:-1] + (self.n_features,)
+                k_w, k_b = self.c_attn.weight[:, self.n_features:self.n_features * 2], self.c_attn.bias[self.n_features:self.n_features * 2]
+                key = torch.addmm(k_b, key.view(-1, key.size(-1)), k_w).view(size_out)
 
-            size_out = value.size()[:-1] + (self.n_features,)
-            v_w, v_b = self.c_attn.weight[:, self.n_features * 2:], self.c_attn.bias[self.n_features * 2:]
-            value = torch.addmm(v_b, value.view(-1, value.size(-1)), v_w).view(size_out)
+                size_out = value.size()[:-1] + (self.n_features,)
+                v_w, v_b = self.c_attn.weight[:, self.n_features * 2:], self.c_attn.bias[self.n_features * 2:]
+                value = torch.addmm(v_b, value.view(-1, value.size(-1)), v_w).view(size_out)
             apply_future_mask = False
 
         query = self.split_heads(query)
-        key = self.split_heads(key, k=True)
-        value = self.split_heads(value)
+        if not qkv_same and layer_past is not None:
+            key, value = layer_past
+        else:
+            key = self.split_heads(key, k=True)
+            value = self.split_heads(value)
+            if layer_past is not None:
+                past_key, past_value = layer_past
+                key = torch.cat((past_key, key), dim=-1)
+                value = torch.cat((past_value, value), dim=-2)
 
         a = self._attn(query, key, value, attn_mask, head_mask, masked=apply_future_mask)
 
@@ -111,6 +125,8 @@ class MultiheadAttention(nn.Module):
         a = self.c_proj(a)
         a = self.resid_dropout(a)
 
+        if use_cache:
+            return a, (key, value)
         return a
 
 class MLP(nn.Module):
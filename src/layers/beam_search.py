@@ -1,15 +1,23 @@
 import torch
-from utils import EOS_ID
+import torch.nn.functional as F
+from utils import EOS_ID, PAD_ID
 
 
 class Beam(object):
-    def __init__(self, batch_size, hidden_size, vocab_size, beam_size, max_unroll, batch_position):
-        """Beam class for beam search"""
+    def __init__(self, batch_size, hidden_size, vocab_size, beam_size, max_unroll, batch_position,
+                 eos_id=EOS_ID, check_every=8):
+        """
+        Beam class for beam search
+        :param check_every: steps between two checks of whether every conversation is done,
+                            as reading it back waits for the device
+        """
         self.batch_size = batch_size
         self.hidden_size = hidden_size
         self.vocab_size = vocab_size
         self.beam_size = beam_size
         self.max_unroll = max_unroll
+        self.eos_id = eos_id
+        self.check_every = check_every
 
         self.batch_position = batch_position
 
@@ -17,6 +25,8 @@ class Beam(object):
         self.scores = list()
         self.back_pointers = list()
         self.token_ids = list()
+        # number of hypotheses ended by eos_id of each conversation
+        self.n_eos = torch.zeros(batch_size, dtype=torch.long, device=batch_position.device)
 
         self.metadata = {'inputs': None, 'output': None, 'scores': None, 'length': None, 'sequence': None}
 
@@ -24,58 +34,211 @@ class Beam(object):
         self.scores.append(score)
         self.back_pointers.append(back_pointer)
         self.token_ids.append(token_id)
+        self.n_eos += token_id.eq(self.eos_id).view(self.batch_size, self.beam_size).sum(1)
+
+    def done(self):
+        """
+        Whether every conversation has beam_size hypotheses ended by eos_id, the ones backtrack returns
+        whatever is decoded next. Only checked every check_every steps.
+        """
+        n_steps = len(self.token_ids)
+        if n_steps % self.check_every != 0:
+            return False
+        return bool((self.n_eos >= self.beam_size).all())
 
     def backtrack(self):
-        prediction = list()
-
-        length = [[self.max_unroll] * self.beam_size for _ in range(self.batch_size)]
+        """
+        Sequences of the beams of the last step, each hypothesis ended by eos_id taking the place of one of them:
+        numbered from the last one back, the j-th hypothesis of a conversation takes beam beam_size - 1 - j % beam_size
+        :return: prediction [batch_size, beam_size, max_unroll] padded after the eos_id (or the steps decoded),
+                 final_score [batch_size, beam_size], length (batch_size lists of beam_size lengths),
+                 best first
+        """
+        n_steps = len(self.token_ids)
+        token_ids = torch.stack(self.token_ids)  # [n_steps, batch_size * beam_size]
+        back_pointers = torch.stack(self.back_pointers)
+        scores = torch.stack(self.scores).view(n_steps, -1)
+        beam_ids = torch.arange(self.beam_size, device=token_ids.device)
+
+        # eos hypotheses of each conversation from the last one back, last step and last beam first
+        eos = token_ids.eq(self.eos_id).view(n_steps, self.batch_size, self.beam_size)
+        eos = eos.flip(0).flip(2).transpose(0, 1).reshape(self.batch_size, -1)
+        n_eos = eos.long().cumsum(1)  # [batch_size, n_steps * beam_size]
+        # the hypothesis j ending in beam k is the last one with j % beam_size == beam_size - 1 - k
+        residue = (self.beam_size - 1 - beam_ids).unsqueeze(0)
+        n_total = n_eos[:, -1:]
+        replaced = n_total > residue  # [batch_size, beam_size]
+        j = residue + (n_total - 1 - residue).clamp(min=0) // self.beam_size * self.beam_size
+        # its position in eos is the first one with j + 1 hypotheses up to there
+        position = (n_eos.unsqueeze(1) <= j.unsqueeze(2)).sum(2).clamp(max=eos.size(1) - 1)
+        eos_step = n_steps - 1 - position // self.beam_size
+        eos_row = self.batch_position.unsqueeze(1) + self.beam_size - 1 - position % self.beam_size
 
         top_k_score, top_k_idx = self.scores[-1].topk(self.beam_size, dim=1)
-
-        top_k_score = top_k_score.clone()
-
-        n_eos_in_batch = [0] * self.batch_size
-
-        back_pointer = (top_k_idx + self.batch_position.unsqueeze(1)).view(-1)
-
-        for t in reversed(range(self.max_unroll)):
-            token_id = self.token_ids[t].index_select(0, back_pointer)
-            back_pointer = self.back_pointers[t].index_select(0, back_pointer)
-            eos_indices = self.token_ids[t].data.eq(EOS_ID).nonzero()
-
-            if eos_indices.dim() > 0:
-                for i in range(eos_indices.size(0) - 1, -1, -1):
-                    eos_idx = eos_indices[i, 0].item()
-
-                    batch_idx = eos_idx // self.beam_size
-                    batch_start_idx = batch_idx * self.beam_size
-
-                    _n_eos_in_batch = n_eos_in_batch[batch_idx] % self.beam_size
-                    beam_idx_to_be_replaced = self.beam_size - _n_eos_in_batch - 1
-                    idx_to_be_replaced = batch_start_idx + beam_idx_to_be_replaced
-
-                    back_pointer[idx_to_be_replaced] = self.back_pointers[t][eos_idx].item()
-                    token_id[idx_to_be_replaced] = self.token_ids[t][eos_idx].item()
-                    top_k_score[batch_idx,
-                                beam_idx_to_be_replaced] = self.scores[t].view(-1)[eos_idx].item()
-                    length[batch_idx][beam_idx_to_be_replaced] = t + 1
-
-                    n_eos_in_batch[batch_idx] += 1
-
-            prediction.append(token_id)
-
-        top_k_score, top_k_idx = top_k_score.topk(self.beam_size, dim=1)
-        final_score = top_k_score.data
-
-        for batch_idx in range(self.batch_size):
-            length[batch_idx] = [length[batch_idx][beam_idx.item()]
-                                 for beam_idx in top_k_idx[batch_idx]]
+        last_step = torch.full_like(eos_step, n_steps - 1)
+        start_step = torch.where(replaced, eos_step, last_step).view(-1)
+        start_row = torch.where(replaced, eos_row, top_k_idx + self.batch_position.unsqueeze(1)).view(-1)
+        score = torch.where(replaced, scores[eos_step, eos_row], top_k_score)
+        length = torch.where(replaced, eos_step + 1, torch.full_like(eos_step, self.max_unroll))
+
+        # walk back over the stacked back pointers, every sequence from its own last step
+        prediction = token_ids.new_full((self.max_unroll, self.batch_size * self.beam_size), PAD_ID)
+        back_pointer = start_row
+        for t in reversed(range(n_steps)):
+            back_pointer = torch.where(start_step == t, start_row, back_pointer)
+            prediction[t] = torch.where(start_step >= t, token_ids[t].index_select(0, back_pointer), prediction[t])
+            back_pointer = back_pointers[t].index_select(0, back_pointer)
+
+        final_score, top_k_idx = score.topk(self.beam_size, dim=1)
+        length = length.gather(1, top_k_idx).tolist()
 
         top_k_idx = (top_k_idx + self.batch_position.unsqueeze(1)).view(-1)
+        prediction = prediction.index_select(1, top_k_idx).view(self.max_unroll, self.batch_size, self.beam_size)
+        prediction = prediction.permute(1, 2, 0)
 
-        prediction = [step.index_select(0, top_k_idx).view(
-            self.batch_size, self.beam_size) for step in reversed(prediction)]
+        return prediction, final_score, length
 
-        prediction = torch.stack(prediction, 2)
 
-        return prediction, final_score, length
+class BeamSearch(object):
+    def __init__(self, beam_size, max_length, eos_id, pad_id, length_penalty=1.0, early_stopping=False,
+                 num_return_sequences=1, check_every=8):
+        """
+        Beam search of a whole batch with tensor operations only, for any model decoding one step at a time
+        with a cache whose rows can be reordered. It searches as transformers' beam search does: the best
+        2 * beam_size continuations of a conversation's beams are ranked, those ending with eos_id before the
+        beam_size-th other one become hypotheses scored by sum of log probs / length ** length_penalty
+        (length of the prefix and the words before eos_id), and the other ones the next beams.
+        At max_length, the beams of the conversations still searching become hypotheses with their own scores.
+        The loop of transformers 2.x that ZHENG copied added the best candidates of the last step instead, with
+        rows that do not line up with them, so ZHENG exports reaching max_length differ from before.
+        :param max_length: length of the sequences searched, prefix included
+        :param early_stopping: a conversation is done once it has beam_size hypotheses, otherwise only once
+                               none of its beams can get a better score than its worst hypothesis
+        :param num_return_sequences: number of hypotheses returned per conversation, at most beam_size
+        :param check_every: steps between two checks of whether every conversation is done,
+                            as reading it back waits for the device
+        """
+        assert num_return_sequences <= beam_size
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self.eos_id = eos_id
+        self.pad_id = pad_id
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.num_return_sequences = num_return_sequences
+        self.check_every = check_every
+
+    def search(self, step, reorder, input_ids, state=None):
+        """
+        :param step: function (input_ids, state) -> (logits (batch_size * beam_size, vocab_size) of the next words,
+                     state), given the whole prefix first and then the last words (batch_size * beam_size, 1)
+        :param reorder: function (state, index) -> state of the rows of index
+        :param input_ids: (batch_size * beam_size, prefix_length) prefix of every beam,
+                          the beams of a conversation next to each other
+        :return: (batch_size * num_return_sequences, length) words following the prefix of the best hypotheses,
+                 ending with eos_id unless cut at max_length and padded with pad_id, and their scores
+        """
+        beam_size = self.beam_size
+        device = input_ids.device
+        batch_size = input_ids.size(0) // beam_size
+        prefix_length = input_ids.size(1)
+        offset = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+        # the longest hypotheses get, bos aside as in transformers, for the best score a beam can still reach
+        max_length_penalty = max(self.max_length - 1, 1) ** self.length_penalty
+
+        # only the first beam of each conversation is searched from at the first step
+        beam_scores = torch.zeros(batch_size, beam_size, device=device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+
+        # hypotheses of each conversation, best first: the number of words before eos_id,
+        # the beam they end on at that step, and whether they end with eos_id
+        hyp_scores = torch.full((batch_size, beam_size), -float('inf'), device=device)
+        hyp_steps = torch.zeros(batch_size, beam_size, dtype=torch.long, device=device)
+        hyp_rows = torch.zeros(batch_size, beam_size, dtype=torch.long, device=device)
+        hyp_eos = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+        # word and previous row of every beam at each step, backtracked once at the end
+        words_history, parents_history = [], []
+
+        cur_len = prefix_length
+        while cur_len < self.max_length:
+            logits, state = step(input_ids, state)
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+            vocab_size = log_probs.size(-1)
+
+            scores = (beam_scores.unsqueeze(1) + log_probs).view(batch_size, -1)
+            next_scores, next_indices = scores.topk(2 * beam_size, dim=1)
+            next_rows = next_indices // vocab_size + offset
+            next_words = next_indices % vocab_size
+
+            # done once none of the beams can do better than the worst hypothesis
+            full = hyp_scores[:, -1] > -float('inf')
+            done = done | (full & (self.early_stopping | (hyp_scores[:, -1] >= next_scores[:, 0] / max_length_penalty)))
+
+            is_eos = next_words == self.eos_id
+            not_eos = ~is_eos
+            n_before = not_eos.long().cumsum(dim=1) - not_eos.long()
+            finished = is_eos & (n_before < beam_size) & ~done.unsqueeze(1)
+            new_scores = (next_scores / cur_len ** self.length_penalty).masked_fill(~finished, -float('inf'))
+            new_steps = torch.full_like(next_rows, cur_len - prefix_length)
+            hyp_scores, hyp_steps, hyp_rows, hyp_eos = self.best_hypotheses(
+                (hyp_scores, hyp_steps, hyp_rows, hyp_eos), (new_scores, new_steps, next_rows, finished))
+
+            # the next beams: the first beam_size continuations without eos_id
+            rank = torch.arange(2 * beam_size, device=device).expand_as(next_words)
+            _, selected = rank.masked_fill(is_eos, 2 * beam_size).topk(beam_size, dim=1, largest=False, sorted=True)
+            beam_scores = next_scores.gather(1, selected).view(-1)
+            rows = next_rows.gather(1, selected).view(-1)
+            words = next_words.gather(1, selected).view(-1)
+
+            words_history.append(words)
+            parents_history.append(rows)
+            state = reorder(state, rows)
+            input_ids = words.unsqueeze(1)
+            cur_len = cur_len + 1
+
+            n_steps = cur_len - prefix_length
+            if n_steps % self.check_every == 0 and done.all():
+                break
+
+        # the beams of the conversations still searching when max_length is reached
+        n_steps = cur_len - prefix_length
+        live_scores = (beam_scores / cur_len ** self.length_penalty).view(batch_size, beam_size)
+        live_scores = live_scores.masked_fill(done.unsqueeze(1), -float('inf'))
+        live_steps = torch.full_like(hyp_steps, n_steps)
+        live_rows = torch.arange(batch_size * beam_size, device=device).view(batch_size, beam_size)
+        live_eos = torch.zeros_like(hyp_eos)
+        hyp_scores, hyp_steps, hyp_rows, hyp_eos = self.best_hypotheses(
+            (hyp_scores, hyp_steps, hyp_rows, hyp_eos), (live_scores, live_steps, live_rows, live_eos))
+
+        n = self.num_return_sequences
+        hyp_scores, hyp_steps, hyp_rows, hyp_eos = [h[:, :n].reshape(-1) for h in
+                                                    (hyp_scores, hyp_steps, hyp_rows, hyp_eos)]
+        sequences = self.backtrack(words_history, parents_history, hyp_steps, hyp_rows, hyp_eos)
+        return sequences, hyp_scores
+
+    def best_hypotheses(self, hypotheses, candidates):
+        """
+        The beam_size best of hypotheses and candidates, both (scores, steps, rows, eos) of shape (batch_size, n)
+        """
+        scores, steps, rows, eos = [torch.cat(pair, dim=1) for pair in zip(hypotheses, candidates)]
+        scores, index = scores.topk(self.beam_size, dim=1)
+        return (scores, steps.gather(1, index), rows.gather(1, index), eos.gather(1, index))
+
+    def backtrack(self, words_history, parents_history, steps, rows, eos):
+        """
+        Words of the hypotheses ending after steps words on rows, followed by eos_id if eos, padded with pad_id
+        """
+        length = len(words_history)
+        sequences = steps.new_full((steps.size(0), length + 1), self.pad_id)
+        pointer = rows
+        for t in reversed(range(length)):
+            before_end = steps > t
+            sequences[:, t] = torch.where(before_end, words_history[t][pointer], sequences[:, t])
+            pointer = torch.where(before_end, parents_history[t][pointer], pointer)
+        ends = torch.full_like(steps, self.pad_id).masked_fill(eos, self.eos_id)
+        sequences.scatter_(1, steps.unsqueeze(1), ends.unsqueeze(1))
+        # as long as the longest hypothesis
+        return sequences[:, :int((steps + eos.long()).max())]
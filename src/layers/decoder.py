@@ -4,6 +4,7 @@ from torch import nn
 from torch.nn import functional as F
 from .rnncells import StackedGRUCell, LSTMSACell
 from .beam_search import Beam
+from .loss import masked_cross_entropy
 from utils import to_var, SOS_ID, UNK_ID, EOS_ID, PAD_ID
 import pickle
 
@@ -42,6 +43,15 @@ class BaseRNNDecoder(nn.Module):
     def forward_step(self):
         raise NotImplementedError
 
+    def loss(self, hidden_states, target, length, chunk_size=1024):
+        """
+        masked_cross_entropy of target from the hidden states of forward(..., hidden_only=True):
+        those within length are projected by self.out chunk by chunk, the logits of the others never are
+        :return: loss summed over the words within length, number of words
+        """
+        return masked_cross_entropy(hidden_states, target, length, weight=self.out.weight, bias=self.out.bias,
+                                    chunk_size=chunk_size)
+
     def embed(self, x):
         if self.training and self.word_drop > 0.0:
             if random.random() < self.word_drop:
@@ -78,7 +88,7 @@ class BaseRNNDecoder(nn.Module):
 
             x = (top_k_idx % self.vocab_size).view(-1)
 
-            beam_idx = top_k_idx / self.vocab_size  # [batch_size, beam_size]
+            beam_idx = top_k_idx // self.vocab_size  # [batch_size, beam_size]
             top_k_pointer = (beam_idx + batch_position.unsqueeze(1)).view(-1)
 
             h = h.index_select(1, top_k_pointer)
@@ -86,8 +96,11 @@ class BaseRNNDecoder(nn.Module):
             beam.update(score.clone(), top_k_pointer, x)  # , h)
 
             eos_idx = x.data.eq(EOS_ID).view(batch_size, self.beam_size)
-            if eos_idx.nonzero().dim() > 0:
-                score.data.masked_fill_(eos_idx, -float('inf'))
+            score.data.masked_fill_(eos_idx, -float('inf'))
+
+            # nothing decoded next changes the sequences backtracked
+            if beam.done():
+                break
 
         prediction, final_score, length = beam.backtrack()
 
@@ -119,14 +132,20 @@ class DecoderRNN(BaseRNNDecoder):
         self.out = nn.Linear(hidden_size, vocab_size)
         self.softmax = nn.Softmax(dim=1)
 
-    def forward_step(self, x, h, encoder_outputs=None, input_valid_length=None):
+    def forward_step(self, x, h, encoder_outputs=None, input_valid_length=None, hidden_only=False):
         x = self.embed(x)
         last_h, h = self.rnncell(x, h)
+        if hidden_only:
+            return last_h, h
         out = self.out(last_h)
 
         return out, h
 
-    def forward(self, inputs, init_h=None, encoder_outputs=None, input_valid_length=None, decode=False):
+    def forward(self, inputs, init_h=None, encoder_outputs=None, input_valid_length=None, decode=False,
+                hidden_only=False):
+        """
+        :param hidden_only: return the hidden states of the teacher-forced steps instead of their logits, see loss
+        """
         batch_size = self.batch_size(inputs, init_h)
 
         x = self.init_token(batch_size)
@@ -137,7 +156,7 @@ class DecoderRNN(BaseRNNDecoder):
             out_list = []
             seq_len = inputs.size(1)
             for i in range(seq_len):
-                out, h = self.forward_step(x, h)
+                out, h = self.forward_step(x, h, hidden_only=hidden_only)
 
                 out_list.append(out)
                 x = inputs[:, i]
@@ -166,7 +185,8 @@ class DecoderRNN(BaseRNNDecoder):
         score.index_fill_(0, torch.arange(0, batch_size).long() * self.beam_size, 0.0)
         score = to_var(score)
 
-        beam = Beam(batch_size, self.hidden_size, self.vocab_size, self.beam_size, self.max_unroll, batch_position)
+        beam = Beam(batch_size, self.hidden_size, self.vocab_size, self.beam_size, self.max_unroll, batch_position,
+                    eos_id=self.eos_id)
 
         for i in range(self.max_unroll):
             out, h = self.forward_step(x, h, encoder_outputs=encoder_outputs, input_valid_length=input_valid_length)
@@ -178,7 +198,7 @@ class DecoderRNN(BaseRNNDecoder):
 
             x = (top_k_idx % self.vocab_size).view(-1)
 
-            beam_idx = top_k_idx / self.vocab_size  # [batch_size, beam_size]
+            beam_idx = top_k_idx // self.vocab_size  # [batch_size, beam_size]
             top_k_pointer = (beam_idx + batch_position.unsqueeze(1)).view(-1)
 
             h = h.index_select(1, top_k_pointer)
@@ -186,8 +206,11 @@ class DecoderRNN(BaseRNNDecoder):
             beam.update(score.clone(), top_k_pointer, x)  # , h)
 
             eos_idx = x.data.eq(self.eos_id).view(batch_size, self.beam_size)
-            if eos_idx.nonzero().dim() > 0:
-                score.data.masked_fill_(eos_idx, -float('inf'))
+            score.data.masked_fill_(eos_idx, -float('inf'))
+
+            # nothing decoded next changes the sequences backtracked
+            if beam.done():
+                break
 
         prediction, final_score, length = beam.backtrack()
 
@@ -217,15 +240,22 @@ class DecoderSARNN(BaseRNNDecoder):
         self.out = nn.Linear(hidden_size, vocab_size)
         self.softmax = nn.Softmax(dim=1)
 
-    def forward_step(self, x, user1_embed, user2_embed, h, encoder_outputs=None, input_valid_length=None):
+    def forward_step(self, x, user1_embed, user2_embed, h, encoder_outputs=None, input_valid_length=None,
+                     hidden_only=False):
         x = self.embed(x)
         hy, cy = self.rnncell(x, user1_embed, user2_embed, h)
         last_h = hy
+        if hidden_only:
+            return last_h, (hy, cy)
         out = self.out(last_h)
 
         return out, (hy, cy)
 
-    def forward(self, word_inputs, user_inputs, init_h=None, encoder_outputs=None, input_valid_length=None, decode=False):
+    def forward(self, word_inputs, user_inputs, init_h=None, encoder_outputs=None, input_valid_length=None, decode=False,
+                hidden_only=False):
+        """
+        :param hidden_only: return the hidden states of the teacher-forced steps instead of their logits, see loss
+        """
         batch_size = self.batch_size(word_inputs, init_h)
         user_embedded = self.user_embedding(user_inputs)
 
@@ -236,7 +266,8 @@ class DecoderSARNN(BaseRNNDecoder):
             out_list = []
             seq_len = word_inputs.size(1)
             for i in range(seq_len):
-                out, h = self.forward_step(x, user_embedded[:, 0, :], user_embedded[:, 1, :], h)
+                out, h = self.forward_step(x, user_embedded[:, 0, :], user_embedded[:, 1, :], h,
+                                           hidden_only=hidden_only)
 
                 out_list.append(out)
                 x = word_inputs[:, i]
@@ -284,7 +315,7 @@ class DecoderSARNN(BaseRNNDecoder):
 
             x = (top_k_idx % self.vocab_size).view(-1)
 
-            beam_idx = top_k_idx / self.vocab_size
+            beam_idx = top_k_idx // self.vocab_size
             top_k_pointer = (beam_idx + batch_position.unsqueeze(1)).view(-1)
 
             h = (h[0].index_select(0, top_k_pointer), h[1].index_select(0, top_k_pointer))
@@ -293,8 +324,11 @@ class DecoderSARNN(BaseRNNDecoder):
             beam.update(score.clone(), top_k_pointer, x)
 
             eos_idx = x.data.eq(EOS_ID).view(batch_size, self.beam_size)
-            if eos_idx.nonzero().dim() > 0:
-                score.data.masked_fill_(eos_idx, -float('inf'))
+            score.data.masked_fill_(eos_idx, -float('inf'))
+
+            # nothing decoded next changes the sequences backtracked
+            if beam.done():
+                break
 
         prediction, final_score, length = beam.backtrack()
 
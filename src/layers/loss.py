@@ -1,34 +1,44 @@
 import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from utils import to_var
+from .activation_checkpoint import CHECKPOINT_KWARGS
 
 
-def masked_cross_entropy(logits, target, length, per_example=False):
+def masked_cross_entropy(logits, target, length, per_example=False, weight=None, bias=None, chunk_size=1024):
     """
     Source: https://gist.github.com/jihunchoi/f1434a77df9db1bb337417854b398df1
+    Only the positions within length are log-softmaxed, chunk by chunk (see indexed_cross_entropy).
+    Given weight, logits are the hidden states of the decoder instead: those of the positions within length
+    are gathered and projected to the vocabulary chunk by chunk (see chunked_cross_entropy),
+    so [batch_size, max_len, num_classes] logits are never allocated
+    :param logits: [batch_size, max_len, num_classes], or [batch_size, max_len, hidden_size] if weight is given
+    :param weight: [num_classes, hidden_size] output projection of the hidden states
+    :param bias: [num_classes] bias of the output projection
+    :param chunk_size: number of positions per chunk, all of them at once if 0
     """
-    batch_size, max_len, num_classes = logits.size()
+    batch_size, max_len = target.size()
 
-    # [batch_size * max_len, num_classes]
-    logits_flat = logits.view(-1, num_classes)
-
-    # [batch_size * max_len, num_classes]
-    log_probs_flat = torch.nn.functional.log_softmax(logits_flat, dim=1)
+    # [batch_size, max_len]
+    mask = sequence_mask(sequence_length=length, max_len=max_len)
 
-    # [batch_size * max_len, 1]
-    target_flat = target.view(-1, 1)
+    # [batch_size * max_len]
+    mask_flat = mask.view(-1)
 
     # Negative Log-likelihood: -sum {  1* log P(target)  + 0 log P(non-target)} = -sum( log P(target) )
-    # [batch_size * max_len, 1]
-    losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
-
-    # [batch_size, max_len]
-    losses = losses_flat.view(batch_size, max_len)
-
-    # [batch_size, max_len]
-    mask = sequence_mask(sequence_length=length, max_len=max_len)
+    # [num_words]
+    index = mask_flat.nonzero().squeeze(1)
+    logits_flat = logits.reshape(-1, logits.size(-1))
+    target_flat = target.reshape(-1)[index]
+    if weight is None:
+        losses_flat = indexed_cross_entropy(logits_flat, index, target_flat, chunk_size)
+    else:
+        losses_flat = chunked_cross_entropy(logits_flat.index_select(0, index), target_flat, weight, chunk_size,
+                                            bias=bias)
 
-    # Apply masking on loss
-    losses = losses * mask.float()
+    # [batch_size, max_len], 0 after length
+    losses = losses_flat.new_zeros(batch_size * max_len).masked_scatter(mask_flat, losses_flat)
+    losses = losses.view(batch_size, max_len)
 
     # word-wise cross entropy
     # loss = losses.sum() / length.float().sum()
@@ -56,3 +66,93 @@ def sequence_mask(sequence_length, max_len=None):
     masks = seq_range_expand < seq_length_expand
 
     return masks
+
+
+def chunked_cross_entropy(inputs, target, weight=None, chunk_size=1024, bias=None):
+    """
+    Cross entropy of each row of inputs, chunk_size rows at a time: only the log-probabilities of one chunk
+    exist at once, in the forward pass and in the backward pass which recomputes them
+    :param inputs: [num_rows, num_classes] logits, or [num_rows, hidden_size] hidden states if weight is given
+    :param target: [num_rows] class of each row
+    :param weight: [num_classes, hidden_size] output projection of the hidden states, e.g. a tied embedding
+    :param chunk_size: number of rows per chunk, all of them at once if 0
+    :param bias: [num_classes] bias of the output projection, if any
+    :return: [num_rows] losses in float32
+    """
+    def chunk_loss(inputs, target, weight=None, bias=None):
+        logits = inputs if weight is None else F.linear(inputs, weight, bias)
+        return F.cross_entropy(logits.float(), target, reduction='none')
+
+    if chunk_size <= 0 or inputs.size(0) <= chunk_size:
+        return chunk_loss(inputs, target, weight, bias)
+
+    recompute = torch.is_grad_enabled() and any(t is not None and t.requires_grad for t in (inputs, weight, bias))
+    losses = []
+    for start in range(0, inputs.size(0), chunk_size):
+        chunk = (inputs[start:start + chunk_size], target[start:start + chunk_size], weight, bias)
+        if recompute:
+            losses.append(checkpoint(chunk_loss, *chunk, **CHECKPOINT_KWARGS))
+        else:
+            losses.append(chunk_loss(*chunk))
+    return torch.cat(losses)
+
+
+class IndexedCrossEntropy(torch.autograd.Function):
+    """
+    Cross entropy of the rows index of logits, gathered chunk by chunk in the forward pass and again in the
+    backward pass, which writes the gradient of each chunk into the rows it was gathered from
+    """
+    @staticmethod
+    def forward(ctx, logits, index, target, chunk_size):
+        ctx.save_for_backward(logits, index, target)
+        ctx.chunk_size = chunk_size
+        if index.numel() == 0:
+            return logits.new_zeros(0, dtype=torch.float)
+        return torch.cat([F.cross_entropy(logits.index_select(0, index[start:start + chunk_size]).float(),
+                                          target[start:start + chunk_size], reduction='none')
+                          for start in range(0, index.size(0), chunk_size)])
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        logits, index, target = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad_logits = torch.zeros_like(logits)
+        for start in range(0, index.size(0), chunk_size):
+            rows = index[start:start + chunk_size]
+            with torch.enable_grad():
+                chunk = logits.index_select(0, rows).detach().requires_grad_()
+                losses = F.cross_entropy(chunk.float(), target[start:start + chunk_size], reduction='none')
+                grad_chunk, = torch.autograd.grad(losses, chunk, grad_losses[start:start + chunk_size])
+            grad_logits.index_copy_(0, rows, grad_chunk)
+        return grad_logits, None, None, None
+
+
+def indexed_cross_entropy(logits, index, target, chunk_size=1024):
+    """
+    Cross entropy of the rows index of logits, chunk_size rows at a time, without copying those rows out first:
+    only the gradient of logits is allocated in full, the log-probabilities exist for one chunk at a time
+    :param logits: [num_rows, num_classes]
+    :param index: [num_words] rows of logits to score
+    :param target: [num_words] class of each indexed row
+    :param chunk_size: number of rows per chunk, all of them at once if 0
+    :return: [num_words] losses in float32
+    """
+    if chunk_size <= 0:
+        chunk_size = max(index.size(0), 1)
+    return IndexedCrossEntropy.apply(logits, index, target, chunk_size)
+
+
+def labeled_cross_entropy(hidden_states, weight, labels, ignore_index=-1, chunk_size=1024):
+    """
+    Language model loss of the labeled positions only: their hidden states are gathered and projected
+    to the vocabulary chunk by chunk, so [batch_size, seq_len, vocab_size] logits are never allocated
+    :param hidden_states: [batch_size, seq_len, hidden_size]
+    :param weight: [vocab_size, hidden_size] output projection, e.g. the lm_head weight
+    :param labels: [batch_size, seq_len] target of each position, ignore_index where there is none
+    :return: loss summed over the labeled positions, number of labeled positions
+    """
+    labels = labels.reshape(-1)
+    labeled = labels != ignore_index
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))[labeled]
+    losses = chunked_cross_entropy(hidden_states, labels[labeled], weight, chunk_size)
+    return losses.sum(), labeled.sum()
@@ -7,6 +7,9 @@ import torch.nn.functional as F
 import torch.nn as nn
 from transformers import GPT2LMHeadModel, GPT2Config, GPT2PreTrainedModel, GPT2Model
 import os 
+import logging
+
+logger = logging.getLogger(__name__)
 
 class DialoGPT(nn.Module):
     def __init__(self, config):
@@ -17,6 +20,7 @@ class DialoGPT(nn.Module):
         project_dir = config.dataset_dir.parent.parent
         pretrained_path = os.path.join(project_dir, 'src', 'models', 'pretrained', config.pretrained_path)
         
+        gpt2_config.activation_checkpointing = config.activation_checkpointing
         if config.mode == "train":
             gpt2_config.original = False
         else:
@@ -41,7 +45,13 @@ class DialoGPT(nn.Module):
             past=None,
             user_ids = None, 
             user_mask = None,
+            segment_ids = None,
+            label_ids = None,
         ):
+        """
+        :param label_ids: if given, (summed loss, number) of the labeled positions are returned instead of the logits,
+            see layers.labeled_cross_entropy
+        """
 
         if self.config.mode == "train":
             logits_only = not(self.config.users and self.config.reversed)
@@ -54,23 +64,119 @@ class DialoGPT(nn.Module):
             token_type_ids=token_type_ids,
             labels=lm_labels,
             past=past,
-            logits_only=logits_only
+            logits_only=logits_only,
+            segment_ids=segment_ids,
+            hidden_only=label_ids is not None,
         ) # (batch_size, seq_len, vocab_size)
 
+        if label_ids is not None:
+            hidden_state = outputs
+            outputs = layers.labeled_cross_entropy(hidden_state, self.gpt2.lm_head.weight, label_ids,
+                                                   chunk_size=self.config.loss_chunk_size)
+
         # not config.users or not_config reversed 
 
         # outputs[0] 에는 logit 들 
         # outputs[1] 에는 transformer output들 .. 뀨 
 
         if self.config.users and self.config.reversed:
-            hidden_state = outputs[1]
+            if label_ids is None:
+                hidden_state = outputs[1]
             user_mask = user_mask.view(-1) == 1
             user_state = hidden_state.view(-1, hidden_state.size(-1))[user_mask]
             user_outputs = self.user_layer(user_state)
+            if label_ids is not None:
+                return outputs + (user_outputs,)
             return outputs[0], user_outputs    
 
         return outputs
 
+    @torch.no_grad()
+    def generate_batch(self, contexts, max_length, generators, temperature=0.9, top_p=0.9, eos_token_id=50256):
+        """
+        Sample a continuation of every context at once with a KV cache, as gpt2.generate(do_sample=True) does
+        for each context alone. The contexts are left-padded, with an attention mask over the padding and
+        the position ids of each context unpadded, and a context leaves the batch once it is finished.
+        :param contexts: list of token id lists
+        :param max_length: length of a context and its continuation together, as in gpt2.generate
+        :param generators: torch.Generator of each context, each one drawn from as gpt2.generate draws from
+            the global RNG: a context sampled with a generator seeded by s gets the continuation gpt2.generate
+            samples for it alone after torch.manual_seed(s)
+        :return: list of each context followed by its continuation, up to and including eos_token_id
+        """
+        device = next(self.parameters()).device
+        outputs = [list(context) for context in contexts]
+        # indices of the contexts still in the batch, in the order of its rows
+        active = [i for i, context in enumerate(contexts) if len(context) < max_length]
+        if not active:
+            return outputs
+
+        width = max(len(contexts[i]) for i in active)
+        input_ids = torch.full((len(active), width), eos_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros(len(active), width, device=device)
+        for row, i in enumerate(active):
+            input_ids[row, width - len(contexts[i]):] = torch.tensor(contexts[i], dtype=torch.long)
+            attention_mask[row, width - len(contexts[i]):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0).long()
+
+        past = None
+        while active:
+            hidden_states, past = self.gpt2.transformer(input_ids, past=past, attention_mask=attention_mask,
+                                                        position_ids=position_ids, use_cache=True)[:2]
+            next_token_logits = self.gpt2.lm_head(hidden_states[:, -1, :])
+            if temperature != 1.0:
+                next_token_logits = next_token_logits / temperature
+            probs = F.softmax(top_k_top_p_filtering(next_token_logits, top_p=top_p), dim=-1)
+            next_tokens = torch.cat([torch.multinomial(probs[row:row + 1], num_samples=1, generator=generators[i])
+                                     for row, i in enumerate(active)])
+
+            keep = []
+            for row, (i, token) in enumerate(zip(active, next_tokens.view(-1).tolist())):
+                outputs[i].append(token)
+                if token != eos_token_id and len(outputs[i]) < max_length:
+                    keep.append(row)
+            if len(keep) < len(active):
+                rows = torch.tensor(keep, dtype=torch.long, device=device)
+                active = [active[row] for row in keep]
+                next_tokens, attention_mask, position_ids = next_tokens[rows], attention_mask[rows], position_ids[rows]
+                # the padding left of every remaining context is dropped too, so the cache of each step
+                # is at most max_length long, as in gpt2.generate
+                start = int(attention_mask.sum(0).nonzero()[0]) if active else 0
+                attention_mask = attention_mask[:, start:]
+                past = [layer_past.index_select(1, rows)[..., start:, :] for layer_past in past]
+            input_ids = next_tokens.view(-1, 1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones(len(active), 1)], dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+        return outputs
+
+    @torch.no_grad()
+    def beam_generate(self, input_ids, max_length, num_beams, eos_token_id=50256, pad_token_id=50256,
+                      length_penalty=1.0, num_return_sequences=1, user_ids=None):
+        """
+        Beam search continuing each context with layers.BeamSearch, the GPT-2 past as cache
+        :param input_ids: (batch_size, context_length) contexts
+        :param max_length: length of a context and its continuation together, as in gpt2.generate
+        :param user_ids: (batch_size,) token id of the user each response is generated for, if config.users:
+            it follows its context with eos_token_id, as build_feature puts the next speaker before an utterance
+        :return: (batch_size * num_return_sequences, length) contexts followed by their best continuations,
+                 ending with eos_token_id unless cut at max_length and padded with pad_token_id
+        """
+        if user_ids is not None:
+            speakers = torch.stack([user_ids, torch.full_like(user_ids, eos_token_id)], dim=1)
+            input_ids = torch.cat([input_ids, speakers.to(input_ids)], dim=1)
+
+        def step(input_ids, past):
+            hidden_states, past = self.gpt2.transformer(input_ids, past=past, use_cache=True)[:2]
+            return self.gpt2.lm_head(hidden_states[:, -1, :]), past
+
+        def reorder(past, index):
+            return [layer_past.index_select(1, index) for layer_past in past]
+
+        beam_search = layers.BeamSearch(num_beams, max_length, eos_token_id, pad_token_id, length_penalty,
+                                        num_return_sequences=num_return_sequences)
+        outputs, _ = beam_search.search(step, reorder, input_ids.repeat_interleave(num_beams, dim=0))
+        return torch.cat([input_ids.repeat_interleave(num_return_sequences, dim=0), outputs], dim=1)
+
     @torch.no_grad()
     def generate_2(
         self,
@@ -106,7 +212,7 @@ class DialoGPT(nn.Module):
         repetition_penalty = repetition_penalty if repetition_penalty is not None else self.gpt2_config.repetition_penalty
         bos_token_id = bos_token_id if bos_token_id is not None else self.gpt2_config.bos_token_id
         pad_token_id = pad_token_id if pad_token_id is not None else self.gpt2_config.pad_token_id
-        eos_token_ids = eos_token_ids if eos_token_ids is not None else self.gpt2_config.eos_token_ids
+        eos_token_ids = eos_token_ids if eos_token_ids is not None else self.gpt2_config.eos_token_id
         length_penalty = length_penalty if length_penalty is not None else self.gpt2_config.length_penalty
         num_return_sequences = (
             num_return_sequences if num_return_sequences is not None else self.gpt2_config.num_return_sequences
@@ -151,6 +257,9 @@ class DialoGPT(nn.Module):
         else:
             assert input_ids.dim() == 2, "Input prompt should be of shape (batch_size, sequence length)."
 
+        if do_sample and num_beams > 1:
+            raise ValueError("Beam search keeps the most likely beams and cannot sample, set `do_sample` to False.")
+
         # not allow to duplicate outputs when greedy decoding
         if do_sample is False:
             if num_beams == 1:
@@ -171,9 +280,8 @@ class DialoGPT(nn.Module):
             )
             pad_token_id = eos_token_ids[0]
 
-        # current position and vocab size
+        # current position
         cur_len = input_ids.shape[1]
-        vocab_size = self.config.vocab_size
 
         # set effective batch size and effective batch multiplier according to do_sample
         if do_sample:
@@ -183,6 +291,10 @@ class DialoGPT(nn.Module):
             effective_batch_size = batch_size
             effective_batch_mult = 1
 
+        if num_beams > 1:
+            return self.beam_generate(input_ids, max_length, num_beams, eos_token_ids[0], pad_token_id,
+                                      length_penalty, num_return_sequences, user_ids)
+
         # Expand input ids if num_beams > 1 or num_return_sequences > 1
         if num_return_sequences > 1 or num_beams > 1:
             input_ids_len = input_ids.shape[-1]
@@ -191,41 +303,20 @@ class DialoGPT(nn.Module):
                 effective_batch_size * num_beams, input_ids_len
             )  # shape: (batch_size * num_return_sequences * num_beams, cur_len)
 
-        if num_beams > 1:
-            assert False
-            #TODO Suppor it
-            output = self._generate_beam_search(
-                input_ids,
-                cur_len,
-                max_length,
-                do_sample,
-                temperature,
-                top_k,
-                top_p,
-                repetition_penalty,
-                pad_token_id,
-                eos_token_ids,
-                effective_batch_size,
-                num_return_sequences,
-                length_penalty,
-                num_beams,
-                vocab_size,
-            )
-        else:
-            output = self._generate_no_beam_search(
-                input_ids,
-                cur_len,
-                max_length,
-                do_sample,
-                temperature,
-                top_k,
-                top_p,
-                repetition_penalty,
-                pad_token_id,
-                eos_token_ids,
-                effective_batch_size,
-                user_ids,
-            )
+        output = self._generate_no_beam_search(
+            input_ids,
+            cur_len,
+            max_length,
+            do_sample,
+            temperature,
+            top_k,
+            top_p,
+            repetition_penalty,
+            pad_token_id,
+            eos_token_ids,
+            effective_batch_size,
+            user_ids,
+        )
 
         return output
 
@@ -344,18 +435,28 @@ class GPT2(GPT2LMHeadModel):
         inputs_embeds=None,
         labels=None,
         use_cache=True,
-        logits_only=False):
+        logits_only=False,
+        segment_ids=None,
+        hidden_only=False):
         
-        transformer_outputs = self.transformer(
-            input_ids,
-            past=past,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache)
+        checkpointing = (self.training and getattr(self.config, 'activation_checkpointing', 0) > 0 and past is None
+                         and attention_mask is None and head_mask is None and inputs_embeds is None)
+        if segment_ids is not None or checkpointing:
+            transformer_outputs = self.blockwise_transformer(input_ids, position_ids, token_type_ids, segment_ids)
+        else:
+            transformer_outputs = self.transformer(
+                input_ids,
+                past=past,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                use_cache=use_cache)
         hidden_states = transformer_outputs[0]
+        if hidden_only:
+            # the caller applies lm_head to the positions it needs
+            return hidden_states
         lm_logits = self.lm_head(hidden_states)
         outputs = lm_logits
         if not logits_only:
@@ -376,6 +477,42 @@ class GPT2(GPT2LMHeadModel):
                     outputs = (loss, hidden_states)
         return outputs
 
+    def blockwise_transformer(self, input_ids, position_ids, token_type_ids, segment_ids=None):
+        """
+        Run the transformer by calling its blocks directly, for what GPT2Model does not support:
+        rows that hold several conversations, and activation checkpointing of the blocks while training.
+        GPT2Model only takes a [batch_size, seq_len] padding mask, so packed rows get a block-diagonal mask:
+        a token attends to earlier tokens of its own segment only.
+        :param segment_ids: (batch_size, seq_len) index of the conversation of each token in its row, or None
+        """
+        transformer = self.transformer
+        if position_ids is None:
+            position_ids = torch.arange(input_ids.size(-1), dtype=torch.long, device=input_ids.device).unsqueeze(0)
+        hidden_states = transformer.wte(input_ids) + transformer.wpe(position_ids)
+        if token_type_ids is not None:
+            hidden_states = hidden_states + transformer.wte(token_type_ids)
+        hidden_states = transformer.drop(hidden_states)
+
+        attention_mask = None
+        if segment_ids is not None:
+            # (batch_size, 1, seq_len, seq_len), added to the causal attention scores of every head
+            same_segment = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+            attention_mask = (1.0 - same_segment.unsqueeze(1).to(hidden_states.dtype)) * -10000.0
+
+        interval = getattr(self.config, 'activation_checkpointing', 0)
+        if self.training and interval > 0:
+            hidden_states = layers.checkpoint_blocks(transformer.h, forward_gpt2_block, hidden_states, attention_mask,
+                                                     interval=interval)
+        else:
+            for block in transformer.h:
+                hidden_states = forward_gpt2_block(block, hidden_states, attention_mask)
+        hidden_states = transformer.ln_f(hidden_states)
+        return (hidden_states,)
+
+
+def forward_gpt2_block(block, hidden_states, attention_mask):
+    return block(hidden_states, attention_mask=attention_mask)[0]
+
 
 def top_k_top_p_filtering(logits, top_k=0, top_p=1.0, filter_value=-float("Inf"), min_tokens_to_keep=1):
     """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
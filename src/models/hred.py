@@ -30,7 +30,7 @@ class HRED(nn.Module):
             self.decoder.embedding = self.encoder.embedding
 
     def forward(self, input_utterances, input_utterance_length, input_conversation_length,
-                target_utterances, decode=False):
+                target_utterances, decode=False, target_utterance_length=None):
         """
         Forward of HRED
         :param input_utterances: [num_utterances, max_utter_len]
@@ -38,6 +38,8 @@ class HRED(nn.Module):
         :param input_conversation_length: [batch_size]
         :param target_utterances: [num_utterances, seq_len]
         :param decode: True or False
+        :param target_utterance_length: [num_utterances], if given (summed loss, number of words) of the target
+            utterances are returned instead of the decoder outputs, see DecoderRNN.loss
         :return: decoder_outputs
         """
         num_utterances = input_utterances.size(0)
@@ -60,7 +62,12 @@ class HRED(nn.Module):
         decoder_init = decoder_init.view(self.decoder.num_layers, -1, self.decoder.hidden_size)
 
         if not decode:
-            decoder_outputs = self.decoder(target_utterances, init_h=decoder_init, decode=decode)
+            hidden_only = target_utterance_length is not None
+            decoder_outputs = self.decoder(target_utterances, init_h=decoder_init, decode=decode,
+                                           hidden_only=hidden_only)
+            if hidden_only:
+                return self.decoder.loss(decoder_outputs, target_utterances, target_utterance_length,
+                                         self.config.loss_chunk_size)
             return decoder_outputs
 
         else:
@@ -27,7 +27,11 @@ class SpeakAddr(nn.Module):
             self.decoder.embedding = self.encoder.embedding
 
     def forward(self, input_utterances, conv_users, input_utterance_length, input_conversation_length,
-                target_utterances, decode=False):
+                target_utterances, decode=False, target_utterance_length=None):
+        """
+        :param target_utterance_length: if given, (summed loss, number of words) of the target utterances
+            are returned instead of the decoder outputs, see DecoderSARNN.loss
+        """
         num_utterances = input_utterances.size(0)
 
         _, encoder_hidden = self.encoder(input_utterances, input_utterance_length)
@@ -44,7 +48,12 @@ class SpeakAddr(nn.Module):
         decoder_init = (decoder_init_h, decoder_init_c)
 
         if not decode:
-            decoder_outputs = self.decoder(target_utterances, conv_users, init_h=decoder_init, decode=decode)
+            hidden_only = target_utterance_length is not None
+            decoder_outputs = self.decoder(target_utterances, conv_users, init_h=decoder_init, decode=decode,
+                                           hidden_only=hidden_only)
+            if hidden_only:
+                return self.decoder.loss(decoder_outputs, target_utterances, target_utterance_length,
+                                         self.config.loss_chunk_size)
             return decoder_outputs
         else:
             prediction, final_score, length = self.decoder.beam_decode(init_h=decoder_init, user_inputs=conv_users)
@@ -82,4 +82,168 @@ class Transformer(nn.Module):
         outputs = self.linear(outputs)
         outputs = torch.einsum('ijk->jik', outputs)
 
-        return outputs
\ No newline at end of file
+        return outputs
+
+    def encode(self, input_utterances, input_mask):
+        """
+        Run the encoder once over the context, for decode_step
+        :param input_mask: True at the padding of input_utterances
+        :return: DecoderState with the memory keys and values of every decoder layer
+        """
+        enc_embed = self.tok_embedding(input_utterances) + self.pos_embedding(input_utterances)
+        enc_embed = torch.einsum('ijk->jik', enc_embed)
+        memory = self.transformer.encoder(enc_embed, src_key_padding_mask=input_mask)
+        memory = torch.einsum('ijk->jik', memory)  # (batch_size, src_len, d_model)
+
+        memory_key_values = []
+        for layer in self.transformer.decoder.layers:
+            attn = layer.multihead_attn
+            _, k_w, v_w = attn.in_proj_weight.chunk(3)
+            _, k_b, v_b = attn.in_proj_bias.chunk(3)
+            memory_key_values.append((project_heads(memory, k_w, k_b, attn.num_heads),
+                                      project_heads(memory, v_w, v_b, attn.num_heads)))
+        return DecoderState(memory_key_values, input_mask)
+
+    def decode_step(self, target_words, state):
+        """
+        Decode the next position of every row, the positions before it being cached in state as in forward
+        :param target_words: (batch_size,) words at the position
+        :param state: DecoderState of encode, to which the keys and values of the position are appended
+        :return: logits (batch_size, vocab_size) of the following words
+        """
+        x = self.tok_embedding(target_words) + self.pos_embedding.pe[:, state.length]
+        x = x.unsqueeze(1)  # (batch_size, 1, d_model)
+
+        for i, layer in enumerate(self.transformer.decoder.layers):
+            attn = layer.self_attn
+            q_w, k_w, v_w = attn.in_proj_weight.chunk(3)
+            q_b, k_b, v_b = attn.in_proj_bias.chunk(3)
+            key = project_heads(x, k_w, k_b, attn.num_heads)
+            value = project_heads(x, v_w, v_b, attn.num_heads)
+            if state.key_values[i] is not None:
+                past_key, past_value = state.key_values[i]
+                key, value = torch.cat((past_key, key), dim=2), torch.cat((past_value, value), dim=2)
+            state.key_values[i] = (key, value)
+            a = attend(attn, project_heads(x, q_w, q_b, attn.num_heads), key, value)
+            x = layer.norm1(x + layer.dropout1(a))
+
+            attn = layer.multihead_attn
+            q_w, q_b = attn.in_proj_weight.chunk(3)[0], attn.in_proj_bias.chunk(3)[0]
+            key, value = state.memory_key_values[i]
+            a = attend(attn, project_heads(x, q_w, q_b, attn.num_heads), key, value, state.memory_mask)
+            x = layer.norm2(x + layer.dropout2(a))
+
+            m = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm3(x + layer.dropout3(m))
+
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+        state.length += 1
+
+        return self.linear(x.squeeze(1))
+
+    @torch.no_grad()
+    def greedy_decode(self, input_utterances, input_mask, sos_id, eos_id, pad_id, max_len):
+        """
+        Greedy decoding of a batch with encode and decode_step
+        :return: list of the words decoded for each row, up to and including eos_id
+        """
+        batch_size = input_utterances.size(0)
+        state = self.encode(input_utterances, input_mask)
+        words = input_utterances.new_full((batch_size,), sos_id)
+        outputs = input_utterances.new_full((batch_size, max_len), pad_id)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=input_utterances.device)
+
+        for t in range(max_len):
+            words = self.decode_step(words, state).argmax(dim=-1)
+            outputs[:, t] = words.masked_fill(finished, pad_id)
+            finished = finished | (words == eos_id)
+            # checked every few steps only, as reading it back waits for the device
+            if t % CHECK_FINISHED_EVERY == CHECK_FINISHED_EVERY - 1 and finished.all():
+                break
+
+        return [truncate_at(words, eos_id) for words in outputs.tolist()]
+
+    @torch.no_grad()
+    def beam_decode(self, input_utterances, input_mask, sos_id, eos_id, pad_id, max_len, beam_size,
+                    length_penalty=1.0):
+        """
+        Beam search over a batch with encode and decode_step, see layers.BeamSearch
+        :return: list of the words of the best hypothesis of each row, up to and including eos_id
+        """
+        batch_size = input_utterances.size(0)
+        state = self.encode(input_utterances, input_mask)
+        state = state.index_select(torch.arange(batch_size, device=input_utterances.device).repeat_interleave(beam_size))
+
+        def step(input_ids, state):
+            return self.decode_step(input_ids[:, -1], state), state
+
+        def reorder(state, index):
+            # the beams stay within their conversation, whose memory they share
+            return state.index_select(index, memory=False)
+
+        beam_search = layers.BeamSearch(beam_size, max_len + 1, eos_id, pad_id, length_penalty,
+                                        check_every=CHECK_FINISHED_EVERY)
+        outputs, _ = beam_search.search(step, reorder, input_utterances.new_full((batch_size * beam_size, 1), sos_id),
+                                        state)
+        return [truncate_at(words, eos_id) for words in outputs.tolist()]
+
+
+# steps between two checks of whether every row has finished decoding
+CHECK_FINISHED_EVERY = 8
+
+
+class DecoderState(object):
+    def __init__(self, memory_key_values, memory_mask):
+        """
+        Keys and values cached for Transformer.decode_step
+        :param memory_key_values: (key, value) of the encoder memory for each decoder layer,
+                                  (batch_size, n_heads, src_len, head_dim)
+        :param memory_mask: True at the padding of the memory
+        """
+        self.memory_key_values = memory_key_values
+        self.memory_mask = memory_mask
+        # (key, value) of the decoded positions for each decoder layer
+        self.key_values = [None] * len(memory_key_values)
+        self.length = 0
+
+    def index_select(self, index, memory=True):
+        """
+        State of the rows of index, e.g. the beams kept by a beam search
+        :param memory: also select the memory, not needed when index keeps every row within its conversation
+        """
+        state = DecoderState(self.memory_key_values, self.memory_mask)
+        if memory:
+            state.memory_key_values = [(k.index_select(0, index), v.index_select(0, index))
+                                       for k, v in self.memory_key_values]
+            state.memory_mask = self.memory_mask.index_select(0, index)
+        state.key_values = [None if kv is None else (kv[0].index_select(0, index), kv[1].index_select(0, index))
+                            for kv in self.key_values]
+        state.length = self.length
+        return state
+
+
+def project_heads(x, weight, bias, n_heads):
+    """(batch_size, len, d_model) projected by weight and bias and split into (batch_size, n_heads, len, head_dim)"""
+    batch_size, length, _ = x.size()
+    x = F.linear(x, weight, bias)
+    return x.view(batch_size, length, n_heads, -1).transpose(1, 2)
+
+
+def attend(attn, query, key, value, key_padding_mask=None):
+    """
+    Output of the nn.MultiheadAttention attn for a query, key and value already split by project_heads
+    :param key_padding_mask: True at the keys not to attend to
+    """
+    w = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(query.size(-1))
+    if key_padding_mask is not None:
+        w = w.masked_fill(key_padding_mask[:, None, None, :], -float('inf'))
+    w = F.softmax(w, dim=-1)
+    a = torch.matmul(w, value).transpose(1, 2)
+    a = a.reshape(a.size(0), a.size(1), -1)
+    return attn.out_proj(a)
+
+
+def truncate_at(words, eos_id):
+    """words up to and including the first eos_id"""
+    return words[:words.index(eos_id) + 1] if eos_id in words else words
@@ -58,7 +58,7 @@ class VHRED(nn.Module):
         pass
 
     def forward(self, utterances, utterance_length, input_conversation_length, target_utterances,
-                decode=False):
+                decode=False, target_utterance_length=None):
         """
         Forward of VHRED
         :param utterances: [num_utterances, max_utter_len]
@@ -66,6 +66,8 @@ class VHRED(nn.Module):
         :param input_conversation_length: [batch_size]
         :param target_utterances: [num_utterances, seq_len]
         :param decode: True or False
+        :param target_utterance_length: [num_utterances], if given (summed loss, number of words) of the target
+            utterances are returned instead of the decoder outputs, see DecoderRNN.loss
         :return: decoder_outputs
         """
         batch_size = input_conversation_length.size(0)
@@ -110,7 +112,12 @@ class VHRED(nn.Module):
         decoder_init = decoder_init.transpose(1, 0).contiguous()
 
         if not decode:
-            decoder_outputs = self.decoder(target_utterances, init_h=decoder_init, decode=decode)
+            hidden_only = target_utterance_length is not None
+            decoder_outputs = self.decoder(target_utterances, init_h=decoder_init, decode=decode,
+                                           hidden_only=hidden_only)
+            if hidden_only:
+                decoder_outputs = self.decoder.loss(decoder_outputs, target_utterances, target_utterance_length,
+                                                    self.config.loss_chunk_size)
             return decoder_outputs, kl_div
         else:
             prediction, final_score, length = self.decoder.beam_decode(init_h=decoder_init)
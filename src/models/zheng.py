@@ -16,6 +16,7 @@ class ZHENG(nn.Module):
         gpt_config = OpenAIGPTConfig().from_pretrained('openai-gpt')
         setattr(gpt_config, 'users', config.users)
         setattr(gpt_config, 'user_size', config.user_size)
+        setattr(gpt_config, 'activation_checkpointing', config.activation_checkpointing)
 
         if config.pretrained:
             transformer = TransformerModule(gpt_config).from_pretrained('openai-gpt', config=gpt_config)
@@ -35,8 +36,16 @@ class ZHENG(nn.Module):
     def encode(self, prev, prev_mask, user_ids=None):
         return self.transformer(prev, prev_mask, user_ids=user_ids)
     
-    def decode(self, x, x_mask, enc_hidden, prev_mask, user_ids=None):
-        return self.linear(self.transformer(x, x_mask, enc_hidden, prev_mask, user_ids=user_ids))
+    def decode(self, x, x_mask, enc_hidden, prev_mask, user_ids=None, past=None, use_cache=False):
+        """
+        :param past: presents returned by a previous call with use_cache, x then only holds the next positions
+        :param use_cache: also return the presents of every layer, see TransformerModule
+        """
+        if use_cache:
+            hidden_states, presents = self.transformer(x, x_mask, enc_hidden, prev_mask, user_ids=user_ids,
+                                                       past=past, use_cache=True)
+            return self.linear(hidden_states), presents
+        return self.linear(self.transformer(x, x_mask, enc_hidden, prev_mask, user_ids=user_ids, past=past))
     
     def forward(self, x, x_mask, prev, prev_mask, x_user_ids=None, prev_user_ids=None):
         enc_hidden = self.transformer(prev, prev_mask, user_ids=prev_user_ids)
@@ -48,147 +57,42 @@ class ZHENG(nn.Module):
     def beam_generate(self, prev, prev_mask, prev_user_ids, x_user_ids, sos_id, pad_id, eos_id):
 
         batch_size = prev.size(0)
-        max_seq_len = prev.size(1)
+        src_len = prev.size(1)
+        max_seq_len = self.config.max_seq_len
         beam_size = self.config.beam_size
-        vocab_size = self.config.vocab_size
         length_penalty = 1.0
 
         enc_hidden = self.encode(prev, prev_mask, prev_user_ids) # (batch_size, max_seq_len, hidden_size)
-        enc_hidden = enc_hidden.repeat(1, beam_size, 1) # (batch_size, max_seq_len * beam_size, hidden_size)
-        enc_hidden = enc_hidden.contiguous().view(batch_size * beam_size, max_seq_len, -1) # (batch_size * beam_size, max_seq_len, hidden_size)
+        enc_hidden = enc_hidden.repeat(1, beam_size, 1) # (batch_size, src_len * beam_size, hidden_size)
+        enc_hidden = enc_hidden.contiguous().view(batch_size * beam_size, src_len, -1) # (batch_size * beam_size, src_len, hidden_size)
         
-        prev_mask = prev_mask.repeat(1, beam_size).contiguous().view(-1, max_seq_len) # (batch_size * beam_size, max_seq_len)
+        prev_mask = prev_mask.repeat(1, beam_size).contiguous().view(-1, src_len) # (batch_size * beam_size, src_len)
 
         if x_user_ids is not None:
-            x_user_ids = x_user_ids.repeat(1, beam_size).contiguous().view(-1, max_seq_len) # (batch_size * beam_size, max_seq_len)
+            x_user_ids = x_user_ids.repeat(1, beam_size).contiguous().view(-1, x_user_ids.size(1)) # (batch_size * beam_size, max_seq_len)
 
         input_ids = torch.LongTensor([[sos_id]] * batch_size * beam_size).to(self.config.device) # (batch_size * beam_size, 1)
 
-        batch_position = (torch.arange(0, batch_size).long() * beam_size).to(self.config.device)
-
-        beam_scores = torch.zeros((batch_size, beam_size), dtype=torch.float, device=prev.device)
-        beam_scores[:, 1:] = -1e9
-        beam_scores = beam_scores.view(-1)  # shape (batch_size * num_beams,)
-
-        done = [False for _ in range(batch_size)]
-
-        generated_hyps = [
-            BeamHypotheses(beam_size, max_seq_len, length_penalty, early_stopping=False) for _ in range(batch_size)
-        ]
-
-        cur_len = 1
-
-        while cur_len < max_seq_len:
-            x_user_id = x_user_ids[...,:cur_len] if x_user_ids is not None else None
-            scores = self.decode(input_ids, None, enc_hidden, prev_mask, x_user_id)[:,-1,:] # (batch_size * beam_size, vocab_size)
-            scores = F.log_softmax(scores, dim=-1)  # (batch_size * beam_size, vocab_size)
-            assert scores.size() == (batch_size * beam_size, vocab_size)
-
-            _scores = beam_scores[:, None].expand_as(scores) + scores
-            _scores = _scores.view(batch_size, beam_size * vocab_size)  # (batch_size, beam_size * vocab_size)
-            next_scores, next_words = torch.topk(_scores, 2 * beam_size, dim=1, largest=True, sorted=True)
-
-            assert next_scores.size() == next_words.size() == (batch_size, 2 * beam_size)
-
-            # next batch beam content
-            # list of (batch_size * num_beams) tuple(next hypothesis score, next word, current position in the batch)
-            next_batch_beam = []
-
-            # for each sentence
-            for batch_idx in range(batch_size):
-                                # if we are done with this sentence
-                done[batch_idx] = done[batch_idx] or generated_hyps[batch_idx].is_done(
-                    next_scores[batch_idx].max().item()
-                )
-                if done[batch_idx]:
-                    assert (
-                        len(generated_hyps[batch_idx]) >= beam_size
-                    ), "Batch can only be done if at least {} beams have been generated".format(beam_size)
-                    assert (
-                        eos_id is not None and pad_id is not None
-                    ), "generated beams >= num_beams -> eos_token_id and pad_token have to be defined"
-                    next_batch_beam.extend([(0, pad_id, 0)] * beam_size)  # pad the batch
-                    continue
-
-                # next sentence beam content
-                next_sent_beam = []
-
-                # next words for this sentence
-                for idx, score in zip(next_words[batch_idx], next_scores[batch_idx]):
-
-                    # get beam and word IDs
-                    beam_id = idx // vocab_size
-                    word_id = idx % vocab_size
-
-                    # add to generated hypotheses if end of sentence or last iteration
-                    if word_id.item() == eos_id:
-                        generated_hyps[batch_idx].add(
-                            input_ids[batch_idx * beam_size + beam_id, :cur_len].clone(), score.item()
-                        )
-                    else:
-                        # add next predicted word if it is not eos_token
-                        next_sent_beam.append((score, word_id, batch_idx * beam_size + beam_id))
-
-                    # the beam for next step is full
-                    if len(next_sent_beam) == beam_size:
-                        break
-            
-                # update next beam content
-                assert len(next_sent_beam) == beam_size, "Beam should always be full"
-                next_batch_beam.extend(next_sent_beam)
-                assert len(next_batch_beam) == beam_size * (batch_idx + 1)
-
-            assert len(next_batch_beam) == batch_size * beam_size
-            beam_scores = beam_scores.new([x[0] for x in next_batch_beam])
-            beam_words = input_ids.new([x[1] for x in next_batch_beam])
-            beam_idx = input_ids.new([x[2] for x in next_batch_beam])
-
-            # re-order batch
-            input_ids = input_ids[beam_idx, :]
-            input_ids = torch.cat([input_ids, beam_words.unsqueeze(1)], dim=-1)
-
-            cur_len = cur_len + 1
-
-            if all(done):
-                break
-
-        for batch_idx in range(batch_size):
-            # Add all open beam hypothesis to generated_hyps
-            if not done[batch_idx]:
-                for idx, score in zip(next_words[batch_idx], next_scores[batch_idx]):
-                    # get beam and word IDs
-                    beam_id = idx // vocab_size
-                    word_id = idx % vocab_size
-                    generated_hyps[batch_idx].add(
-                        input_ids[batch_idx * beam_size + beam_id, :cur_len].clone(), score.item()
-                    )
-
-        # select the best hypotheses
-        sent_lengths = input_ids.new(batch_size)
-        best = []
-
-        for i, hypotheses in enumerate(generated_hyps):
-            best_hyp = max(hypotheses.beams, key=lambda x: x[0])[1]
-            sent_lengths[i] = len(best_hyp)
-            best.append(best_hyp)
-
-        # shorter batches are filled with pad_token
-        if sent_lengths.min().item() != sent_lengths.max().item():
-            assert pad_id is not None, "`Pad_token_id` has to be defined"
-            sent_max_len = min(sent_lengths.max().item() + 1, max_seq_len)
-            decoded = input_ids.new(batch_size, sent_max_len).fill_(pad_id)
-
-            # fill with hypothesis and eos_token_id if necessary
-            for i, hypo in enumerate(best):
-                decoded[i, : sent_lengths[i]] = hypo
-                if sent_lengths[i] < max_seq_len:
-                    decoded[i, sent_lengths[i]] = eos_id
-        else:
-            # none of the hypotheses have an eos_token
-            assert (len(hypo) == max_seq_len for hypo in best)
-            decoded = torch.stack(best).type(torch.long).to(next(self.parameters()).device)
+        def step(input_ids, past):
+            # per layer key/value of the decoded positions and of enc_hidden, so each step only decodes its new word
+            cur_len = 0 if past is None else past[0][0][1].size(-2)
+            x_user_id = x_user_ids[..., cur_len:cur_len + input_ids.size(1)] if x_user_ids is not None else None
+            scores, past = self.decode(input_ids, None, enc_hidden, prev_mask, x_user_id, past=past, use_cache=True)
+            return scores[:, -1, :], past
+
+        beam_search = layers.BeamSearch(beam_size, max_seq_len, eos_id, pad_id, length_penalty)
+        decoded, _ = beam_search.search(step, self._reorder_cache, input_ids)
 
-        return decoded 
+        # sos_id, the words and eos_id (unless cut at max_seq_len), padded
+        return torch.cat([input_ids[::beam_size], decoded], dim=1)
+
+    @staticmethod
+    def _reorder_cache(past, beam_idx):
+        """
+        Self-attention keys and values of the beams selected by beam_idx. Those of enc_hidden are the same for
+        every beam of a conversation, and beam_idx stays within a conversation, so they are kept as they are
+        """
+        return [(tuple(t.index_select(0, beam_idx) for t in self_past), enc_past) for self_past, enc_past in past]
 
 
 
@@ -227,13 +131,24 @@ class TransformerModule(OpenAIGPTPreTrainedModel):
         if self.config.users:
             nn.init.normal_(self.user_embed.weight, std=0.02)
 
-    def forward(self, x, x_mask=None, enc_hidden=None, enc_hidden_mask=None, user_ids=None):
+    def forward(self, x, x_mask=None, enc_hidden=None, enc_hidden_mask=None, user_ids=None, past=None, use_cache=False):
+        """
+        :param past: presents returned by a previous call with use_cache, the key/value of every layer for the
+            positions before x (and for enc_hidden, which is then not projected again)
+        :param use_cache: also return the presents of every layer, for decoding the next positions with past
+        """
         device = x.device
 
         x_shape = x.size()
         x = x.view(-1, x_shape[-1])
 
-        pos_ids = torch.arange(x_shape[-1], dtype=torch.long, device=device)
+        if past is None:
+            past_length = 0
+            past = [None] * len(self.h)
+        else:
+            # value of the self-attention of the first layer: (batch, head, seq_length, head_features)
+            past_length = past[0][0][1].size(-2)
+        pos_ids = torch.arange(past_length, past_length + x_shape[-1], dtype=torch.long, device=device)
         pos_ids = pos_ids.unsqueeze(0).view(-1, x_shape[-1])
 
         if x_mask is not None: 
@@ -256,9 +171,23 @@ class TransformerModule(OpenAIGPTPreTrainedModel):
 
         hidden_states = self.drop(hidden_states)
 
-        for i, block in enumerate(self.h):
-            hidden_states = block(hidden_states, x_mask, enc_hidden=enc_hidden, enc_hidden_mask=enc_hidden_mask)
-
+        interval = getattr(self.config, 'activation_checkpointing', 0)
+        presents = ()
+        if self.training and interval > 0:
+            hidden_states = layers.checkpoint_blocks(self.h, forward_block, hidden_states, x_mask,
+                                                     enc_hidden, enc_hidden_mask, interval=interval)
+        else:
+            for i, (block, layer_past) in enumerate(zip(self.h, past)):
+                outputs = block(hidden_states, x_mask, enc_hidden=enc_hidden, enc_hidden_mask=enc_hidden_mask,
+                                layer_past=layer_past, use_cache=use_cache)
+                if use_cache:
+                    hidden_states, present = outputs
+                    presents = presents + (present,)
+                else:
+                    hidden_states = outputs
+
+        if use_cache:
+            return hidden_states, presents
         return hidden_states
 
     def get_input_embeddings(self):
@@ -269,6 +198,10 @@ class TransformerModule(OpenAIGPTPreTrainedModel):
 
 
     
+def forward_block(block, hidden_states, x_mask, enc_hidden, enc_hidden_mask):
+    return block(hidden_states, x_mask, enc_hidden=enc_hidden, enc_hidden_mask=enc_hidden_mask)
+
+
 class TransformerBlock(nn.Module):
     def __init__(self, n_features, n_heads, dropout, attn_dropout, ff_dropout, max_seq_len):
         super(TransformerBlock, self).__init__()
@@ -278,63 +211,35 @@ class TransformerBlock(nn.Module):
         self.ln_2 = nn.LayerNorm(n_features)
         self.mlp = layers.MLP(4 * n_features, n_features, ff_dropout)
 
-    def forward(self, x, attention_mask=None, head_mask=None, enc_hidden=None, enc_hidden_mask=None):
+    def forward(self, x, attention_mask=None, head_mask=None, enc_hidden=None, enc_hidden_mask=None,
+                layer_past=None, use_cache=False):
+        """
+        :param layer_past: (self-attention, enc_hidden attention) key/value of a previous call with use_cache
+        :param use_cache: also return the present (key, value) of both attentions
+        """
+        self_past, enc_past = layer_past if layer_past is not None else (None, None)
 
         a = self.attn (
-            self.ln_1(x), self.ln_1(x), self.ln_1(x), attn_mask=attention_mask, head_mask=head_mask
+            self.ln_1(x), self.ln_1(x), self.ln_1(x), attn_mask=attention_mask, head_mask=head_mask,
+            layer_past=self_past, use_cache=use_cache
         )
+        if use_cache:
+            a, self_past = a
 
         if enc_hidden is not None: 
-            a += self.attn(self.ln_1(x), self.ln_1(enc_hidden), self.ln_1(enc_hidden),
-                            attn_mask=enc_hidden_mask, head_mask=head_mask, qkv_same=False)
+            # the key/value of enc_hidden are projected once, by the first call with use_cache
+            enc_hidden = self.ln_1(enc_hidden) if enc_past is None else None
+            e = self.attn(self.ln_1(x), enc_hidden, enc_hidden,
+                          attn_mask=enc_hidden_mask, head_mask=head_mask, qkv_same=False,
+                          layer_past=enc_past, use_cache=use_cache)
+            if use_cache:
+                e, enc_past = e
+            a += e
 
         x = x + a 
         m = self.mlp(self.ln_2(x))
         x = x + m 
 
+        if use_cache:
+            return x, (self_past, enc_past)
         return x 
-
-
-class BeamHypotheses(object):
-    def __init__(self, num_beams, max_length, length_penalty, early_stopping):
-        """
-        Initialize n-best list of hypotheses.
-        """
-        self.max_length = max_length - 1  # ignoring bos_token
-        self.length_penalty = length_penalty
-        self.early_stopping = early_stopping
-        self.num_beams = num_beams
-        self.beams = []
-        self.worst_score = 1e9
-
-    def __len__(self):
-        """
-        Number of hypotheses in the list.
-        """
-        return len(self.beams)
-
-    def add(self, hyp, sum_logprobs):
-        """
-        Add a new hypothesis to the list.
-        """
-        score = sum_logprobs / len(hyp) ** self.length_penalty
-        if len(self) < self.num_beams or score > self.worst_score:
-            self.beams.append((score, hyp))
-            if len(self) > self.num_beams:
-                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
-                del self.beams[sorted_scores[0][1]]
-                self.worst_score = sorted_scores[1][0]
-            else:
-                self.worst_score = min(score, self.worst_score)
-
-    def is_done(self, best_sum_logprobs):
-        """
-        If there are enough hypotheses and that none of the hypotheses being generated
-        can become better than the worst one in the heap, then we are done with this sentence.
-        """
-        if len(self) < self.num_beams:
-            return False
-        elif self.early_stopping:
-            return True
-        else:
-            return self.worst_score >= best_sum_logprobs / self.max_length ** self.length_penalty
@@ -0,0 +1,156 @@
+import os
+import re
+import ast
+import time
+import pickle
+import random
+import shutil
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+from tqdm import tqdm
+from utils import ConvStore, conv_store_meta, conv_store_path, PAD_TOKEN, EOS_TOKEN, SOS_TOKEN, SEP_TOKEN
+from transformers import OpenAIGPTTokenizer, GPT2Tokenizer
+
+FIELD_SEP = ' +++$+++ '
+
+# cleanText of datasets/cornell2/Preprocess.ipynb, applied in the same order
+# ("what's" -> "that is" included, so that the conversations are the same as the published ones)
+CONTRACTIONS = [(re.compile(pattern), replacement) for pattern, replacement in [
+    (r"i'm", "i am"),
+    (r"he's", "he is"),
+    (r"she's", "she is"),
+    (r"it's", "it is"),
+    (r"that's", "that is"),
+    (r"what's", "that is"),
+    (r"where's", "where is"),
+    (r"how's", "how is"),
+    (r"\'ll", " will"),
+    (r"\'ve", " have"),
+    (r"\'re", " are"),
+    (r"\'d", " would"),
+    (r"won't", "will not"),
+    (r"can't", "cannot"),
+    (r"n't", " not"),
+    (r"n'", "ng"),
+    (r"'bout", "about"),
+    (r"'til", "until"),
+]]
+PUNCTUATION = re.compile(r"[-()\"#/@;:<>{}`+=~|.!?,]")
+
+vocab = None
+
+
+def clean_text(text):
+    text = text.lower()
+    # every contraction has an apostrophe
+    if "'" in text:
+        for pattern, replacement in CONTRACTIONS:
+            text = pattern.sub(replacement, text)
+    return PUNCTUATION.sub("", text)
+
+
+def parse_line(line):
+    """movie_lines.txt line -> (line id, speaker, cleaned utterance)"""
+    fields = line.strip().split(FIELD_SEP)
+    return fields[0], fields[1], clean_text(fields[-1])
+
+
+def load_tokenizer(name):
+    if name == 'gpt2':
+        return GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer = OpenAIGPTTokenizer.from_pretrained('openai-gpt')
+    # same special tokens as train.py
+    tokenizer.add_special_tokens({
+        'pad_token': PAD_TOKEN,
+        'bos_token': SOS_TOKEN,
+        'eos_token': EOS_TOKEN,
+        'sep_token': SEP_TOKEN,
+    })
+    return tokenizer
+
+
+def init_worker(tokenizer):
+    global vocab
+    vocab = tokenizer
+
+
+def encode_conversation(conv):
+    return [(speaker, vocab.encode(utter)) for speaker, utter in conv]
+
+
+def read_lines(path, encoding='iso-8859-1'):
+    with open(path, 'r', encoding=encoding) as f:
+        yield from f
+
+
+def throughput(desc, n, start):
+    elapsed = time.time() - start
+    print(f'{desc}: {n} in {elapsed:.1f}s ({n / max(elapsed, 1e-6):.0f}/s)')
+
+
+def main():
+    """
+    Build the train/valid/test conversations of cornell2 from the Cornell Movie-Dialogs Corpus
+    as convs.pkl (list of conversations of [speaker, utterance]) and as a conversation store
+    that is read with --conv_store
+    """
+    project_dir = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_dir', type=str, required=True,
+                        help='directory of movie_lines.txt and movie_conversations.txt')
+    parser.add_argument('--data_name', type=str, default='cornell2')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--tokenizer', type=str, default='openai-gpt', choices=['openai-gpt', 'gpt2', 'none'],
+                        help='tokenizer of the conversation store, none only writes the pickles')
+    parser.add_argument('--chunksize', type=int, default=1024)
+    args = parser.parse_args()
+
+    raw_dir = Path(args.raw_dir)
+    dataset_dir = project_dir.joinpath('datasets', args.data_name)
+    tokenizer = load_tokenizer(args.tokenizer) if args.tokenizer != 'none' else None
+
+    with Pool(args.num_workers, initializer=init_worker, initargs=(tokenizer,)) as pool:
+        start = time.time()
+        lines = {}
+        for line_id, speaker, utter in tqdm(pool.imap(parse_line, read_lines(raw_dir.joinpath('movie_lines.txt')),
+                                                      chunksize=args.chunksize),
+                                            ncols=80, unit='line', desc='Cleaning'):
+            lines[line_id] = [speaker, utter]
+        throughput('Cleaned lines', len(lines), start)
+
+        convs = []
+        for line in read_lines(raw_dir.joinpath('movie_conversations.txt')):
+            line_ids = ast.literal_eval(line.strip().split(FIELD_SEP)[-1])
+            convs.append([lines[line_id] for line_id in line_ids])
+        random.Random(args.seed).shuffle(convs)
+
+        n_train = int(len(convs) * 0.8)
+        n_valid = int(len(convs) * 0.9)
+        splits = [('train', convs[:n_train]), ('valid', convs[n_train:n_valid]), ('test', convs[n_valid:])]
+
+        for split, split_convs in splits:
+            split_dir = dataset_dir.joinpath(split)
+            os.makedirs(split_dir, exist_ok=True)
+            convs_path = split_dir.joinpath('convs.pkl')
+            with open(convs_path, 'wb') as f:
+                pickle.dump(split_convs, f)
+            print(f'{split}: {len(split_convs)} conversations written to {convs_path}')
+
+            if tokenizer is None:
+                continue
+
+            meta = conv_store_meta(tokenizer)
+            path = conv_store_path(convs_path, meta)
+            # the store of the previous convs.pkl is out of date
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            start = time.time()
+            store = ConvStore.build(path, pool.imap(encode_conversation, split_convs, chunksize=64), meta,
+                                    total=len(split_convs))
+            throughput(f'{split}: tokens stored in {path}', len(store.tokens), start)
+
+
+if __name__ == '__main__':
+    main()
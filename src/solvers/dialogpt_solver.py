@@ -2,16 +2,16 @@ import numpy as np
 import torch
 import torch.nn as nn
 from layers import masked_cross_entropy
-from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, EOS_ID, SOS_ID
+from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, num_batches, EOS_ID, SOS_ID, is_main_process, LossMeter
 import os
 from tqdm import tqdm
-from math import isnan
 import codecs
 import sys
-from .solver import Solver
+from .solver import Solver, inference_mode
 import torch.nn.functional as F
 from models import DialoGPT
 import copy
+from torch.utils.data import IterableDataset
 
 class SolverDialoGPT(Solver):
     def __init__(self, config, train_data_loader, eval_data_loader, vocab, is_train=True, model=None):
@@ -24,8 +24,7 @@ class SolverDialoGPT(Solver):
 
         self.config.n_gpu = torch.cuda.device_count()
 
-        t_total = len(self.train_data_loader) * self.config.n_epoch
-        cur_step = 0
+        t_total = num_batches(self.train_data_loader, self.config.n_epoch, accum_steps=self.config.grad_accum_steps)
 
         no_decay = ['bias', 'ln']
         optimizer_grouped_parameters = [
@@ -33,29 +32,27 @@ class SolverDialoGPT(Solver):
             {'params': [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
 
-        self.optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=self.config.learning_rate)
+        self.optimizer = self.adamw(optimizer_grouped_parameters)
         self.scheduler = get_linear_schedule_with_warmup(
             self.optimizer, num_warmup_steps=self.config.warmup_steps, num_training_steps=t_total
         )
 
-        if self.config.n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model).to(self.config.device)
-        else:
-            self.model = self.model.to(self.config.device)
+        self.parallelize()
+        cur_step, resume_step_i = self.resume_training()
 
         for epoch_i in range(self.epoch_i, self.config.n_epoch):
-            self.epoch_i = epoch_i 
+            self.set_epoch(epoch_i)
             self.model.train()
 
-            epoch_loss = 0.0
-
-            for batch_i, batch in enumerate(tqdm(self.train_data_loader, ncols=80)):
-                self.optimizer.zero_grad()
-                self.model.zero_grad()
+            loss_meter = LossMeter(self.loss_names(), self.config.device)
+            # optimizer steps done in the epoch, some of them before the checkpoint being resumed
+            step_i, resume_step_i = resume_step_i, 0
 
+            for batch, sync in tqdm(self.micro_batches(self.train_data_loader),
+                                    total=len(self.train_data_loader), ncols=80):
                 batch = tuple(t.to(self.config.device) for t in batch)
 
-                input_ids, position_ids, token_ids, label_ids, user_ids, user_mask = batch
+                input_ids, position_ids, token_ids, label_ids, user_ids, user_mask = batch[:6]
 
                 inputs = {
                     'input_ids': input_ids,
@@ -63,90 +60,85 @@ class SolverDialoGPT(Solver):
                     'token_type_ids': token_ids, 
                     'user_mask': user_mask
                 }
+                if len(batch) > 6:
+                    # rows packed by DialoGPTDataset.collate_packed
+                    inputs['segment_ids'] = batch[6]
 
-                outputs = self.model(**inputs)
-
-                loss_fn = nn.CrossEntropyLoss(ignore_index=-1)
-
-                if self.config.users and self.config.reversed:
-                    lm_logits, user_outputs = outputs
-                    user_ids = user_ids.view(-1)
-                    user_ids_mask = user_ids != -1 
-                    user_ids = user_ids[user_ids_mask]
-                    user_loss = loss_fn(user_outputs.view(-1, user_outputs.size(-1)),
-                        user_ids.view(-1))
-                    output_loss = loss_fn(lm_logits.view(-1, lm_logits.size(-1)),
-                                label_ids.view(-1))
-                    batch_loss = user_loss + output_loss
-                else:
-                    batch_loss = loss_fn(outputs.view(-1, outputs.size(-1)),
-                                label_ids.view(-1))
-                    user_loss = None
-                    output_loss = None
-                
-                assert not isnan(batch_loss.item())
+                with self.autocast():
+                    batch_loss, output_loss, user_loss, user_ids = self.compute_losses(inputs, label_ids, user_ids)
 
                 if self.config.n_gpu > 1: 
                     batch_loss = batch_loss.mean()
 
-                epoch_loss = (batch_i * epoch_loss + batch_loss.item()) / (batch_i + 1)
+                self.add_losses(loss_meter, batch_loss, output_loss, user_loss, label_ids, user_ids)
 
-                if batch_i % self.config.print_every == 0:
-                    tqdm.write(f'Epoch: {epoch_i+1}, iter {batch_i}: loss = {batch_loss.item():.3f}')
-                    self.writer.add_scalar('Train/loss', batch_loss.item(), cur_step)
+                self.backward(batch_loss, sync)
+                if not sync:
+                    continue
+
+                if step_i % self.config.print_every == 0:
+                    # losses per token since the last print
+                    recent_losses, _ = loss_meter.read()
+                    recent_loss = sum(recent_losses.values())
+                    tqdm.write(f'Epoch: {epoch_i+1}, iter {step_i}: loss = {recent_loss:.3f}')
+                    self.writer.add_scalar('Train/loss', recent_loss, cur_step)
                     if self.config.users and self.config.reversed:
-                        self.writer.add_scalar('Train/user_loss', user_loss.item(), cur_step)
-                        self.writer.add_scalar('Train/lmloss', output_loss.item(), cur_step)
+                        self.writer.add_scalar('Train/user_loss', recent_losses['user_loss'], cur_step)
+                        self.writer.add_scalar('Train/lmloss', recent_losses['lm_loss'], cur_step)
                     self.writer.add_scalar('Train/learning_rate', self.scheduler.get_lr()[0], cur_step)
 
-                batch_loss.backward()
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip)
-                self.optimizer.step()
-                self.scheduler.step()
+                self.step()
+                step_i += 1
                 cur_step += 1
+                self.validate_every(cur_step)
+                self.save_every(step_i)
             
             if epoch_i == 0:
-                if self.config.users and not self.config.reversed:
+                if self.config.users and not self.config.reversed and is_main_process():
                     self.vocab.save_pretrained(self.config.save_path)
 
+            _, epoch_losses = loss_meter.read()
+            epoch_loss = sum(epoch_losses.values())
             epoch_loss_history.append(epoch_loss)
             self.epoch_loss = epoch_loss
 
             print(f'Epoch {epoch_i+1} loss average: {epoch_loss:.3f}')
 
             print('\n<Validation>...')
-            val_loss, output_loss, user_loss = self.evaluate()
+            val_loss, output_loss, user_loss = self.evaluate(self.validation_loader())
             self.validation_loss  = val_loss
 
             if epoch_i % self.config.plot_every_epoch == 0:
                 self.writer.add_scalar('Val/loss', self.validation_loss, epoch_i + 1)
                 if output_loss != None and user_loss != None:
-                    self.writer.add_scalar('Val/lmloss', output_loss.item(), epoch_i + 1)
-                    self.writer.add_scalar('Val/user_loss', user_loss.item(), epoch_i + 1)
+                    self.writer.add_scalar('Val/lmloss', output_loss, epoch_i + 1)
+                    self.writer.add_scalar('Val/user_loss', user_loss, epoch_i + 1)
 
             if min_validation_loss > self.validation_loss:
                 min_validation_loss = self.validation_loss
             else:
                 patience_cnt -= 1
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
 
             if patience_cnt < 0:
                 print(f'\nEarly stop at {epoch_i}')
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
                 return epoch_loss_history
 
         self.save_model(self.config.n_epoch)
 
         return epoch_loss_history        
 
-    def evaluate(self):
+    @inference_mode()
+    def evaluate(self, data_loader=None):
         self.model.eval()
-        epoch_loss = 0.0
+        if data_loader is None:
+            data_loader = self.eval_data_loader
+        loss_meter = LossMeter(self.loss_names(), self.config.device)
 
-        for batch_i, batch in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+        for batch_i, batch in enumerate(tqdm(self.batches(data_loader), ncols=80)):
                 
-            with torch.no_grad():
-                batch = tuple(t.to(self.config.device) for t in batch)
+            batch = tuple(t.to(self.config.device) for t in batch)
             
             input_ids, position_ids, token_ids, label_ids, user_ids, user_mask = batch
             inputs = {
@@ -156,40 +148,73 @@ class SolverDialoGPT(Solver):
                 'user_mask': user_mask,
             }
 
-            outputs = self.model(**inputs)
-            
-            loss_fn = nn.CrossEntropyLoss(ignore_index=-1)
-
-            if self.config.users and self.config.reversed:
-                lm_logits, user_outputs = outputs
-                user_ids = user_ids.view(-1)
-                user_ids_mask = user_ids != -1 
-                user_ids = user_ids[user_ids_mask]
-                user_loss = loss_fn(user_outputs.view(-1, user_outputs.size(-1)),
-                    user_ids.view(-1))
-                output_loss = loss_fn(lm_logits.view(-1, lm_logits.size(-1)),
-                            label_ids.view(-1))
-                batch_loss = user_loss + output_loss
-            else: 
-                batch_loss = loss_fn(outputs.view(-1, outputs.size(-1)),
-                                                    label_ids.view(-1))
-                output_loss = None
-                user_loss = None
+            batch_loss, output_loss, user_loss, user_ids = self.compute_losses(inputs, label_ids, user_ids)
 
             
 
             if self.config.n_gpu > 1:
                 batch_loss = batch_loss.mean()
 
-            epoch_loss = (batch_i * epoch_loss + batch_loss.item()) / (batch_i + 1)
+            self.add_losses(loss_meter, batch_loss, output_loss, user_loss, label_ids, user_ids)
 
-            assert not isnan(batch_loss.item())
-        
+        # summed over every rank, for the same early stopping
+        _, epoch_losses = loss_meter.read()
+        epoch_loss = sum(epoch_losses.values())
+        output_loss = epoch_losses.get('lm_loss')
+        user_loss = epoch_losses.get('user_loss')
         print(f'Validation loss: {epoch_loss:.3f}\n')
         return epoch_loss, output_loss, user_loss
 
     
+    def compute_losses(self, inputs, label_ids, user_ids):
+        """
+        Losses of a batch. Unless loss_chunk_size is 0, the language model loss is computed from the hidden states
+        of the labeled positions only, without the logits of the whole batch.
+        :return: batch_loss, output_loss and user_loss (both None without reversed users),
+            ids of the user tokens without the -1 of the other tokens
+        """
+        loss_fn = nn.CrossEntropyLoss(ignore_index=-1)
+        user_outputs = None
+        if self.config.loss_chunk_size > 0:
+            outputs = self.model(**inputs, label_ids=label_ids)
+            # summed over the replicas of DataParallel
+            loss_sum, n_tokens = outputs[0].sum(), outputs[1].sum()
+            output_loss = loss_sum / n_tokens.clamp(min=1)
+            if len(outputs) > 2:
+                user_outputs = outputs[2]
+        else:
+            outputs = self.model(**inputs)
+            if self.config.users and self.config.reversed:
+                outputs, user_outputs = outputs
+            output_loss = loss_fn(outputs.view(-1, outputs.size(-1)), label_ids.view(-1))
+
+        if user_outputs is None:
+            return output_loss, None, None, user_ids
+
+        user_ids = user_ids.view(-1)
+        user_ids = user_ids[user_ids != -1]
+        user_loss = loss_fn(user_outputs.view(-1, user_outputs.size(-1)), user_ids)
+        return user_loss + output_loss, output_loss, user_loss, user_ids
+
+    def loss_names(self):
+        if self.config.users and self.config.reversed:
+            return ['lm_loss', 'user_loss']
+        return ['lm_loss']
+
+    def add_losses(self, loss_meter, batch_loss, output_loss, user_loss, label_ids, user_ids):
+        """
+        Add the mean losses of a batch to loss_meter as sums over their tokens
+        :param user_ids: ids of the user tokens, without the -1 of the other tokens
+        """
+        n_tokens = (label_ids != -1).sum()
+        if user_loss is None:
+            loss_meter.add([batch_loss * n_tokens], n_tokens)
+        else:
+            loss_meter.add([output_loss * n_tokens, user_loss * user_ids.numel()], [n_tokens, user_ids.numel()])
+
     def export_samples(self, beam_size, file_write=True):
+        if self.config.batched_export and not self.config.mmi:
+            return self.export_batched_samples(beam_size)
         self.model.eval()
         context_history = list()
         sample_history = list()
@@ -204,7 +229,7 @@ class SolverDialoGPT(Solver):
             reversed_config.original = False
             self.reversed_model = DialoGPT(reversed_config).cuda(1)
 
-        for batch_i, batch in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+        for batch_i, batch in enumerate(tqdm(self.batches(self.eval_data_loader), ncols=80)):
            
             with torch.no_grad():
                 batch = tuple(t.to(self.config.device) for t in batch)
@@ -226,17 +251,32 @@ class SolverDialoGPT(Solver):
             else:
                 num_return_sequences = 1
 
-            output_sequences = self.model.gpt2.generate(
-                input_ids=input_ids,
-                max_length=self.config.max_seq_len-20,
-                temperature=0.9,
-                top_k=0,
-                top_p=0.9,
-                repetition_penalty=1.0,
-                do_sample=True,
-                num_return_sequences=num_return_sequences,
-                pad_token_id=self.vocab.pad_token,
-            )
+            if self.config.beam_export and beam_size > 1:
+                output_sequences = self.model.generate_2(
+                    input_ids=input_ids,
+                    max_length=self.config.max_seq_len-20,
+                    do_sample=False,
+                    num_beams=beam_size,
+                    eos_token_ids=self.vocab.eos_token_id,
+                    pad_token_id=self.vocab.eos_token_id,
+                    num_return_sequences=num_return_sequences,
+                )
+            else:
+                # one conversation per batch, in dataset order: sampled from the RNG seeded by its index, as
+                # export_batched_samples samples it, forked so that the global RNG is left as it was
+                with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+                    torch.manual_seed(self.config.seed + batch_i)
+                    output_sequences = self.model.gpt2.generate(
+                        input_ids=input_ids,
+                        max_length=self.config.max_seq_len-20,
+                        temperature=0.9,
+                        top_k=0,
+                        top_p=0.9,
+                        repetition_penalty=1.0,
+                        do_sample=True,
+                        num_return_sequences=num_return_sequences,
+                        pad_token_id=self.vocab.pad_token,
+                    )
 
             loss_fn = nn.CrossEntropyLoss(ignore_index=-1)
 
@@ -307,27 +347,103 @@ class SolverDialoGPT(Solver):
 
                 output_sequences = results[winner][0]
             output_sequences.squeeze_()
-            output = output_sequences.tolist()
-            output = self.vocab.decode(output, clean_up_tokenization_spaces=True)
-
-            output = output.split(self.vocab.eos_token)
-            assert (len(output) >= 2)
-            gen_history = output[self.config.n_context].replace("\n", " ")
-            generated_history.append(gen_history)
-
             input_ids.squeeze_()
-            input_ids = input_ids.tolist()
-            inputs = self.vocab.decode(input_ids, clean_up_tokenization_spaces=True)
-            inputs.replace("\n", " ")
-            input_history.append(inputs)
-
             gt_ids.squeeze_()
-            gt_ids = gt_ids.tolist()
-            gt = self.vocab.decode(gt_ids, clean_up_tokenization_spaces=True)
-            gt = gt.split(self.vocab.eos_token)
-            ground_truth = gt[0].replace("\n", " ")
+            inputs, generated, ground_truth = self.decode_sample(output_sequences.tolist(), input_ids.tolist(),
+                                                                 gt_ids.tolist())
+            input_history.append(inputs)
+            generated_history.append(generated)
             ground_truth_history.append(ground_truth)
 
+        return self.write_samples(beam_size, input_history, generated_history, ground_truth_history)
+
+    @torch.no_grad()
+    def export_batched_samples(self, beam_size):
+        """
+        export_samples of a whole batch at a time: the contexts are generated together by DialoGPT.generate_batch,
+        each one with a generator seeded by its index in the dataset (its position in the stream when streaming),
+        or by beam_generate_batch with --beam_export, so the samples are the ones of export_samples one
+        conversation at a time, written in dataset order
+        """
+        self.model.eval()
+        if isinstance(self.eval_data_loader.dataset, IterableDataset):
+            index_batches = None
+        else:
+            # the dataset indices of each batch, also when the batches are sorted by length
+            index_batches = iter(self.eval_data_loader.batch_sampler)
+        samples = dict()
+
+        for batch in tqdm(self.eval_data_loader, ncols=80):
+            input_ids, position_ids, token_ids, label_ids, user_ids, user_masks = batch
+            lengths = (position_ids.max(dim=1)[0] + 1).tolist()
+            if index_batches is not None:
+                indices = next(index_batches)
+            else:
+                indices = range(len(samples), len(samples) + len(lengths))
+
+            contexts, gt_ids = list(), list()
+            for ids, labels, length in zip(input_ids.tolist(), label_ids.tolist(), lengths):
+                ids, labels = ids[:length], labels[:length]
+                # the first token and those following an unlabeled one, as export_samples flattens a context
+                contexts.append([token for token, prev in zip(ids, [-1] + labels[:-1]) if prev == -1])
+                gt_ids.append([token for token, label in zip(ids, labels) if label != -1][1:])
+
+            if self.config.beam_export and beam_size > 1:
+                outputs = self.beam_generate_batch(contexts, beam_size)
+            else:
+                generators = [torch.Generator(device=self.config.device).manual_seed(self.config.seed + index)
+                              for index in indices]
+                outputs = self.model.generate_batch(contexts, max_length=self.config.max_seq_len-20,
+                                                    generators=generators, temperature=0.9, top_p=0.9,
+                                                    eos_token_id=self.vocab.eos_token_id)
+            for index, output, context, gt in zip(indices, outputs, contexts, gt_ids):
+                samples[index] = self.decode_sample(output, context, gt)
+
+        input_history = [samples[index][0] for index in sorted(samples)]
+        generated_history = [samples[index][1] for index in sorted(samples)]
+        ground_truth_history = [samples[index][2] for index in sorted(samples)]
+        return self.write_samples(beam_size, input_history, generated_history, ground_truth_history)
+
+    def beam_generate_batch(self, contexts, beam_size):
+        """
+        Beam search continuation of each context, the one export_samples finds for it alone:
+        the contexts of the same length are searched together, so none of them is padded
+        :param contexts: list of token id lists
+        :return: list of each context followed by its continuation
+        """
+        outputs = [None] * len(contexts)
+        for length in sorted(set(len(context) for context in contexts)):
+            indices = [i for i, context in enumerate(contexts) if len(context) == length]
+            input_ids = torch.tensor([contexts[i] for i in indices], dtype=torch.long, device=self.config.device)
+            output_sequences = self.model.generate_2(
+                input_ids=input_ids,
+                max_length=self.config.max_seq_len-20,
+                do_sample=False,
+                num_beams=beam_size,
+                eos_token_ids=self.vocab.eos_token_id,
+                pad_token_id=self.vocab.eos_token_id,
+            )
+            for i, output in zip(indices, output_sequences.tolist()):
+                outputs[i] = output
+        return outputs
+
+    def decode_sample(self, output_ids, input_ids, gt_ids):
+        """
+        :return: context, generated response and ground truth of a conversation, decoded from their token ids
+        """
+        output = self.vocab.decode(output_ids, clean_up_tokenization_spaces=True)
+        output = output.split(self.vocab.eos_token)
+        assert (len(output) >= 2)
+        generated = output[self.config.n_context].replace("\n", " ")
+
+        inputs = self.vocab.decode(input_ids, clean_up_tokenization_spaces=True)
+
+        gt = self.vocab.decode(gt_ids, clean_up_tokenization_spaces=True)
+        gt = gt.split(self.vocab.eos_token)
+        ground_truth = gt[0].replace("\n", " ")
+        return inputs, generated, ground_truth
+
+    def write_samples(self, beam_size, input_history, generated_history, ground_truth_history):
         target_file_name = 'responses_{}_{}_{}_{}.txt'.format(self.config.mode, self.config.n_context, beam_size, self.epoch_i)
         if self.config.mmi:
             target_file_name = target_file_name.replace('.txt', '_mmi.txt')
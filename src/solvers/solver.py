@@ -1,10 +1,55 @@
 import torch
 import torch.nn as nn
 import models
-from utils import TensorboardWriter
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset
+from utils import TensorboardWriter, DevicePrefetcher, ConvStream, CheckpointManager, is_main_process
 import os
 import re
+import random
+import inspect
+import numpy as np
 from collections import OrderedDict
+from contextlib import nullcontext
+from itertools import islice
+
+# a training state holds numpy and python objects besides tensors
+LOAD_KWARGS = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+PRECISION_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def grad_scaler(device, enabled):
+    """GradScaler of device, torch.amp.GradScaler handles CPU too on recent torch versions"""
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+
+def rng_state():
+    """States of the python, numpy and torch random number generators"""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def inference_mode():
+    """torch.inference_mode, which also skips the version counting of no_grad, or no_grad before torch 1.9"""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
 
 
 class Solver(object):
@@ -20,6 +65,17 @@ class Solver(object):
         self.optimizer = None
         self.epoch_loss = None
         self.validation_loss = None
+        self.scheduler = None
+        # only fp16 gradients underflow, bf16 has the exponent range of fp32
+        self.scaler = grad_scaler(config.device, config.precision == 'fp16')
+        self.n_accumulated = 0
+        self.validation_subset = None
+        self.checkpoint_manager = None
+        # optimizer steps done since the start of training
+        self.global_step = 0
+        # training state of the checkpoint being resumed, see resume_training
+        self.resume_state = None
+        self.epoch_rng_state = None
 
     def build(self, cuda=True):
         if self.model is None:
@@ -44,26 +100,257 @@ class Solver(object):
             self.load_model(self.config.checkpoint)
 
         if self.is_train:
-            self.writer = TensorboardWriter(self.config.logdir)
+            self.writer = TensorboardWriter(self.config.logdir, write_to_disk=is_main_process())
             self.optimizer = self.config.optimizer(filter(lambda p: p.requires_grad, self.model.parameters()),
                                                    lr=self.config.learning_rate)
+            self.checkpoint_manager = CheckpointManager(self.config.save_path, keep_best=self.config.keep_checkpoints,
+                                                        background=self.config.async_checkpoint)
+
+    def set_epoch(self, epoch_i):
+        """Start epoch_i: reshuffle the batches of a bucketing sampler and report how much padding they save"""
+        self.epoch_i = epoch_i
+        # the shuffling of the epoch is drawn from it, see skip_trained
+        self.epoch_rng_state = torch.get_rng_state()
+        dataset = getattr(self.train_data_loader, 'dataset', None)
+        if isinstance(dataset, ConvStream) and dataset.epoch != epoch_i:
+            # a position loaded with load_state_dict for epoch_i is kept
+            dataset.set_epoch(epoch_i)
+        sampler = getattr(self.train_data_loader, 'sampler', None)
+        if isinstance(sampler, DistributedSampler):
+            sampler.set_epoch(epoch_i)
+        batch_sampler = getattr(self.train_data_loader, 'batch_sampler', None)
+        if hasattr(batch_sampler, 'set_epoch'):
+            batch_sampler.set_epoch(epoch_i)
+            padding_ratio, unbucketed_padding_ratio = batch_sampler.padding_ratio()
+            print(f'Epoch {epoch_i+1} padding ratio: {padding_ratio:.3f} (without bucketing: {unbucketed_padding_ratio:.3f})')
+            if self.writer is not None:
+                self.writer.add_scalar('Train/padding_ratio', padding_ratio, epoch_i + 1)
+
+    def adamw(self, parameter_groups):
+        """AdamW over parameter_groups, its state sharded across the ranks of distributed training if shard_optimizer"""
+        if self.config.distributed and self.config.shard_optimizer:
+            return ZeroRedundancyOptimizer(parameter_groups, optimizer_class=torch.optim.AdamW,
+                                           lr=self.config.learning_rate)
+        return torch.optim.AdamW(parameter_groups, lr=self.config.learning_rate)
+
+    def parallelize(self):
+        """Move the model to the device for training, wrapped in DistributedDataParallel or DataParallel"""
+        self.model = self.model.to(self.config.device)
+        if self.config.distributed:
+            device_ids = [self.config.device.index] if self.config.device.type == 'cuda' else None
+            self.model = DistributedDataParallel(self.model, device_ids=device_ids)
+        elif self.config.n_gpu > 1:
+            self.model = torch.nn.DataParallel(self.model)
+
+    def batches(self, data_loader):
+        """Batches of data_loader, already copied to the device in the background if prefetch_to_device"""
+        if self.config.prefetch_to_device:
+            return DevicePrefetcher(data_loader, self.config.device)
+        return data_loader
 
-    def save_model(self, epoch):
-        ckpt_path = os.path.join(self.config.save_path, f'{epoch}.pkl')
+    def validation_loader(self):
+        """
+        eval_data_loader, or a fixed random subset of eval_subset of its batches, the same at every validation.
+        A stream is read in a fixed order, so its first eval_subset batches are kept instead.
+        """
+        if self.config.eval_subset <= 0:
+            return self.eval_data_loader
+        if self.validation_subset is None:
+            data_loader = self.eval_data_loader
+            if isinstance(data_loader.dataset, IterableDataset):
+                self.validation_subset = list(islice(data_loader, self.config.eval_subset))
+            else:
+                batches = list(data_loader.batch_sampler)
+                rng = np.random.RandomState(self.config.seed)
+                subset = np.sort(rng.choice(len(batches), min(self.config.eval_subset, len(batches)), replace=False))
+                self.validation_subset = DataLoader(data_loader.dataset, batch_sampler=[batches[i] for i in subset],
+                                                    collate_fn=data_loader.collate_fn,
+                                                    num_workers=data_loader.num_workers,
+                                                    pin_memory=data_loader.pin_memory)
+        return self.validation_subset
+
+    def validate_every(self, step):
+        """Validate on validation_loader after every eval_every optimizer steps, logged at step"""
+        if self.config.eval_every <= 0 or step % self.config.eval_every != 0:
+            return
+        print(f'\n<Validation at step {step}>...')
+        val_losses = self.evaluate(self.validation_loader())
+        val_loss = val_losses[0] if isinstance(val_losses, tuple) else val_losses
+        self.writer.add_scalar('Val/step_loss', val_loss, step)
+        self.model.train()
+
+    def autocast(self):
+        """Context of the forward pass and the loss, in config.precision on config.device"""
+        return torch.autocast(self.config.device.type, dtype=PRECISION_DTYPES[self.config.precision],
+                              enabled=self.config.precision != 'fp32')
+
+    def micro_batches(self, data_loader):
+        """
+        (batch, sync) of the batches of data_loader, sync on the last micro-batch of every grad_accum_steps
+        and on the last batch of the epoch, after which the optimizer steps
+        """
+        batches = iter(self.batches(self.skip_trained(data_loader)))
+        batch = next(batches, None)
+        n_micro = 0
+        for next_batch in batches:
+            n_micro += 1
+            yield batch, n_micro % self.config.grad_accum_steps == 0
+            batch = next_batch
+        if batch is not None:
+            yield batch, True
+
+    def backward(self, loss, sync=True):
+        """
+        Backward pass of the loss of a micro-batch, adding to the gradients of the next step.
+        Unless sync, DistributedDataParallel does not all-reduce the gradients yet.
+        """
+        no_sync = getattr(self.model, 'no_sync', None)
+        with no_sync() if no_sync is not None and not sync else nullcontext():
+            self.scaler.scale(loss).backward()
+        self.n_accumulated += 1
+
+    def step(self):
+        """
+        Optimizer step on the gradients accumulated by backward, averaged over their micro-batches and clipped,
+        then scheduler step if there is one.
+        With fp16 the gradients are unscaled before clipping, and steps with inf/nan gradients are skipped
+        by the scaler, and by the scheduler so that warmup counts real steps only.
+        """
+        self.scaler.unscale_(self.optimizer)
+        if self.n_accumulated > 1:
+            for param in self.model.parameters():
+                if param.grad is not None:
+                    param.grad.div_(self.n_accumulated)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip)
+        scale = self.scaler.get_scale()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        if self.scheduler is not None and self.scaler.get_scale() >= scale:
+            self.scheduler.step()
+        self.optimizer.zero_grad()
+        self.n_accumulated = 0
+        self.global_step += 1
+
+    def decode_groups(self, ids):
+        """
+        Decode a [num_groups, ..., max_len] tensor of token ids with a single batch_decode
+        :return: num_groups lists of strings
+        """
+        rows = ids.reshape(-1, ids.size(-1))
+        decoded = self.vocab.batch_decode(rows.tolist())
+        group_size = rows.size(0) // ids.size(0) if ids.size(0) > 0 else 1
+        return [decoded[i:i + group_size] for i in range(0, len(decoded), group_size)]
+
+    def training_state(self, epoch_i, step_i=None):
+        """
+        Everything needed to resume training: the model, optimizer, scheduler, gradient scaler and RNG states,
+        and the position in the epoch. Under distributed training the state of rank 0 is saved for every rank.
+        :param epoch_i: epoch training resumes at
+        :param step_i: number of optimizer steps done in epoch epoch_i, None to resume at its start
+        :return: the state, None on the other ranks
+        """
+        if isinstance(self.optimizer, ZeroRedundancyOptimizer):
+            # gathered on rank 0, every rank takes part
+            self.optimizer.consolidate_state_dict(to=0)
+        if not is_main_process():
+            return None
+
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        return {
+            'epoch_i': epoch_i,
+            'step_i': step_i or 0,
+            'global_step': self.global_step,
+            'model': model.state_dict(),
+            'optimizer': self.optimizer.state_dict() if self.optimizer is not None else None,
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler': self.scaler.state_dict(),
+            'epoch_rng_state': self.epoch_rng_state,
+            'rng_state': rng_state(),
+        }
+
+    def save_model(self, epoch, step_i=None):
+        """
+        Save the training state to {epoch}.pkl, or {epoch}_{global_step}.pkl in the middle of an epoch,
+        written in the background by checkpoint_manager and resumed at epoch epoch
+        :param epoch: number of epochs done, or the current epoch with step_i
+        :param step_i: number of optimizer steps done in the current epoch, to resume at the next batch
+        """
+        state = self.training_state(epoch, step_i)
+        if state is None:
+            return
+        name = str(epoch) if step_i is None else f'{epoch}_{self.global_step}'
+        ckpt_path = self.checkpoint_manager.save(state, name, metric=self.validation_loss if step_i is None else None)
         print(f'Save parameters to {ckpt_path}')
-        torch.save(self.model.state_dict(), ckpt_path)
+
+    def save_every(self, step_i):
+        """Save the training state after every save_every_steps optimizer steps, see save_model"""
+        if self.config.save_every_steps > 0 and self.global_step % self.config.save_every_steps == 0:
+            self.save_model(self.epoch_i, step_i=step_i)
 
     def load_model(self, checkpoint):
         print(f'Load parameters from {checkpoint}')
-        epoch = re.match(r"[0-9]*", os.path.basename(checkpoint)).group(0)
-        self.epoch_i = int(epoch)
-        chpt = torch.load(checkpoint)
+        chpt = torch.load(checkpoint, map_location='cpu', **LOAD_KWARGS)
+        if 'epoch_i' in chpt and 'model' in chpt:
+            # training state of save_model, the rest is loaded by resume_training
+            self.epoch_i = chpt['epoch_i']
+            self.resume_state = chpt
+            chpt = chpt['model']
+        else:
+            epoch = re.match(r"[0-9]*", os.path.basename(checkpoint)).group(0)
+            self.epoch_i = int(epoch)
         new_state_dict= OrderedDict()
         for k, v in chpt.items():
             name = k[7:] if k.startswith("module.") else k #remove 'module.' of DataParallel
             new_state_dict[name] = v
         self.model.load_state_dict(new_state_dict)
 
+    def resume_training(self):
+        """
+        Load the optimizer, scheduler and gradient scaler states of the checkpoint given to load_model,
+        once train has built them, and its RNG state unless batches of the epoch are skipped first
+        :return: optimizer steps done since the start of training, and in epoch epoch_i
+        """
+        state = self.resume_state
+        if state is None:
+            return 0, 0
+        if state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        if state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+        self.global_step = state['global_step']
+        if state['step_i'] == 0:
+            set_rng_state(state['rng_state'])
+            self.resume_state = None
+        return state['global_step'], state['step_i']
+
+    def skip_trained(self, data_loader):
+        """
+        data_loader without the batches of the resumed epoch trained on before the checkpoint.
+        A ConvStream skips them without building them. Other loaders are iterated from the RNG state of
+        the start of the epoch, which draws the same shuffling, and the skipped batches are thrown away.
+        """
+        state, self.resume_state = self.resume_state, None
+        if state is None:
+            return data_loader
+        n_batches = state['step_i'] * self.config.grad_accum_steps
+        dataset = getattr(data_loader, 'dataset', None)
+        if isinstance(dataset, ConvStream):
+            dataset.set_epoch(self.epoch_i, n_batches)
+            set_rng_state(state['rng_state'])
+            return data_loader
+
+        def remaining_batches():
+            self.epoch_rng_state = state['epoch_rng_state']
+            torch.set_rng_state(self.epoch_rng_state)
+            batches = iter(data_loader)
+            for _ in islice(batches, n_batches):
+                pass
+            set_rng_state(state['rng_state'])
+            yield from batches
+        return remaining_batches()
+
     def write_summary(self, epoch_i):
         epoch_loss = getattr(self, 'epoch_loss', None)
         if epoch_loss is not None:
@@ -92,7 +379,7 @@ class Solver(object):
     def train(self):
         raise NotImplementedError
 
-    def evaluate(self):
+    def evaluate(self, data_loader=None):
         raise NotImplementedError
 
     def test(self):
@@ -2,13 +2,12 @@ import numpy as np
 import torch
 import torch.nn as nn
 from layers import masked_cross_entropy
-from utils import to_var
 import os
 from tqdm import tqdm
-from math import isnan
 import codecs
 import sys
-from .solver import Solver
+from utils import LossMeter
+from .solver import Solver, inference_mode
 
 
 class SolverSpeakAddr(Solver):
@@ -20,70 +19,49 @@ class SolverSpeakAddr(Solver):
         min_validation_loss = sys.float_info.max
         patience_cnt = self.config.patience
 
+        self.resume_training()
         for epoch_i in range(self.epoch_i, self.config.n_epoch):
-            self.epoch_i = epoch_i
-            batch_loss_history = list()
+            self.set_epoch(epoch_i)
+            loss_meter = LossMeter(['loss'], self.config.device)
             self.model.train()
-            n_total_words = 0
-            for batch_i, (conversations, convs_length, utterances_length, users) in \
-                    enumerate(tqdm(self.train_data_loader, ncols=80)):
-                # conversations: [batch_size, max_conv_len, max_utter_len] list of conversation
-                #   A conversation: [max_conv_len, max_utter_len] list of utterances
-                #   An utterance: [max_utter_len] list of tokens
-                # convs_length: [batch_size] list of integer
-                # utterances_length: [batch_size, max_conv_len] list of conversation that has a list of utterance length
-
-                input_conversations = [conv[:-1] for conv in conversations]
-                input_conversations_users = [conv_users[:-1] for conv_users in users]
-                target_conversations = [conv[1:] for conv in conversations]
-                target_conversations_users = [conv_users[1:] for conv_users in users]
-
-                input_utterances = [utter for conv in input_conversations for utter in conv]
-                target_utterances = [utter for conv in target_conversations for utter in conv]
-                input_utterance_length = [l for len_list in utterances_length for l in len_list[:-1]]
-                target_utterance_length = [l for len_list in utterances_length for l in len_list[1:]]
-                input_conversation_length = [conv_len - 1 for conv_len in convs_length]
-                input_users = [one_user for conv_users in input_conversations_users for one_user in conv_users]
-                target_users = [one_user for conv_users in target_conversations_users for one_user in conv_users]
-
-                input_utterances = to_var(torch.LongTensor(input_utterances))
-                target_utterances = to_var(torch.LongTensor(target_utterances))
-                input_utterance_length = to_var(torch.LongTensor(input_utterance_length))
-                target_utterance_length = to_var(torch.LongTensor(target_utterance_length))
-                input_conversation_length = to_var(torch.LongTensor(input_conversation_length))
-                conv_users = to_var(torch.cat((torch.LongTensor(input_users).unsqueeze(1),
-                                               torch.LongTensor(target_users).unsqueeze(1)), dim=1))
+            for batch_i, batch in enumerate(tqdm(self.batches(self.train_data_loader), ncols=80)):
+                # batch: ConversationBatch, flattened and padded by the data loader
+                batch = batch.to(self.config.device)
+                input_utterances = batch.input_utterances
+                target_utterances = batch.target_utterances
+                input_utterance_length = batch.input_utterance_length
+                target_utterance_length = batch.target_utterance_length
+                input_conversation_length = batch.input_conversation_length
+                conv_users = torch.stack((batch.input_users, batch.target_users), dim=1)
 
                 self.optimizer.zero_grad()
 
-                utterances_logits = self.model(input_utterances, conv_users, input_utterance_length,
-                                               input_conversation_length, target_utterances, decode=False)
-
-                batch_loss, n_words = masked_cross_entropy(utterances_logits, target_utterances, target_utterance_length)
-
-                assert not isnan(batch_loss.item())
-                batch_loss_history.append(batch_loss.item())
-                n_total_words += n_words.item()
+                batch_loss, n_words = self.model(input_utterances, conv_users, input_utterance_length,
+                                                 input_conversation_length, target_utterances, decode=False,
+                                                 target_utterance_length=target_utterance_length)
+                loss_meter.add([batch_loss], n_words)
 
                 if batch_i % self.config.print_every == 0:
-                    tqdm.write(f'Epoch: {epoch_i+1}, iter {batch_i}: loss = {batch_loss.item()/ n_words.item():.3f}')
+                    recent_loss, _ = loss_meter.read()
+                    tqdm.write(f'Epoch: {epoch_i+1}, iter {batch_i}: loss = {recent_loss["loss"]:.3f}')
 
                 batch_loss.backward()
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip)
                 self.optimizer.step()
 
-            epoch_loss = np.sum(batch_loss_history) / n_total_words
+            _, epoch_losses = loss_meter.read()
+            epoch_loss = epoch_losses['loss']
             epoch_loss_history.append(epoch_loss)
             self.epoch_loss = epoch_loss
 
             print(f'Epoch {epoch_i+1} loss average: {epoch_loss:.3f}')
 
+            print('\n<Validation>...')
+            self.validation_loss = self.evaluate(self.validation_loader())
+
             if epoch_i % self.config.save_every_epoch == 0:
                 self.save_model(epoch_i + 1)
 
-            print('\n<Validation>...')
-            self.validation_loss = self.evaluate()
-
             if epoch_i % self.config.plot_every_epoch == 0:
                 self.write_summary(epoch_i)
 
@@ -91,55 +69,39 @@ class SolverSpeakAddr(Solver):
                 min_validation_loss = self.validation_loss
             else:
                 patience_cnt -= 1
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
 
             if patience_cnt < 0:
                 print(f'\nEarly stop at {epoch_i}')
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
                 return epoch_loss_history
 
         self.save_model(self.config.n_epoch)
 
         return epoch_loss_history
 
-    def evaluate(self):
+    @inference_mode()
+    def evaluate(self, data_loader=None):
         self.model.eval()
-        batch_loss_history = []
-        n_total_words = 0
-        for batch_i, (conversations, convs_length, utterances_length, users) in \
-                enumerate(tqdm(self.eval_data_loader, ncols=80)):
-            input_conversations = [conv[:-1] for conv in conversations]
-            target_conversations = [conv[1:] for conv in conversations]
-            input_conversations_users = [conv_users[:-1] for conv_users in users]
-            target_conversations_users = [conv_users[1:] for conv_users in users]
-
-            input_utterances = [utter for conv in input_conversations for utter in conv]
-            target_utterances = [utter for conv in target_conversations for utter in conv]
-            input_utterance_length = [l for len_list in utterances_length for l in len_list[:-1]]
-            target_utterance_length = [l for len_list in utterances_length for l in len_list[1:]]
-            input_conversation_length = [conv_len - 1 for conv_len in convs_length]
-            input_users = [one_user for conv_users in input_conversations_users for one_user in conv_users]
-            target_users = [one_user for conv_users in target_conversations_users for one_user in conv_users]
-
-            with torch.no_grad():
-                input_utterances = to_var(torch.LongTensor(input_utterances))
-                target_utterances = to_var(torch.LongTensor(target_utterances))
-                input_utterance_length = to_var(torch.LongTensor(input_utterance_length))
-                target_utterance_length = to_var(torch.LongTensor(target_utterance_length))
-                input_conversation_length = to_var(torch.LongTensor(input_conversation_length))
-                conv_users = to_var(torch.cat((torch.LongTensor(input_users).unsqueeze(1),
-                                               torch.LongTensor(target_users).unsqueeze(1)), dim=1))
-
-            utterances_logits = self.model(input_utterances, conv_users, input_utterance_length,
-                                           input_conversation_length, target_utterances)
-
-            batch_loss, n_words = masked_cross_entropy(utterances_logits, target_utterances, target_utterance_length)
-
-            assert not isnan(batch_loss.item())
-            batch_loss_history.append(batch_loss.item())
-            n_total_words += n_words.item()
-
-        epoch_loss = np.sum(batch_loss_history) / n_total_words
+        if data_loader is None:
+            data_loader = self.eval_data_loader
+        loss_meter = LossMeter(['loss'], self.config.device)
+        for batch_i, batch in enumerate(tqdm(self.batches(data_loader), ncols=80)):
+            batch = batch.to(self.config.device)
+            input_utterances = batch.input_utterances
+            target_utterances = batch.target_utterances
+            input_utterance_length = batch.input_utterance_length
+            target_utterance_length = batch.target_utterance_length
+            input_conversation_length = batch.input_conversation_length
+            conv_users = torch.stack((batch.input_users, batch.target_users), dim=1)
+
+            batch_loss, n_words = self.model(input_utterances, conv_users, input_utterance_length,
+                                             input_conversation_length, target_utterances,
+                                             target_utterance_length=target_utterance_length)
+            loss_meter.add([batch_loss], n_words)
+
+        _, epoch_losses = loss_meter.read()
+        epoch_loss = epoch_losses['loss']
 
         print(f'Validation loss: {epoch_loss:.3f}\n')
 
@@ -147,44 +109,25 @@ class SolverSpeakAddr(Solver):
 
     def test(self):
         self.model.eval()
-        batch_loss_history = []
-        n_total_words = 0
-        for batch_i, (conversations, convs_length, utterances_length, users) in \
-                enumerate(tqdm(self.eval_data_loader, ncols=80)):
-            input_conversations = [conv[:-1] for conv in conversations]
-            target_conversations = [conv[1:] for conv in conversations]
-            input_conversations_users = [conv_users[:-1] for conv_users in users]
-            target_conversations_users = [conv_users[1:] for conv_users in users]
-
-            input_utterances = [utter for conv in input_conversations for utter in conv]
-            target_utterances = [utter for conv in target_conversations for utter in conv]
-            input_utterance_length = [l for len_list in utterances_length for l in len_list[:-1]]
-            target_utterance_length = [l for len_list in utterances_length for l in len_list[1:]]
-            input_conversation_length = [conv_len - 1 for conv_len in convs_length]
-            input_users = [one_user for conv_users in input_conversations_users for one_user in conv_users]
-            target_users = [one_user for conv_users in target_conversations_users for one_user in conv_users]
-
-            with torch.no_grad():
-                input_utterances = to_var(torch.LongTensor(input_utterances))
-                target_utterances = to_var(torch.LongTensor(target_utterances))
-                input_utterance_length = to_var(torch.LongTensor(input_utterance_length))
-                target_utterance_length = to_var(torch.LongTensor(target_utterance_length))
-                input_conversation_length = to_var(torch.LongTensor(input_conversation_length))
-                conv_users = to_var(torch.cat((torch.LongTensor(input_users).unsqueeze(1),
-                                               torch.LongTensor(target_users).unsqueeze(1)), dim=1))
-
-            utterances_logits = self.model(input_utterances, conv_users, input_utterance_length,
-                                         input_conversation_length, target_utterances)
-
-            batch_loss, n_words = masked_cross_entropy(utterances_logits, target_utterances, target_utterance_length)
-
-            assert not isnan(batch_loss.item())
-            batch_loss_history.append(batch_loss.item())
-            n_total_words += n_words.item()
-
-        epoch_loss = np.sum(batch_loss_history) / n_total_words
-
-        print(f'Number of words: {n_total_words}')
+        loss_meter = LossMeter(['loss'], self.config.device)
+        for batch_i, batch in enumerate(tqdm(self.batches(self.eval_data_loader), ncols=80)):
+            batch = batch.to(self.config.device)
+            input_utterances = batch.input_utterances
+            target_utterances = batch.target_utterances
+            input_utterance_length = batch.input_utterance_length
+            target_utterance_length = batch.target_utterance_length
+            input_conversation_length = batch.input_conversation_length
+            conv_users = torch.stack((batch.input_users, batch.target_users), dim=1)
+
+            batch_loss, n_words = self.model(input_utterances, conv_users, input_utterance_length,
+                                             input_conversation_length, target_utterances,
+                                             target_utterance_length=target_utterance_length)
+            loss_meter.add([batch_loss], n_words)
+
+        _, epoch_losses = loss_meter.read()
+        epoch_loss = epoch_losses['loss']
+
+        print(f'Number of words: {loss_meter.counts["loss"]}')
         print(f'Bits per word: {epoch_loss:.3f}')
         word_perplexity = np.exp(epoch_loss)
         print(f'Word perplexity : {word_perplexity:.3f}\n')
@@ -199,27 +142,21 @@ class SolverSpeakAddr(Solver):
         context_history = list()
         sample_history = list()
         ground_truth_history = list()
-        for batch_i, (conversations, convs_length, utterances_length, users) in \
-                enumerate(tqdm(self.eval_data_loader, ncols=80)):
-            n_context_sample_step = n_context + n_sample_step
-            conv_indices = [i for i in range(len(conversations)) if len(conversations[i]) >= n_context_sample_step]
-            context = [c for i in conv_indices for c in [conversations[i][:n_context]]]
-            ground_truth = [c for i in conv_indices for c in [conversations[i][n_context:n_context_sample_step]]]
-            utterances_length = [c for i in conv_indices for c in [utterances_length[i][:n_context]]]
-            conv_users = [list(set(utter_users)) for i in conv_indices for utter_users in [users[i][:n_context_sample_step]]]
-
-            with torch.no_grad():
-                context = to_var(torch.LongTensor(context))
-                utterances_length = to_var(torch.LongTensor(utterances_length))
-                conv_users = to_var(torch.LongTensor(conv_users))
+        for batch_i, batch in enumerate(tqdm(self.batches(self.eval_data_loader), ncols=80)):
+            batch = batch.to(self.config.device)
+            conv_index = batch.conversation_index(n_context + n_sample_step)
+            context = batch.utterances[conv_index[:, :n_context]]
+            ground_truth = batch.utterances[conv_index[:, n_context:]]
+            utterances_length = batch.utterance_length[conv_index[:, :n_context]]
+            conv_users = [list(set(utter_users)) for utter_users in batch.users[conv_index].tolist()]
+            conv_users = torch.LongTensor(conv_users).to(self.config.device)
 
             _, all_samples = self.model.generate(context, conv_users, utterances_length, n_context)
 
-            context = context.data.cpu().numpy().tolist()
-            all_samples = all_samples.data.cpu().numpy().tolist()
-            context_history.append(context)
-            sample_history.append(all_samples)
-            ground_truth_history.append(ground_truth)
+            # decoded all at once, as lists of strings per conversation
+            context_history.append(self.decode_groups(context))
+            sample_history.append(self.decode_groups(all_samples))
+            ground_truth_history.append(self.decode_groups(ground_truth))
 
         target_file_name = 'responses_{}_{}_{}_{}_{}.txt'.format(self.config.mode, n_context, n_sample_step,
                                                                  beam_size, self.epoch_i)
@@ -230,9 +167,9 @@ class SolverSpeakAddr(Solver):
                                                          total=len(context_history), ncols=80):
                 for one_conv_contexts, one_conv_samples, one_conv_ground_truth in zip(contexts, samples, ground_truths):
                     print("Conversation Context {}".format(conv_idx), file=output_f)
-                    print("\n".join([self.vocab.decode(utter) for utter in one_conv_contexts]), file=output_f)
-                    print("\n".join([self.vocab.decode(utter) for utters_beam in one_conv_samples for utter in utters_beam]), file=output_f)
-                    print("\n".join([self.vocab.decode(utter) for utter in one_conv_ground_truth]), file=output_f)
+                    print("\n".join(one_conv_contexts), file=output_f)
+                    print("\n".join(one_conv_samples), file=output_f)
+                    print("\n".join(one_conv_ground_truth), file=output_f)
                     conv_idx += 1
 
         return conv_idx
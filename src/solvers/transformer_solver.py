@@ -2,13 +2,12 @@ import numpy as np
 import torch
 import torch.nn as nn
 from layers import masked_cross_entropy
-from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, EOS_ID, SOS_ID
+from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, num_batches, EOS_ID, SOS_ID, LossMeter
 import os
 from tqdm import tqdm
-from math import isnan
 import codecs
 import sys
-from .solver import Solver
+from .solver import Solver, inference_mode
 import torch.nn.functional as F
 
 class SolverTransformer(Solver):
@@ -22,8 +21,7 @@ class SolverTransformer(Solver):
 
         self.config.n_gpu = torch.cuda.device_count()
 
-        t_total = len(self.train_data_loader) * self.config.n_epoch
-        cur_step = 0
+        t_total = num_batches(self.train_data_loader, self.config.n_epoch, accum_steps=self.config.grad_accum_steps)
 
         no_decay = ['bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
@@ -31,36 +29,35 @@ class SolverTransformer(Solver):
             {'params': [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
 
-        self.optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=self.config.learning_rate)
+        self.optimizer = self.adamw(optimizer_grouped_parameters)
         self.scheduler = get_linear_schedule_with_warmup(
             self.optimizer, num_warmup_steps=self.config.warmup_steps, num_training_steps=t_total
         )
 
-        if self.config.n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model).to(self.config.device)
-        else:
-            self.model = self.model.to(self.config.device)
+        self.parallelize()
+        cur_step, resume_step_i = self.resume_training()
 
         for epoch_i in range(self.epoch_i, self.config.n_epoch):
-            self.epoch_i = epoch_i 
+            self.set_epoch(epoch_i)
             self.model.train()
 
-            epoch_loss = 0.0
+            loss_meter = LossMeter(['loss'], self.config.device)
+            # optimizer steps done in the epoch, some of them before the checkpoint being resumed
+            step_i, resume_step_i = resume_step_i, 0
 
-            for batch_i, (input_utterances,
-                          input_utterances_mask,
-                          target_utterance,
-                          target_utterance_mask) in enumerate(tqdm(self.train_data_loader, ncols=80)):
+            for (input_utterances,
+                 input_utterances_mask,
+                 target_utterance,
+                 target_utterance_mask,
+                 _, _), sync in tqdm(self.micro_batches(self.train_data_loader),
+                                     total=len(self.train_data_loader), ncols=80):
 
                 # the mask should be a BoolTensor if padding True else False
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device) == 0
-                target_utterance = torch.LongTensor(target_utterance).to(self.config.device)
-                target_utterance_mask = torch.LongTensor(target_utterance_mask).to(self.config.device) == 0
+                input_utterances = input_utterances.to(self.config.device)
+                input_utterances_mask = input_utterances_mask.to(self.config.device) == 0
+                target_utterance = target_utterance.to(self.config.device)
+                target_utterance_mask = target_utterance_mask.to(self.config.device) == 0
 
-                self.optimizer.zero_grad()
-                self.model.zero_grad()
-                
                 loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.config.pad_id)
                 target, gt_target = target_utterance[..., :-1].contiguous(), target_utterance[..., 1:].contiguous()
                 target_mask = target_utterance_mask[..., :-1].contiguous()
@@ -74,31 +71,39 @@ class SolverTransformer(Solver):
 
                 batch_loss = loss_fn(outputs.view(-1, outputs.size(-1)), gt_target.view(-1))
 
-                assert not isnan(batch_loss.item())
-
                 if self.config.n_gpu > 1: 
                     batch_loss = batch_loss.mean()
 
-                epoch_loss = (batch_i * epoch_loss + batch_loss.item()) / (batch_i + 1)
+                n_tokens = (gt_target != self.config.pad_id).sum()
+                loss_meter.add([batch_loss * n_tokens], n_tokens)
 
-                if batch_i % self.config.print_every == 0:
-                    tqdm.write(f'Epoch: {epoch_i+1}, iter {batch_i}: loss = {batch_loss.item():.3f}')
-                    self.writer.add_scalar('Train/loss', batch_loss.item(), cur_step)
+                self.backward(batch_loss, sync)
+                if not sync:
+                    continue
+
+                if step_i % self.config.print_every == 0:
+                    # loss per token since the last print
+                    recent_losses, _ = loss_meter.read()
+                    step_loss = recent_losses['loss']
+                    tqdm.write(f'Epoch: {epoch_i+1}, iter {step_i}: loss = {step_loss:.3f}')
+                    self.writer.add_scalar('Train/loss', step_loss, cur_step)
                     self.writer.add_scalar('Train/learning_rate', self.scheduler.get_lr()[0], cur_step)
 
-                batch_loss.backward()
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip)
-                self.optimizer.step()
-                self.scheduler.step()
+                self.step()
+                step_i += 1
                 cur_step += 1
+                self.validate_every(cur_step)
+                self.save_every(step_i)
 
+            _, epoch_losses = loss_meter.read()
+            epoch_loss = epoch_losses['loss']
             epoch_loss_history.append(epoch_loss)
             self.epoch_loss = epoch_loss
 
             print(f'Epoch {epoch_i+1} loss average: {epoch_loss:.3f}')
 
             print('\n<Validation>...')
-            self.validation_loss = self.evaluate()
+            self.validation_loss = self.evaluate(self.validation_loader())
 
             if epoch_i % self.config.plot_every_epoch == 0:
                 self.writer.add_scalar('Val/loss', self.validation_loss, epoch_i + 1)
@@ -107,31 +112,34 @@ class SolverTransformer(Solver):
                 min_validation_loss = self.validation_loss
             else:
                 patience_cnt -= 1
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
 
             if patience_cnt < 0:
                 print(f'\nEarly stop at {epoch_i}')
-                self.save_model(epoch_i)
+                self.save_model(epoch_i + 1)
                 return epoch_loss_history
 
         self.save_model(self.config.n_epoch)
 
         return epoch_loss_history
 
-    def evaluate(self):
+    @inference_mode()
+    def evaluate(self, data_loader=None):
         self.model.eval()
-        epoch_loss = 0.0
+        if data_loader is None:
+            data_loader = self.eval_data_loader
+        loss_meter = LossMeter(['loss'], self.config.device)
 
         for batch_i, (input_utterances,
                       input_utterances_mask,
                       target_utterance,
-                      target_utterance_mask) in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+                      target_utterance_mask,
+                      _, _) in enumerate(tqdm(self.batches(data_loader), ncols=80)):
                 
-            with torch.no_grad():
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device) == 0
-                target_utterance = torch.LongTensor(target_utterance).to(self.config.device)
-                target_utterance_mask = torch.BoolTensor(target_utterance_mask).to(self.config.device) == 0
+            input_utterances = input_utterances.to(self.config.device)
+            input_utterances_mask = input_utterances_mask.to(self.config.device) == 0
+            target_utterance = target_utterance.to(self.config.device)
+            target_utterance_mask = target_utterance_mask.to(self.config.device) == 0
 
 
             loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.config.pad_id)
@@ -150,10 +158,12 @@ class SolverTransformer(Solver):
             if self.config.n_gpu > 1:
                 batch_loss = batch_loss.mean()
 
-            epoch_loss = (batch_i * epoch_loss + batch_loss.item()) / (batch_i + 1)
+            n_tokens = (gt_target != self.config.pad_id).sum()
+            loss_meter.add([batch_loss * n_tokens], n_tokens)
 
-            assert not isnan(batch_loss.item())
-        
+        # summed over every rank, for the same early stopping
+        _, epoch_losses = loss_meter.read()
+        epoch_loss = epoch_losses['loss']
         print(f'Validation loss: {epoch_loss:.3f}\n')
         return epoch_loss
 
@@ -170,49 +180,42 @@ class SolverTransformer(Solver):
         for batch_i, (input_utterances,
                       input_utterances_mask,
                       target_utterance,
-                      _) in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+                      _, _, _) in enumerate(tqdm(self.batches(self.eval_data_loader), ncols=80)):
 
             context_history.append(input_utterances)
             with torch.no_grad():
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device) == 0
+                input_utterances = input_utterances.to(self.config.device)
+                input_utterances_mask = input_utterances_mask.to(self.config.device) == 0
 
             max_seq_len =self.model.config.max_seq_len 
+            vocab = self.config.vocab
 
-            # input_utterances = input_utterances.unsqueeze(-1)
-            dec_input = torch.LongTensor([[self.config.vocab.bos_token_id]]).to(self.config.device)
-
-            # Greedy Decoding 
-            for i in range(max_seq_len):
-                y_pred = self.model(input_utterances, input_utterances_mask, dec_input, None)
-                y_pred_ids = y_pred.max(dim=-1)[1]
-
-                new_word = y_pred_ids.tolist()[0][-1]
-
-                if new_word == self.config.vocab.eos_token_id or i == max_seq_len - 1:
-                    break
-
-                dec_input = torch.cat((dec_input, torch.LongTensor([[new_word]]).to(self.config.device)), dim=-1)
-            
-            labels = y_pred_ids.tolist()[0]
-
-            labels = self.vocab.convert_ids_to_tokens(labels)
-            labels = self.vocab.convert_tokens_to_string(labels)
-            labels = labels.replace("<eos>", "").strip()
-            generated_history.append(labels)
-
-            input_utterances = input_utterances.tolist()[0]
-            input_utterances = self.vocab.convert_ids_to_tokens(input_utterances)
-            input_utterances = self.vocab.convert_tokens_to_string(input_utterances)
-            input_utterances = input_utterances.replace("<pad>", "").strip()
-            input_history.append(input_utterances)
-
-            ground_truth = list(target_utterance)[0]
-            ground_truth = self.vocab.convert_ids_to_tokens(ground_truth)
-            ground_truth = self.vocab.convert_tokens_to_string(ground_truth)
-            ground_truth = ground_truth.replace("<sos>", "").replace("<eos>", "").replace("<pad>", "").strip()
-
-            ground_truth_history.append(ground_truth)
+            # the whole batch is decoded at once, the encoder memory computed once for every step
+            if not self.config.beam_export or beam_size == 1:
+                # Greedy Decoding 
+                labels = self.model.greedy_decode(input_utterances, input_utterances_mask, vocab.bos_token_id,
+                                                  vocab.eos_token_id, vocab.pad_token_id, max_seq_len)
+            else:
+                # Beam Decoding 
+                labels = self.model.beam_decode(input_utterances, input_utterances_mask, vocab.bos_token_id,
+                                                vocab.eos_token_id, vocab.pad_token_id, max_seq_len, beam_size)
+
+            for label, input_utter, ground_truth in zip(labels, input_utterances.tolist(), target_utterance.tolist()):
+                label = self.vocab.convert_ids_to_tokens(label)
+                label = self.vocab.convert_tokens_to_string(label)
+                label = label.replace("<eos>", "").strip()
+                generated_history.append(label)
+
+                input_utter = self.vocab.convert_ids_to_tokens(input_utter)
+                input_utter = self.vocab.convert_tokens_to_string(input_utter)
+                input_utter = input_utter.replace("<pad>", "").strip()
+                input_history.append(input_utter)
+
+                ground_truth = self.vocab.convert_ids_to_tokens(ground_truth)
+                ground_truth = self.vocab.convert_tokens_to_string(ground_truth)
+                ground_truth = ground_truth.replace("<sos>", "").replace("<eos>", "").replace("<pad>", "").strip()
+
+                ground_truth_history.append(ground_truth)
 
         
         target_file_name = 'responses_{}_{}_{}_{}.txt'.format(self.config.mode, n_sample_step,
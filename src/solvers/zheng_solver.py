@@ -2,13 +2,12 @@ import numpy as np
 import torch
 import torch.nn as nn
 from layers import masked_cross_entropy
-from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, EOS_ID, SOS_ID
+from utils import to_var, PAD_ID, get_linear_schedule_with_warmup, num_batches, EOS_ID, SOS_ID, LossMeter
 import os
 from tqdm import tqdm
-from math import isnan
 import codecs
 import sys
-from .solver import Solver
+from .solver import Solver, inference_mode
 import torch.nn.functional as F
 from subprocess import call
 
@@ -23,8 +22,7 @@ class SolverZHENG(Solver):
 
         self.config.n_gpu = torch.cuda.device_count()
 
-        t_total = len(self.train_data_loader) * self.config.n_epoch
-        cur_step = 0
+        t_total = num_batches(self.train_data_loader, self.config.n_epoch, accum_steps=self.config.grad_accum_steps)
 
         no_decay = ['bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
@@ -32,45 +30,41 @@ class SolverZHENG(Solver):
             {'params': [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
 
-        self.optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=self.config.learning_rate)
+        self.optimizer = self.adamw(optimizer_grouped_parameters)
         self.scheduler = get_linear_schedule_with_warmup(
             self.optimizer, num_warmup_steps=self.config.warmup_steps, num_training_steps=t_total
         )
 
-        if self.config.n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model).to(self.config.device)
-        else:
-            self.model = self.model.to(self.config.device)
+        self.parallelize()
+        cur_step, resume_step_i = self.resume_training()
 
         for epoch_i in range(self.epoch_i, self.config.n_epoch):
-            self.epoch_i = epoch_i 
+            self.set_epoch(epoch_i)
             batch_loss_history = list()
             self.model.train()
 
-            epoch_lm_loss = 0.0 
-            epoch_conv_loss = 0.0 
-            epoch_batch_loss = 0.0 
+            loss_meter = LossMeter(['lm_loss', 'conv_loss'], self.config.device)
+            # optimizer steps done in the epoch, some of them before the checkpoint being resumed
+            step_i, resume_step_i = resume_step_i, 0
 
-            for batch_i, (input_utterances,
-                          input_utterances_mask,
-                          target_utterance,
-                          target_utterance_mask,
-                          input_user_ids,
-                          target_user_ids) in enumerate(tqdm(self.train_data_loader, ncols=80)):
-    
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device)
-                target_utterance = torch.LongTensor(target_utterance).to(self.config.device)
-                target_utterance_mask = torch.LongTensor(target_utterance_mask).to(self.config.device)
+            for (input_utterances,
+                 input_utterances_mask,
+                 target_utterance,
+                 target_utterance_mask,
+                 input_user_ids,
+                 target_user_ids), sync in tqdm(self.micro_batches(self.train_data_loader),
+                                                total=len(self.train_data_loader), ncols=80):
 
-                user_available = input_user_ids[0] is not None 
+                input_utterances = input_utterances.to(self.config.device)
+                input_utterances_mask = input_utterances_mask.to(self.config.device)
+                target_utterance = target_utterance.to(self.config.device)
+                target_utterance_mask = target_utterance_mask.to(self.config.device)
 
-                if user_available:
-                    input_user_ids = torch.LongTensor(input_user_ids).to(self.config.device)
-                    target_user_ids = torch.LongTensor(target_user_ids).to(self.config.device)
+                user_available = input_user_ids is not None 
 
-                self.optimizer.zero_grad()
-                self.model.zero_grad()
+                if user_available:
+                    input_user_ids = input_user_ids.to(self.config.device)
+                    target_user_ids = target_user_ids.to(self.config.device)
 
                 loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.config.pad_id)
 
@@ -83,49 +77,55 @@ class SolverZHENG(Solver):
                     input_user_ids = None 
                     target_user_ids = None 
 
-                lm_output, conv_output = self.model(target, target_mask,
-                                                    input_utterances, input_utterances_mask,
-                                                    target_user_ids, input_user_ids)
-                
-                # 1. Calculate Language Model Loss 
-                outputs, labels = lm_output[..., :-1, :].contiguous(), input_utterances[..., 1:].contiguous()
-                lm_loss = loss_fn(outputs.view(-1, outputs.size(-1)), labels.view(-1))
-                
-                # 2. Calculate Conv Loss 
-                conv_loss = loss_fn(conv_output.view(-1, conv_output.size(-1)), gt_target.view(-1))
+                with self.autocast():
+                    lm_output, conv_output = self.model(target, target_mask,
+                                                        input_utterances, input_utterances_mask,
+                                                        target_user_ids, input_user_ids)
 
-                # 3. Total Loss 
-                batch_loss = lm_loss * 0.2 + conv_loss
+                    # 1. Calculate Language Model Loss
+                    outputs, labels = lm_output[..., :-1, :].contiguous(), input_utterances[..., 1:].contiguous()
+                    lm_loss = loss_fn(outputs.view(-1, outputs.size(-1)), labels.view(-1))
 
-                assert not isnan(batch_loss.item())
+                    # 2. Calculate Conv Loss
+                    conv_loss = loss_fn(conv_output.view(-1, conv_output.size(-1)), gt_target.view(-1))
+
+                    # 3. Total Loss
+                    batch_loss = lm_loss * 0.2 + conv_loss
 
                 if self.config.n_gpu > 1: 
                     batch_loss = batch_loss.mean()
 
-                epoch_lm_loss = (batch_i * epoch_lm_loss + lm_loss.item()) / (batch_i + 1)
-                epoch_conv_loss = (batch_i * epoch_conv_loss + conv_loss.item()) / (batch_i + 1)
-                epoch_batch_loss = (batch_i * epoch_batch_loss + batch_loss.item()) / (batch_i + 1)
+                self.add_losses(loss_meter, lm_loss, conv_loss, labels, gt_target)
+
+                self.backward(batch_loss, sync)
+                if not sync:
+                    continue
 
-                if batch_i % self.config.print_every == 0:
-                    tqdm.write(f'Epoch: {epoch_i+1}, iter {batch_i}: loss = {batch_loss.item():.3f}')
-                    self.writer.add_scalar('Train/lm_loss', lm_loss.item(), cur_step)
-                    self.writer.add_scalar('Train/conv_loss', conv_loss.item(), cur_step)
-                    self.writer.add_scalar('Train/loss', batch_loss.item(), cur_step)
+                if step_i % self.config.print_every == 0:
+                    # losses per token since the last print
+                    recent_losses, _ = loss_meter.read()
+                    step_loss = self.total_loss(recent_losses)
+                    tqdm.write(f'Epoch: {epoch_i+1}, iter {step_i}: loss = {step_loss:.3f}')
+                    self.writer.add_scalar('Train/lm_loss', recent_losses['lm_loss'], cur_step)
+                    self.writer.add_scalar('Train/conv_loss', recent_losses['conv_loss'], cur_step)
+                    self.writer.add_scalar('Train/loss', step_loss, cur_step)
                     self.writer.add_scalar('Train/learning_rate', self.scheduler.get_lr()[0], cur_step)
 
-                batch_loss.backward()
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.clip)
-                self.optimizer.step()
-                self.scheduler.step()
+                self.step()
+                step_i += 1
                 cur_step += 1
+                self.validate_every(cur_step)
+                self.save_every(step_i)
 
+            _, epoch_losses = loss_meter.read()
+            epoch_batch_loss = self.total_loss(epoch_losses)
             epoch_loss_history.append(epoch_batch_loss)
             self.epoch_loss = epoch_batch_loss
 
             print(f'Epoch {epoch_i+1} loss average: {epoch_batch_loss:.3f}')
 
             print('\n<Validation>...')
-            val_loss, val_lm_loss, val_conv_loss = self.evaluate()
+            val_loss, val_lm_loss, val_conv_loss = self.evaluate(self.validation_loader())
             self.validation_loss = val_loss
 
             if epoch_i % self.config.plot_every_epoch == 0:
@@ -133,7 +133,7 @@ class SolverZHENG(Solver):
                 self.writer.add_scalar('Val/conv_loss', val_conv_loss, epoch_i + 1)
                 self.writer.add_scalar('Val/loss', val_loss, epoch_i + 1)
 
-            self.save_model(epoch_i)
+            self.save_model(epoch_i + 1)
 
             if min_validation_loss > self.validation_loss:
                 min_validation_loss = self.validation_loss
@@ -148,30 +148,30 @@ class SolverZHENG(Solver):
 
         return epoch_loss_history
 
-    def evaluate(self):
+    @inference_mode()
+    def evaluate(self, data_loader=None):
         self.model.eval()
-        epoch_batch_loss = 0.0
-        epoch_lm_loss = 0.0 
-        epoch_conv_loss = 0.0
+        if data_loader is None:
+            data_loader = self.eval_data_loader
+        loss_meter = LossMeter(['lm_loss', 'conv_loss'], self.config.device)
 
         for batch_i, (input_utterances,
                       input_utterances_mask,
                       target_utterance,
                       target_utterance_mask,
                       input_user_ids,
-                      target_user_ids) in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+                      target_user_ids) in enumerate(tqdm(self.batches(data_loader), ncols=80)):
                 
-            with torch.no_grad():
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device)
-                target_utterance = torch.LongTensor(target_utterance).to(self.config.device)
-                target_utterance_mask = torch.LongTensor(target_utterance_mask).to(self.config.device)
+            input_utterances = input_utterances.to(self.config.device)
+            input_utterances_mask = input_utterances_mask.to(self.config.device)
+            target_utterance = target_utterance.to(self.config.device)
+            target_utterance_mask = target_utterance_mask.to(self.config.device)
 
-                user_available = input_user_ids[0] is not None 
+            user_available = input_user_ids is not None 
 
-                if user_available:
-                    input_user_ids = torch.LongTensor(input_user_ids).to(self.config.device)
-                    target_user_ids = torch.LongTensor(target_user_ids).to(self.config.device)
+            if user_available:
+                input_user_ids = input_user_ids.to(self.config.device)
+                target_user_ids = target_user_ids.to(self.config.device)
 
             loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.config.pad_id)
 
@@ -201,17 +201,26 @@ class SolverZHENG(Solver):
             if self.config.n_gpu > 1:
                 batch_loss = batch_loss.mean()
 
-            assert not isnan(batch_loss.item())
-        
-            epoch_batch_loss = (batch_i * epoch_batch_loss + batch_loss.item()) / (batch_i + 1)
-            epoch_lm_loss = (batch_i * epoch_lm_loss + lm_loss.item()) / (batch_i + 1)
-            epoch_conv_loss = (batch_i * epoch_conv_loss + conv_loss.item()) / (batch_i + 1)
-            
+            self.add_losses(loss_meter, lm_loss, conv_loss, labels, gt_target)
+
+        # summed over every rank, for the same early stopping
+        _, epoch_losses = loss_meter.read()
+        epoch_batch_loss = self.total_loss(epoch_losses)
+        epoch_lm_loss, epoch_conv_loss = epoch_losses['lm_loss'], epoch_losses['conv_loss']
         print(f'Validation loss: {epoch_batch_loss:.3f}\n')
 
         return epoch_batch_loss, epoch_lm_loss, epoch_conv_loss
 
     
+    def add_losses(self, loss_meter, lm_loss, conv_loss, labels, gt_target):
+        """Add the mean losses of a batch to loss_meter as sums over their tokens, pad_id left out"""
+        n_lm_tokens = (labels != self.config.pad_id).sum()
+        n_conv_tokens = (gt_target != self.config.pad_id).sum()
+        loss_meter.add([lm_loss * n_lm_tokens, conv_loss * n_conv_tokens], [n_lm_tokens, n_conv_tokens])
+
+    def total_loss(self, losses):
+        return losses['lm_loss'] * 0.2 + losses['conv_loss']
+
     def export_samples(self, beam_size, file_write=True):
         self.model.eval()
         n_sample_step = self.config.n_sample_step
@@ -226,24 +235,26 @@ class SolverZHENG(Solver):
                       target_utterance,
                       _,
                       input_user_ids,
-                      target_user_ids) in enumerate(tqdm(self.eval_data_loader, ncols=80)):
+                      target_user_ids) in enumerate(tqdm(self.batches(self.eval_data_loader), ncols=80)):
 
             context_history.append(input_utterances)
+            max_seq_len = self.model.config.max_seq_len 
+
             with torch.no_grad():
-                input_utterances = torch.LongTensor(input_utterances).to(self.config.device)
-                input_utterances_mask = torch.LongTensor(input_utterances_mask).to(self.config.device)
+                input_utterances = input_utterances.to(self.config.device)
+                input_utterances_mask = input_utterances_mask.to(self.config.device)
                 
-                user_available = input_user_ids[0] is not None 
+                user_available = input_user_ids is not None 
                 
                 if user_available:
-                    input_user_ids = torch.LongTensor(input_user_ids).to(self.config.device)
-                    target_user_ids = torch.LongTensor(target_user_ids).to(self.config.device)
+                    input_user_ids = input_user_ids.to(self.config.device)
+                    # decoding runs up to max_seq_len steps, later steps see the padding user 0
+                    target_user_ids = F.pad(target_user_ids, (0, max_seq_len - target_user_ids.size(1)))
+                    target_user_ids = target_user_ids.to(self.config.device)
                 else:
                     input_user_ids = None 
                     target_user_ids = None 
 
-            max_seq_len = self.model.config.max_seq_len 
-
             if beam_size == 1:
                 # do Greedy Decoding 
                 enc_hidden = self.model.encode(input_utterances, input_utterances_mask, input_user_ids)
@@ -270,7 +281,7 @@ class SolverZHENG(Solver):
         
                 
             input_utterances = input_utterances.tolist()
-            ground_truthes = list(target_utterance)
+            ground_truthes = target_utterance.tolist()
 
             for label, input_utter, ground_truth in zip(labels, input_utterances, ground_truthes):
                 label = self.vocab.convert_ids_to_tokens(label)
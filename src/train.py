@@ -3,7 +3,8 @@ from config import get_config
 from utils import Vocab
 import os
 import solvers
-from utils import load_pickle, PAD_TOKEN, UNK_TOKEN, EOS_TOKEN, SOS_TOKEN, UNK_TOKEN, SEP_TOKEN, EOS_ID
+from utils import init_distributed, is_main_process
+from utils import load_pickle, load_conversations, count_users, PAD_TOKEN, UNK_TOKEN, EOS_TOKEN, SOS_TOKEN, UNK_TOKEN, SEP_TOKEN, EOS_ID
 import torch 
 import sentencepiece as spm
 from transformers import OpenAIGPTTokenizer, GPT2Tokenizer
@@ -12,8 +13,12 @@ import os
 if __name__ == '__main__':
     config = get_config(mode='train')
     val_config = get_config(mode='valid')
-    with open(os.path.join(config.save_path, 'config.txt'), 'w') as f:
-        print(config, file=f)
+    if config.distributed:
+        init_distributed(config)
+        val_config.device = config.device
+    if is_main_process():
+        with open(os.path.join(config.save_path, 'config.txt'), 'w') as f:
+            print(config, file=f)
 
     if config.data_name == "cornell":
         vocab = Vocab()
@@ -24,48 +29,46 @@ if __name__ == '__main__':
 
         print(f'Vocabulary size: {vocab.vocab_size}')
 
+        train_convs = load_conversations(config, vocab)
+        eval_convs = load_conversations(val_config, vocab)
         if config.users:
-            train_users = load_pickle(config.convs_users_path)
-            config.user_size = max([x for xx in train_users for x in xx]) + 1
+            config.user_size = count_users(train_convs)
             print(f'User size: {config.user_size}')
-            eval_users = load_pickle(val_config.convs_users_path)
-        else:
-            train_users = None
-            eval_users = None
         
             
-        train_data_loader = get_loader(convs=load_pickle(config.convs_path),
-                                    convs_length=load_pickle(config.conversations_length_path),
-                                    utterances_length=load_pickle(config.utterances_length_path),
-                                    vocab=vocab, convs_users=train_users,
+        train_data_loader = get_loader(**train_convs,
+                                    vocab=vocab,
                                     batch_size=config.batch_size,
-                                    is_ptb_model=(config.model=="ZHENG") or (config.model=="Transformer"))
+                                    config=config)
 
-        eval_data_loader = get_loader(convs=load_pickle(val_config.convs_path),
-                                    convs_length=load_pickle(val_config.conversations_length_path),
-                                    utterances_length=load_pickle(val_config.utterances_length_path),
-                                    vocab=vocab, shuffle=False, convs_users=eval_users,
+        eval_data_loader = get_loader(**eval_convs,
+                                    vocab=vocab, shuffle=False,
                                     batch_size=val_config.eval_batch_size,
-                                    is_ptb_model=(val_config.model=="ZHENG") or (val_config.model=="Transformer"))
+                                    config=val_config,
+                                    sort_by_length=True)
     
     elif config.model == "DialoGPT":
         vocab = GPT2Tokenizer.from_pretrained('gpt2')
         config.vocab_size = len(vocab)
         config.vocab = vocab
 
-        train_data_loader = get_loader(convs=load_pickle(config.convs_path),
+        train_data_loader = get_loader(**load_conversations(config, vocab),
                                         vocab=vocab, 
                                         batch_size=config.batch_size,
                                         model=config.model,
                                         dataset=config.data_name,
-                                        config=config)
+                                        config=config,
+                                        convs_path=config.convs_path)
         
-        eval_data_loader = get_loader(convs=load_pickle(val_config.convs_path),
+        eval_data_loader = get_loader(**load_conversations(val_config, vocab),
                                         vocab=vocab,
-                                        batch_size=val_config.batch_size,
+                                        batch_size=val_config.eval_batch_size,
+                                        shuffle=False,
                                         model=val_config.model,
                                         dataset=config.data_name,
-                                        config=config)
+                                        config=config,
+                                        convs_path=val_config.convs_path,
+                                        sort_by_length=True)
 
 
     elif config.data_name == "cornell2" or "ubuntu":
@@ -83,19 +86,21 @@ if __name__ == '__main__':
         config.eos_id = vocab.eos_token_id
         config.sos_id = vocab.bos_token_id 
 
-        train_data_loader = get_loader(convs=load_pickle(config.convs_path),
+        train_data_loader = get_loader(**load_conversations(config, vocab),
                                         vocab=vocab, 
                                         batch_size=config.batch_size,
                                         model=config.model,
                                         dataset=config.data_name,
                                         config=config)
         
-        eval_data_loader = get_loader(convs=load_pickle(val_config.convs_path),
+        eval_data_loader = get_loader(**load_conversations(val_config, vocab),
                                         vocab=vocab,
-                                        batch_size=val_config.batch_size,
+                                        batch_size=val_config.eval_batch_size,
+                                        shuffle=False,
                                         model=val_config.model,
                                         dataset=config.data_name,
-                                        config=config)
+                                        config=config,
+                                        sort_by_length=True)
 
     else: 
         raise ValueError("{} Sorry... We don't support that data".format(config.data_name))
@@ -3,7 +3,13 @@ from .tensorboard import TensorboardWriter
 from .vocab import *
 from .pad import *
 from .load_save import *
+from .conv_store import *
+from .distributed import *
+from .stream import *
+from .token_cache import *
+from .sampler import *
 from .data_loader import *
 from .metric import *
 from .probability import *
 from .get_linear_schedule_with_warmup import *
+from .checkpoint_manager import *
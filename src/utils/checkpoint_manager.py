@@ -0,0 +1,88 @@
+import os
+import threading
+import torch
+
+
+def snapshot(state):
+    """
+    Copy of the tensors of a nested state (dicts, lists, tuples) on the CPU, detached from the tensors
+    that training keeps updating in place
+    """
+    if isinstance(state, torch.Tensor):
+        state = state.detach()
+        return state.clone() if state.device.type == 'cpu' else state.to('cpu')
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointManager(object):
+    def __init__(self, save_path, keep_best=0, background=True):
+        """
+        Checkpoints of the training state in save_path, serialized in a background thread while training goes on.
+        Each one is written to a temporary file renamed over {name}.pkl, so a checkpoint on disk is always complete.
+        :param keep_best: if positive, only the keep_best checkpoints of lowest metric and the latest one are kept
+                          among those saved by this manager, the others are deleted
+        :param background: serialize in a background thread, otherwise in save
+        """
+        self.save_path = str(save_path)
+        self.keep_best = keep_best
+        self.background = background
+        # (path, metric) of the checkpoints saved so far, oldest first
+        self.checkpoints = []
+        self.thread = None
+        self.error = None
+
+    def save(self, state, name, metric=None):
+        """
+        Snapshot state now and write it to {name}.pkl
+        :param metric: lower is better, e.g. the validation loss, None for a checkpoint kept only while latest
+        :return: path of the checkpoint
+        """
+        # one checkpoint in flight at a time, which bounds the memory of the snapshots
+        self.wait()
+        path = os.path.join(self.save_path, f'{name}.pkl')
+        state = snapshot(state)
+        if self.background:
+            # not a daemon thread: the interpreter waits for the last checkpoint before exiting
+            self.thread = threading.Thread(target=self.write, args=(state, path, metric))
+            self.thread.start()
+        else:
+            self.write(state, path, metric)
+            self.raise_error()
+        return path
+
+    def write(self, state, path, metric):
+        try:
+            tmp_path = f'{path}.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+            self.checkpoints = [(p, m) for p, m in self.checkpoints if p != path] + [(path, metric)]
+            self.prune()
+        except Exception as e:
+            self.error = e
+
+    def prune(self):
+        """Delete the checkpoints that are neither among the keep_best best ones nor the latest one"""
+        if self.keep_best <= 0:
+            return
+        scored = sorted((m, i) for i, (p, m) in enumerate(self.checkpoints) if m is not None)
+        keep = {i for m, i in scored[:self.keep_best]} | {len(self.checkpoints) - 1}
+        for i, (path, metric) in enumerate(self.checkpoints):
+            if i not in keep and os.path.exists(path):
+                os.remove(path)
+        self.checkpoints = [checkpoint for i, checkpoint in enumerate(self.checkpoints) if i in keep]
+
+    def wait(self):
+        """Wait until the checkpoint being written is on disk"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
@@ -0,0 +1,208 @@
+import os
+import json
+import shutil
+import numpy as np
+from tqdm import tqdm
+
+
+class ConvStoreColumn(object):
+    def __init__(self, store, getter):
+        """Per-conversation view of a ConvStore that can be indexed like the list it replaces"""
+        self.store = store
+        self.getter = getter
+
+    def __getitem__(self, index):
+        return self.getter(index)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class ConvStore(object):
+    TOKENS = 'tokens.int32'
+    UTTERANCE_OFFSETS = 'utterance_offsets.int64'
+    CONVERSATION_OFFSETS = 'conversation_offsets.int64'
+    SPEAKERS = 'speakers.int32'
+    SPEAKER_LABELS = 'speakers.json'
+    META = 'meta.json'
+
+    def __init__(self, path):
+        """
+        Conversations stored as flat binary arrays and opened with numpy.memmap
+            tokens.int32: token ids of every utterance, back to back
+            utterance_offsets.int64: [num_utterances + 1] start of each utterance in tokens
+            conversation_offsets.int64: [num_conversations + 1] start of each conversation in utterances
+            speakers.int32: [num_utterances] index of the speaker label in speakers.json, -1 if unknown
+        :param path: directory written by ConvStore.build
+        """
+        self.path = str(path)
+        with open(os.path.join(self.path, self.META)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(self.path, self.SPEAKER_LABELS)) as f:
+            self.speaker_labels = json.load(f)
+        self.len = self.meta['num_conversations']
+        self.pad_length = self.meta.get('pad_length')
+        self._arrays = None
+
+    def __getstate__(self):
+        # DataLoader workers reopen the files instead of receiving a copy of the arrays
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _memmap(self, name, dtype, length):
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(length,))
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = (
+                self._memmap(self.TOKENS, np.int32, self.meta['num_tokens']),
+                self._memmap(self.UTTERANCE_OFFSETS, np.int64, self.meta['num_utterances'] + 1),
+                self._memmap(self.CONVERSATION_OFFSETS, np.int64, self.meta['num_conversations'] + 1),
+                self._memmap(self.SPEAKERS, np.int32, self.meta['num_utterances']),
+            )
+        return self._arrays
+
+    @property
+    def tokens(self):
+        return self.arrays[0]
+
+    @property
+    def speaker_ids(self):
+        """[num_utterances] index of the speaker label of every utterance, -1 if unknown"""
+        return self.arrays[3]
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, index):
+        """
+        :return: speakers (list of speaker labels, None if unknown), utterances (list of token id lists)
+        """
+        return self.speakers(index), self.utterances(index)
+
+    def _utterance_offsets(self, index):
+        _, utterance_offsets, conversation_offsets, _ = self.arrays
+        return utterance_offsets[conversation_offsets[index]:conversation_offsets[index + 1] + 1]
+
+    def utterances(self, index):
+        tokens = self.tokens
+        offsets = self._utterance_offsets(index).tolist()
+        return [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
+    def padded_utterances(self, index, pad_id):
+        return [utter + [pad_id] * (self.pad_length - len(utter)) for utter in self.utterances(index)]
+
+    def speakers(self, index):
+        _, _, conversation_offsets, speakers = self.arrays
+        speakers = speakers[conversation_offsets[index]:conversation_offsets[index + 1]].tolist()
+        return [self.speaker_labels[s] if s >= 0 else None for s in speakers]
+
+    def utterance_length(self, index):
+        return np.diff(self._utterance_offsets(index)).tolist()
+
+    def conversation_length(self, index):
+        _, _, conversation_offsets, _ = self.arrays
+        return int(conversation_offsets[index + 1] - conversation_offsets[index])
+
+    def lengths(self, max_utterance_length=None):
+        """
+        Number of tokens of every conversation
+        :param max_utterance_length: count at most this many tokens per utterance
+        """
+        _, utterance_offsets, conversation_offsets, _ = self.arrays
+        if max_utterance_length is None:
+            return np.diff(utterance_offsets[conversation_offsets])
+        utterance_lengths = np.minimum(np.diff(utterance_offsets), max_utterance_length)
+        cumsum = np.concatenate([[0], np.cumsum(utterance_lengths)])
+        return np.diff(cumsum[conversation_offsets])
+
+    def utterance_table(self):
+        """
+        Every utterance of the store, read from the offsets only
+        :return: [num_utterances] number of tokens, conversation index and position in its conversation
+        """
+        _, utterance_offsets, conversation_offsets, _ = self.arrays
+        conversation = np.repeat(np.arange(self.len), np.diff(conversation_offsets))
+        position = np.arange(len(conversation)) - conversation_offsets[conversation]
+        return np.diff(utterance_offsets), conversation, position
+
+    @property
+    def conversations_length(self):
+        return ConvStoreColumn(self, self.conversation_length)
+
+    @property
+    def utterances_length(self):
+        return ConvStoreColumn(self, self.utterance_length)
+
+    @property
+    def users(self):
+        return ConvStoreColumn(self, self.speakers)
+
+    @classmethod
+    def build(cls, path, conversations, meta, total=None):
+        """
+        Stream conversations to disk and move the finished store to `path` atomically
+        :param path: target directory
+        :param conversations: iterable of conversations, each a list of (speaker, token ids). speaker may be None
+        :param meta: json-serializable description of what the store was built with
+        :param total: number of conversations, only used for the progress bar
+        """
+        path = str(path)
+        tmp_path = path + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+
+        num_tokens = 0
+        num_utterances = 0
+        num_conversations = 0
+        pad_length = 0
+        speaker_index = {}
+        speaker_labels = []
+
+        with open(os.path.join(tmp_path, cls.TOKENS), 'wb') as tokens_f, \
+                open(os.path.join(tmp_path, cls.UTTERANCE_OFFSETS), 'wb') as utterance_offsets_f, \
+                open(os.path.join(tmp_path, cls.CONVERSATION_OFFSETS), 'wb') as conversation_offsets_f, \
+                open(os.path.join(tmp_path, cls.SPEAKERS), 'wb') as speakers_f:
+            utterance_offsets_f.write(np.int64(0).tobytes())
+            conversation_offsets_f.write(np.int64(0).tobytes())
+
+            for conv in tqdm(conversations, total=total, ncols=80, desc='Storing'):
+                utterance_offsets = []
+                speakers = []
+                for speaker, token_ids in conv:
+                    if speaker is None:
+                        speakers.append(-1)
+                    else:
+                        if speaker not in speaker_index:
+                            speaker_index[speaker] = len(speaker_labels)
+                            speaker_labels.append(speaker)
+                        speakers.append(speaker_index[speaker])
+                    tokens_f.write(np.asarray(token_ids, dtype=np.int32).tobytes())
+                    num_tokens += len(token_ids)
+                    pad_length = max(pad_length, len(token_ids))
+                    utterance_offsets.append(num_tokens)
+
+                utterance_offsets_f.write(np.asarray(utterance_offsets, dtype=np.int64).tobytes())
+                speakers_f.write(np.asarray(speakers, dtype=np.int32).tobytes())
+                num_utterances += len(conv)
+                num_conversations += 1
+                conversation_offsets_f.write(np.int64(num_utterances).tobytes())
+
+        meta = dict(meta)
+        meta.setdefault('pad_length', pad_length)
+        meta.update(num_tokens=num_tokens, num_utterances=num_utterances, num_conversations=num_conversations)
+        with open(os.path.join(tmp_path, cls.SPEAKER_LABELS), 'w') as f:
+            json.dump(speaker_labels, f)
+        with open(os.path.join(tmp_path, cls.META), 'w') as f:
+            json.dump(meta, f, sort_keys=True)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same store first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return cls(path)
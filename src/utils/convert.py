@@ -11,3 +11,62 @@ def to_tensor(x):
     if torch.cuda.is_available():
         x = x.cpu()
     return x.data
+
+
+def tensors(batch):
+    """Every tensor of a tensor or a (nested) tuple/list of tensors"""
+    if torch.is_tensor(batch):
+        yield batch
+    elif isinstance(batch, (list, tuple)):
+        for elem in batch:
+            yield from tensors(elem)
+
+
+def to_device(batch, device, non_blocking=False):
+    """Move a tensor or a (nested) tuple/list of tensors to device, anything else (e.g. None) is kept"""
+    if hasattr(batch, 'to'):
+        # tensors and ConversationBatch
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(elem, device, non_blocking) for elem in batch)
+    return batch
+
+
+class DevicePrefetcher(object):
+    def __init__(self, data_loader, device):
+        """
+        Iterate over data_loader with every batch already on device.
+        On a GPU the next batch is copied on a side stream while the current step runs,
+        which overlaps the copy with compute when the loader uses pin_memory.
+        """
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.data_loader:
+                yield to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.data_loader)
+        next_batch = self.preload(batches, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            for tensor in tensors(batch):
+                # the memory was allocated on the side stream but is used on the current one
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(batches, stream)
+            yield batch
+
+    def preload(self, batches, stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return to_device(batch, self.device, non_blocking=True)
@@ -1,15 +1,59 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 import pickle
 import logging
 import sentencepiece as spm
 from torch.nn.utils.rnn import pad_sequence
 import torch 
+import numpy as np
+from collections import namedtuple
+from functools import partial
+from .token_cache import tokenizer_fingerprint, load_token_cache
+from .conv_store import ConvStore
+from .vocab import PAD_ID
+from .sampler import BucketBatchSampler, TokenBudgetBatchSampler
+from .stream import ConvStream, StreamLoader
+from .distributed import distributed_rank
+
+
+def split_conversation(convs, index):
+    """
+    :param convs: A list of conversation that is represented as a list of utterances or (speaker, utterance), or a ConvStore
+    :return: speakers (None if unknown), utterances (str, or token ids when read from a ConvStore)
+    """
+    if isinstance(convs, ConvStore):
+        return convs[index]
+    conv = convs[index]
+    speakers = [elem[0] if isinstance(elem, (list, tuple)) else None for elem in conv]
+    utterances = [elem[1] if isinstance(elem, (list, tuple)) else elem for elem in conv]
+    return speakers, utterances
+
+
+def conversation_lengths(convs, max_utterance_length=None, tokenize=None):
+    """
+    Number of tokens of each conversation, used to batch conversations of similar length.
+    Exact for a ConvStore or with tokenize, approximated by whitespace-separated words otherwise.
+    :param max_utterance_length: count at most this many tokens per utterance
+    :param tokenize: function(utterance) -> tokens of the model, e.g. the tokenize of a GPT-2 tokenizer
+    """
+    if isinstance(convs, ConvStore):
+        return convs.lengths(max_utterance_length)
+    if tokenize is None:
+        tokenize = str.split
+    lengths = []
+    for conv in convs:
+        utterances = [elem[1] if isinstance(elem, (list, tuple)) else elem for elem in conv]
+        utterance_lengths = [len(tokenize(utter)) for utter in utterances]
+        if max_utterance_length is not None:
+            utterance_lengths = [min(length, max_utterance_length) for length in utterance_lengths]
+        lengths.append(sum(utterance_lengths))
+    return np.asarray(lengths)
+
 
 class ConvDataset(Dataset):
     def __init__(self, convs, convs_length, utterances_length, vocab):
         """
         Dataset class for conversation
-        :param convs: A list of conversation that is represented as a list of utterances
+        :param convs: A list of conversation that is represented as a list of utterances, or a ConvStore
         :param convs_length: A list of integer that indicates the number of utterances in each conversation
         :param utterances_length: A list of list whose element indicates the number of tokens in each utterance
         :param vocab: vocab class
@@ -19,6 +63,9 @@ class ConvDataset(Dataset):
         self.convs_length = convs_length
         self.utterances_length = utterances_length
         self.len = len(convs)   # total number of conversations
+        if isinstance(convs, ConvStore):
+            self.convs_length = convs.conversations_length if convs_length is None else convs_length
+            self.utterances_length = convs.utterances_length if utterances_length is None else utterances_length
 
     def __getitem__(self, index):
         """
@@ -26,10 +73,9 @@ class ConvDataset(Dataset):
         :param index: index of the conversation
         :return: utterances, conversation_length, utterance_length
         """
-        utterances = self.convs[index]
+        utterances = self.get_utterances(index)
         conversation_length = self.convs_length[index]
         utterance_length = self.utterances_length[index]
-        utterances = self.sent2id(utterances)
 
         return utterances, conversation_length, utterance_length
 
@@ -37,7 +83,21 @@ class ConvDataset(Dataset):
         return self.len
 
     def sent2id(self, utterances):
-        return [self.vocab.sent2id(utter) for utter in utterances]
+        return self.vocab.sents2id(utterances)
+
+    def lengths(self):
+        if isinstance(self.convs, ConvStore):
+            return self.convs.lengths()
+        return np.asarray([sum(utterance_length) for utterance_length in self.utterances_length])
+
+    def get_utterances(self, index):
+        if isinstance(self.convs, ConvStore):
+            # already converted to ids by the store
+            return self.convs.padded_utterances(index, PAD_ID)
+        return self.sent2id(self.convs[index])
+
+    def collate(self, data):
+        return collate_conversations(data, PAD_ID)
 
 class Cornell2HREDDataset(Dataset):
     def __init__(self, convs, vocab, config):
@@ -45,38 +105,38 @@ class Cornell2HREDDataset(Dataset):
         self.convs = convs 
         self.len = len(convs)
         self.max_seq_len = config.max_seq_len
+        self.truncation_side = config.truncation_side
 
     def __getitem__(self, index):
-        conv = self.convs[index]
-        if isinstance(conv[0], list):
-            conv = [info[1] for info in conv]
-        conv = [ self.vocab.encode(utter, max_length=self.max_seq_len) + [self.vocab.eos_token_id] \
+        _, conv = split_conversation(self.convs, index)
+        conv = [ encode(self.vocab, utter, self.max_seq_len) + [self.vocab.eos_token_id] \
                 for utter in conv]
 
         if len(conv) > 10:
             conv = conv[:10]
 
         conversation_length = len(conv)
-        utterance_length = [len(utter) if len(utter) < self.max_seq_len else self.max_seq_len for utter in conv] 
-        conversation = [self._set_padding(utter) for utter in conv]
+        conversation = [truncate(utter, self.max_seq_len, self.truncation_side) for utter in conv]
+        utterance_length = [len(utter) for utter in conversation]
 
         return conversation, conversation_length, utterance_length
     
     def __len__(self):
         return self.len
 
-    def _set_padding(self, text):
-        if len(text) <= self.max_seq_len:
-            return text + [self.vocab.pad_token_id for _ in range(self.max_seq_len - len(text))]
-        else:
-            return text[len(text) - self.max_seq_len:]
+    def lengths(self):
+        return conversation_lengths(self.convs, self.max_seq_len, tokenize=self.vocab.tokenize)
+
+    def collate(self, data):
+        """Pad the utterances of a batch to its longest utterance instead of max_seq_len"""
+        return collate_conversations(data, self.vocab.pad_token_id)
     
 class ConvUserDataset(ConvDataset):
     def __init__(self, convs, convs_users, convs_length, utterances_length, vocab):
         """
         Dataset class for conversation
-        :param convs: A list of conversation that is represented as a list of utterances
-        :param convs_users: A list of list whose element indicates the user index of each utterance
+        :param convs: A list of conversation that is represented as a list of utterances, or a ConvStore
+        :param convs_users: A list of list whose element indicates the user index of each utterance, or ConvStore.users
         :param convs_length: A list of integer that indicates the number of utterances in each conversation
         :param utterances_length: A list of list whose element indicates the number of tokens in each utterance
         :param vocab: vocab class
@@ -86,6 +146,9 @@ class ConvUserDataset(ConvDataset):
         self.convs_length = convs_length
         self.utterances_length = utterances_length
         self.len = len(convs)   # total number of conversations
+        if isinstance(convs, ConvStore):
+            self.convs_length = convs.conversations_length if convs_length is None else convs_length
+            self.utterances_length = convs.utterances_length if utterances_length is None else utterances_length
         self.convs_users = convs_users
 
     def __getitem__(self, index):
@@ -94,13 +157,11 @@ class ConvUserDataset(ConvDataset):
         :param index: index of the conversation
         :return: utterances, conversation_length, utterance_length
         """
-        utterances = self.convs[index]
+        utterances = self.get_utterances(index)
         conversation_length = self.convs_length[index]
         utterance_length = self.utterances_length[index]
         conversation_users = self.convs_users[index]
 
-        utterances = self.sent2id(utterances)
-
         return utterances, conversation_length, utterance_length, conversation_users
 
 class TransformerBasedConvDataset(Dataset):
@@ -111,68 +172,105 @@ class TransformerBasedConvDataset(Dataset):
         self.max_seq_len = config.max_seq_len
         self.users = config.users 
         self.n_context = config.n_context
+        self.truncation_side = config.truncation_side
     
     def __getitem__(self, index):
 
-        conv = self.convs[index]
+        speakers, conv = split_conversation(self.convs, index)
 
         if self.n_context != 0: 
+            speakers = speakers[:self.n_context+1]
             conv = conv[:self.n_context+1]
 
         inputs = []
         input_users = []
 
-        for i, elem in enumerate(conv):
-            if isinstance(elem, list) or isinstance(elem, tuple):
-                user_num = int(elem[0].replace('u', '').strip()) + 1 if isinstance(elem[0], str) else elem[0] + 1
-                utter = elem[1]
+        for i, (speaker, utter) in enumerate(zip(speakers, conv)):
+            if speaker is not None:
+                user_num = int(speaker.replace('u', '').strip()) + 1 if isinstance(speaker, str) else speaker + 1
             else:
                 user_num = None 
-                utter = elem 
 
             if i < len(conv) - 1: 
                 eos_tokens = [self.vocab.eos_token_id] if i == len(conv) - 2 else [self.vocab.eos_token_id, self.vocab.sep_token_id]
-                encoded = self.vocab.encode(utter.strip(), max_length=self.max_seq_len) + eos_tokens
+                encoded = encode(self.vocab, utter.strip() if isinstance(utter, str) else utter, self.max_seq_len) + eos_tokens
                 inputs += encoded
                 if user_num:
                     input_users += [user_num] * len(encoded)
             else: 
-                target = [self.vocab.bos_token_id] + self.vocab.encode(utter, max_length=self.max_seq_len-2) + [self.vocab.eos_token_id]
+                target = [self.vocab.bos_token_id] + encode(self.vocab, utter, self.max_seq_len-2) + [self.vocab.eos_token_id]
                 target_users = [user_num] * len(target) if user_num else None 
 
-        input_utter, input_mask = self._setting(inputs)
-        target_utter, target_mask = self._setting(target)
+        inputs = truncate(inputs, self.max_seq_len, self.truncation_side)
+        target = truncate(target, self.max_seq_len, self.truncation_side)
 
         if input_users and target_users and self.users:
-            input_users = self._setting(input_users, pad_index=0, return_mask=False)
-            target_users = self._setting(target_users, 0, False)
-            assert len(input_users) == len(target_users) == self.max_seq_len
+            input_users = truncate(input_users, self.max_seq_len, self.truncation_side)
+            target_users = truncate(target_users, self.max_seq_len, self.truncation_side)
+            assert len(input_users) == len(inputs) and len(target_users) == len(target)
         else:
             input_users = None 
             target_users = None
 
-        assert len(input_utter) == len(input_mask) == len(target_utter) == len(target_mask) == self.max_seq_len
-
-        return input_utter, input_mask, target_utter, target_mask, input_users, target_users
+        return inputs, target, input_users, target_users
 
     def __len__(self):
         return self.len 
+
+    def lengths(self):
+        """[num_examples, 2] number of tokens of the input and of the target of every example, padded separately"""
+        if isinstance(self.convs, ConvStore):
+            return self.store_lengths()
+        lengths = []
+        for index in range(self.len):
+            inputs, target, _, _ = self[index]
+            lengths.append((len(inputs), len(target)))
+        return np.asarray(lengths).reshape(self.len, 2)
+
+    def store_lengths(self):
+        """Same lengths as __getitem__ computed from the utterance offsets of a ConvStore, no example is built"""
+        utterance_lengths, conversation, position = self.convs.utterance_table()
+        # utterances of each conversation that __getitem__ reads
+        num_utterances = np.bincount(conversation, minlength=self.len)
+        if self.n_context != 0:
+            num_utterances = np.minimum(num_utterances, self.n_context + 1)
+        last = num_utterances[conversation] - 1
+
+        # eos after every input utterance, sep after all but the last one
+        is_input = position < last
+        inputs = np.bincount(conversation, weights=np.minimum(utterance_lengths, self.max_seq_len) * is_input,
+                             minlength=self.len)
+        inputs += np.maximum(2 * num_utterances - 3, 0)
+        # bos + target + eos
+        is_target = position == last
+        target = np.zeros(self.len)
+        target[conversation[is_target]] = np.minimum(utterance_lengths[is_target], self.max_seq_len - 2) + 2
+
+        lengths = np.stack([np.minimum(inputs, self.max_seq_len), np.minimum(target, self.max_seq_len)], axis=1)
+        return lengths.astype(np.int64)
     
-    def _setting(self, text, pad_index=None, return_mask=True):
-        if pad_index is None:
-            pad_index = self.vocab.pad_token_id
-            
-        if len(text) <= self.max_seq_len:
-            text = text + [pad_index for _ in range(self.max_seq_len - len(text))]
+    def collate(self, data):
+        """
+        Pad every sequence of a batch to the longest one of its kind
+        :return: input_utter, input_mask, target_utter, target_mask, input_users, target_users as LongTensors
+                 (the users are None if the conversations have none)
+        """
+        # longest input first, the order the padded masks used to be sorted in
+        data.sort(key=lambda x: len(x[0]), reverse=True)
+        inputs, targets, input_users, target_users = zip(*data)
+        input_utter = pad_batch(inputs, self.vocab.pad_token_id)
+        target_utter = pad_batch(targets, self.vocab.pad_token_id)
+        input_mask = (input_utter != self.vocab.pad_token_id).long()
+        target_mask = (target_utter != self.vocab.pad_token_id).long()
+
+        if input_users[0] is not None:
+            input_users = pad_batch(input_users, 0)
+            target_users = pad_batch(target_users, 0)
         else:
-            text = text[len(text) - self.max_seq_len:]
-            assert len(text) == self.max_seq_len
+            input_users = None
+            target_users = None
 
-        if return_mask:
-            text_mask = [ 0 if tok == self.vocab.pad_token_id else 1 for tok in text ]
-            return text, text_mask
-        
-        return text 
+        return input_utter, input_mask, target_utter, target_mask, input_users, target_users
 
 class DialoGPTFeature(object):
     def __init__(self, input_ids, position_ids, token_type_ids, lm_labels, user_ids, user_mask):
@@ -185,6 +283,13 @@ class DialoGPTFeature(object):
 
 class DialoGPTDataset(Dataset):
     def __init__(self, convs, vocab, config):
+        """
+        Dataset class for DialoGPT
+        :param convs: A list of conversation that is represented as a list of (speaker, utterance),
+                      or a ConvStore (e.g. a token cache) whose utterances are not tokenized again
+        :param vocab: GPT2Tokenizer
+        :param config: config
+        """
         self.vocab = vocab 
         self.convs = convs 
         self.len = len(convs)
@@ -193,6 +298,52 @@ class DialoGPTDataset(Dataset):
     
     def __len__(self):
         return self.len 
+
+    def lengths(self):
+        """Number of tokens of every feature, speaker and eos tokens included, which its batch is padded to"""
+        if isinstance(self.convs, ConvStore):
+            return self.store_lengths()
+        return np.asarray([len(self[index].input_ids) for index in range(self.len)])
+
+    def store_lengths(self):
+        """
+        Same lengths as build_feature computed from the utterance offsets of a ConvStore (e.g. a token cache),
+        no feature is built. register_speakers must have been called first.
+        """
+        utterance_lengths, conversation, position = self.convs.utterance_table()
+        speaker_ids = np.asarray(self.convs.speaker_ids)
+        num_utterances = np.bincount(conversation, minlength=self.len)
+        conversation_start = np.concatenate([[0], np.cumsum(num_utterances)[:-1]])
+
+        # truncate_utterance
+        conv_length = num_utterances[conversation]
+        utterance_lengths = np.where(speaker_ids >= 0,
+                                     np.minimum(utterance_lengths, np.maximum(self.max_seq_len - 10 - conv_length, 0)),
+                                     utterance_lengths)
+
+        # build_feature keeps the utterances whose running length fits in the budget
+        budget = self.max_seq_len - num_utterances - 2
+        counted = utterance_lengths + 1 if self.config.users else utterance_lengths
+        running = np.cumsum(counted)
+        running -= (running - counted)[conversation_start[conversation]]
+        kept = running <= budget[conversation]
+        num_kept = np.bincount(conversation, weights=kept, minlength=self.len).astype(np.int64)
+        num_tokens = np.bincount(conversation, weights=utterance_lengths * kept, minlength=self.len)
+
+        # and cuts the second utterance to the budget when only the first one fits
+        cut = np.flatnonzero((num_kept == 1) & (num_utterances >= 2))
+        first = conversation_start[cut]
+        num_tokens[cut] += np.minimum(utterance_lengths[first + 1], budget[cut] - utterance_lengths[first])
+        num_kept[cut] = 2
+
+        # one eos between utterances
+        lengths = num_tokens + num_kept - 1
+        if self.config.users and not self.config.reversed:
+            # speaker tokens of the kept utterances
+            speaker_lengths = np.asarray([len(self.vocab.encode(label)) for label in self.convs.speaker_labels])
+            kept = position < num_kept[conversation]
+            lengths += np.bincount(conversation, weights=speaker_lengths[speaker_ids] * kept, minlength=self.len)
+        return lengths.astype(np.int64)
     
     def __getitem__(self, index):
         # conversation = user1 : [hi] / user2 : [how] [are] [u?] / user3: [fine] [thank] [you.]
@@ -206,9 +357,61 @@ class DialoGPTDataset(Dataset):
         # token_type_ids = [0]     [0]  [0]     [1]   [1]   [1]   [1]   [1]     [2]   [2]    [2]     [2]
         # lm_labels      = [-1]    [-1] [-1]    [how] [are] [u?]  [eos] [-1]    [fine][thank][you]   [eos]
 
+        if isinstance(self.convs, ConvStore):
+            speakers, utterances = self.convs[index]
+            utterances = [self.truncate_utterance(utter, speaker, len(speakers))
+                          for speaker, utter in zip(speakers, utterances)]
+        else:
+            conv = self.convs[index]
+            speakers = [elem[0] if isinstance(elem, list) or isinstance(elem, tuple) else None for elem in conv]
+            # encoded lazily, utterances beyond max_seq_len are never tokenized
+            utterances = (self.encode_utterance(elem, len(conv)) for elem in conv)
+
+        return self.build_feature(speakers, utterances)
+
+    def encode_utterance(self, elem, conv_length):
+        if isinstance(elem, list) or isinstance(elem, tuple):
+            return self.vocab.encode(elem[1], max_length=(self.max_seq_len-10-conv_length))
+        return self.vocab.encode(elem)
+
+    def truncate_utterance(self, token_ids, speaker, conv_length):
+        """Same truncation as encode_utterance for utterances that are already tokenized"""
+        if speaker is not None:
+            return token_ids[:max(self.max_seq_len-10-conv_length, 0)]
+        return token_ids
+
+    def register_speakers(self):
+        """
+        Add the speaker tokens of every conversation to the tokenizer once, in the main process.
+        build_feature only encodes them, so that the dataset can be read by DataLoader workers
+        that each hold their own copy of the tokenizer.
+        """
+        if not self.config.users or self.config.reversed:
+            return
+        if isinstance(self.convs, ConvStore):
+            speakers = self.convs.speaker_labels
+        else:
+            speakers = dict.fromkeys(elem[0] for conv in self.convs for elem in conv
+                                     if isinstance(elem, list) or isinstance(elem, tuple))
+        self.vocab.add_tokens(list(speakers))
+
+    def cache_meta(self):
+        """Everything that changes the result of encode_utterance"""
+        return {
+            'tokenizer': tokenizer_fingerprint(self.vocab),
+            'max_seq_len': self.max_seq_len,
+            'users': bool(self.config.users),
+            'reversed': bool(self.config.reversed),
+            'export_test': bool(self.config.export_test),
+        }
+
+    def build_feature(self, speakers, utterances):
+        """
+        :param speakers: speaker of each utterance of the conversation
+        :param utterances: token ids of each utterance of the conversation
+        """
         eos_id = self.vocab.encoder['<|endoftext|>']
 
-        conv = self.convs[index]
         max_seq_len = self.max_seq_len
 
         token_type_ids = []
@@ -217,17 +420,15 @@ class DialoGPTDataset(Dataset):
         # processed for max sequence length
         len_ = 0
         conv_ids = []
-        assert len(conv) >= 2
-        for elem in conv:
-            utter_id = self.vocab.encode(elem[1], max_length=(self.max_seq_len-10-len(conv))) if isinstance(elem, list) \
-                                                                                    or isinstance(elem, tuple) else self.vocab.encode(elem)
+        assert len(speakers) >= 2
+        for utter_id in utterances:
             if self.config.users:
                 len_ += len(utter_id) + 1
             else:
                 len_ += len(utter_id)
-            if len_ > self.max_seq_len - len(conv) - 2:
+            if len_ > self.max_seq_len - len(speakers) - 2:
                 if len(conv_ids) == 1:
-                    utter_id = utter_id[:self.max_seq_len - len(conv) - 2 - len(conv_ids[0])]
+                    utter_id = utter_id[:self.max_seq_len - len(speakers) - 2 - len(conv_ids[0])]
                     conv_ids.append(utter_id)
                 break
             conv_ids.append(utter_id) 
@@ -236,7 +437,7 @@ class DialoGPTDataset(Dataset):
 
         if self.config.reversed:
             conv_ids = list(reversed(conv_ids))
-            conv = list(reversed(conv))
+            speakers = list(reversed(speakers))
 
         input_ids = [i for s in conv_ids for i in s+[eos_id]][:-1]
 
@@ -248,10 +449,8 @@ class DialoGPTDataset(Dataset):
         for i, conv_id in enumerate(conv_ids): 
             if self.config.users and not self.config.reversed:
                 if i == 0:
-                    user_id_1 = conv[i][0]
-                    user_id_2 = conv[i+1][0]
-                    self.vocab.add_tokens([user_id_1])
-                    self.vocab.add_tokens([user_id_2])
+                    user_id_1 = speakers[i]
+                    user_id_2 = speakers[i+1]
                     input_ids += self.vocab.encode(user_id_1) + conv_id + self.vocab.encode(user_id_2) + [eos_id]
                     lm_labels += [-1] * (len(conv_id) + 2)
                     token_type_ids += [0] * (len(conv_id) + 2)
@@ -261,8 +460,7 @@ class DialoGPTDataset(Dataset):
                     lm_labels += conv_id + [eos_id]
                     token_type_ids += [i] * (len(conv_id) + 1)
                 else: 
-                    user_id = conv[i+1][0]
-                    self.vocab.add_tokens([user_id])
+                    user_id = speakers[i+1]
 
                     input_ids += conv_id + self.vocab.encode(user_id) + [eos_id]
                     if self.config.export_test:
@@ -272,7 +470,7 @@ class DialoGPTDataset(Dataset):
                     token_type_ids += [i] * (len(conv_id) + 2)
             else: 
                 # baseline, reversed, reversed + User
-                user_ids.append(int(conv[i][0][1:]) if isinstance(conv[i][0], str) else conv[i][0]) 
+                user_ids.append(int(speakers[i][1:]) if isinstance(speakers[i], str) else speakers[i]) 
                 if i == 0: 
                     lm_labels += [-1] * len(conv_id)
                     user_mask += [0] * len(conv_id)
@@ -318,27 +516,236 @@ class DialoGPTDataset(Dataset):
                                 batch_first=True, padding_value=0)
         return (input_ids, position_ids, token_type_ids, labels, user_ids, user_mask)
 
+    @staticmethod
+    def collate_packed(features, max_length):
+        """
+        Pack the conversations of a batch into as few rows of max_length tokens as possible (first-fit decreasing).
+        position_ids and token_type_ids restart with every conversation as they already do in each feature,
+        and the first label of every conversation is -1 so that nothing is predicted across a boundary.
+        :return: collate outputs of the packed rows and segment_ids, the conversation index of each token in its row
+        """
+        rows = []
+        row_lengths = []
+        for f in sorted(features, key=lambda f: len(f.input_ids), reverse=True):
+            for i, row_length in enumerate(row_lengths):
+                if row_length + len(f.input_ids) <= max_length:
+                    rows[i].append(f)
+                    row_lengths[i] += len(f.input_ids)
+                    break
+            else:
+                rows.append([f])
+                row_lengths.append(len(f.input_ids))
+
+        packed = []
+        segment_ids = []
+        for row in rows:
+            lm_labels = []
+            for f in row:
+                lm_labels += [-1] + f.lm_labels[1:]
+            packed.append(DialoGPTFeature(
+                [i for f in row for i in f.input_ids],
+                [i for f in row for i in f.position_ids],
+                [i for f in row for i in f.token_type_ids],
+                lm_labels,
+                [i for f in row for i in f.user_ids],
+                [i for f in row for i in f.user_mask]))
+            segment_ids.append(torch.tensor([k for k, f in enumerate(row) for _ in f.input_ids], dtype=torch.long))
+
+        # padding gets a segment of its own
+        segment_ids = pad_sequence(segment_ids, batch_first=True, padding_value=-1)
+        return DialoGPTDataset.collate(packed) + (segment_ids,)
+
+
+
+class ConversationBatch(namedtuple('ConversationBatch', [
+        'utterances', 'utterance_length', 'conversation_length',
+        'input_utterances', 'input_utterance_length', 'target_utterances', 'target_utterance_length',
+        'input_conversation_length', 'users', 'input_users', 'target_users'])):
+    """
+    Batch of conversations flattened into utterances, every field is a LongTensor
+        utterances: [num_utterances, max_utter_len] every utterance of the batch, conversation after conversation
+        utterance_length: [num_utterances]
+        conversation_length: [batch_size] number of utterances of each conversation
+        input_utterances, target_utterances: [num_utterances - batch_size, max_utter_len] utterances without the
+            last (input) or the first (target) one of each conversation, with their lengths
+        input_conversation_length: [batch_size] conversation_length - 1
+        users, input_users, target_users: user of each of these utterances, None if the dataset has no users
+    """
+    __slots__ = ()
+
+    def to(self, device, non_blocking=False):
+        return ConversationBatch(*[None if t is None else t.to(device, non_blocking=non_blocking) for t in self])
+
+    def conversation_index(self, n_utterances):
+        """
+        Index in utterances of the first n_utterances utterances of every conversation that has that many
+        :return: [num_selected_conversations, n_utterances] LongTensor
+        """
+        offsets = torch.cumsum(self.conversation_length, 0) - self.conversation_length
+        offsets = offsets[self.conversation_length >= n_utterances]
+        return offsets.unsqueeze(1) + torch.arange(n_utterances, device=offsets.device)
+
+
+def collate_conversations(data, pad_index):
+    """
+    Collate (utterances, conversation_length, utterance_length[, users]) of the conversation datasets
+    into a ConversationBatch, so that the training loop only moves it to the device
+    """
+    # Sort by conversation length (descending order) to use 'pack_padded_sequence'
+    data.sort(key=lambda x: x[1], reverse=True)
+
+    input_index = []
+    target_index = []
+    start = 0
+    for x in data:
+        input_index.extend(range(start, start + len(x[0]) - 1))
+        target_index.extend(range(start + 1, start + len(x[0])))
+        start += len(x[0])
+    input_index = torch.tensor(input_index, dtype=torch.long)
+    target_index = torch.tensor(target_index, dtype=torch.long)
+
+    utterances = pad_batch([utter for x in data for utter in x[0]], pad_index)
+    utterance_length = torch.tensor([l for x in data for l in x[2]], dtype=torch.long)
+    conversation_length = torch.tensor([x[1] for x in data], dtype=torch.long)
+
+    users = input_users = target_users = None
+    if len(data[0]) > 3:
+        users = torch.tensor([user for x in data for user in x[3]], dtype=torch.long)
+        input_users = users[input_index]
+        target_users = users[target_index]
+
+    return ConversationBatch(utterances, utterance_length, conversation_length,
+                             utterances[input_index], utterance_length[input_index],
+                             utterances[target_index], utterance_length[target_index],
+                             conversation_length - 1, users, input_users, target_users)
+
+
+def truncate(ids, max_length, truncation_side='left'):
+    """
+    Cut ids to max_length
+    :param truncation_side: 'left' drops the first tokens (i.e. the oldest context), 'right' the last ones
+    """
+    if len(ids) <= max_length:
+        return ids
+    if truncation_side == 'left':
+        return ids[len(ids) - max_length:]
+    return ids[:max_length]
+
+
+def pad_batch(sequences, pad_index):
+    """Right-pad a list of id lists to the longest one as a (batch_size, max_len) LongTensor"""
+    max_len = max(len(seq) for seq in sequences)
+    padded = torch.full((len(sequences), max_len), pad_index, dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+    return padded
+
+
+def encode(vocab, utter, max_length):
+    """Encode utter with at most max_length tokens, utter may already be token ids read from a ConvStore"""
+    if isinstance(utter, str):
+        return vocab.encode(utter, max_length=max_length)
+    return utter[:max_length]
+
+
+def loader_options(config):
+    """DataLoader keyword arguments for parallel and pinned loading"""
+    if config is None:
+        return {}
+    options = dict(num_workers=config.num_workers, pin_memory=config.pin_memory)
+    if config.num_workers > 0:
+        options.update(persistent_workers=config.persistent_workers, prefetch_factor=config.prefetch_factor)
+    return options
 
 
 def get_loader(convs, vocab, convs_length=None, utterances_length=None, convs_users=None, batch_size=100, 
-                shuffle=True, model=None, dataset=None, config=None):
-    def collate_fn(data):
-        # Sort by conversation length (descending order) to use 'pack_padded_sequence'
-        data.sort(key=lambda x: x[1], reverse=True)
-        return zip(*data)
-    
+                shuffle=True, model=None, dataset=None, config=None, convs_path=None, sort_by_length=False):
+    """
+    :param sort_by_length: without shuffle, batch the examples in order of length, e.g. for validation,
+                           none of them dropped
+    """
+    if config is not None and config.streaming and model in ("DialoGPT", "ZHENG", "Transformer"):
+        return get_stream_loader(convs, vocab, batch_size, shuffle, model, config)
+
     if (model == "DialoGPT"):
         dataset = DialoGPTDataset(convs, vocab, config)
+        if config.token_cache and convs_path is not None:
+            token_cache = load_token_cache(convs_path, dataset.cache_meta(), dataset.encode_utterance,
+                                           convs=None if isinstance(convs, ConvStore) else convs)
+            dataset = DialoGPTDataset(token_cache, vocab, config)
+        dataset.register_speakers()
         collate_fn = DialoGPTDataset.collate
+        if shuffle and config.pack_sequences:
+            collate_fn = partial(DialoGPTDataset.collate_packed, max_length=config.max_seq_len)
     elif (model == "ZHENG" or model == "Transformer")  and (dataset == "cornell2" or dataset == "ubuntu" or dataset=="twitter_s"):
         dataset = TransformerBasedConvDataset(convs, vocab, config)
+        collate_fn = dataset.collate
     elif model == "HRED" and (dataset == "cornell2" or dataset == "ubuntu" or dataset == "twitter_s"):
         dataset = Cornell2HREDDataset(convs, vocab, config)
+        collate_fn = dataset.collate
     elif convs_users is None:
         dataset = ConvDataset(convs, convs_length, utterances_length, vocab)
+        collate_fn = dataset.collate
     else:
         dataset = ConvUserDataset(convs, convs_users, convs_length, utterances_length, vocab)
-
-    data_loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn, drop_last=True)
+        collate_fn = dataset.collate
+
+    # every rank loads its own part of the batches under distributed training
+    rank, world_size = distributed_rank()
+    if shuffle and config is not None and config.max_tokens_per_batch > 0:
+        batch_sampler = TokenBudgetBatchSampler(dataset.lengths(), config.max_tokens_per_batch, batch_size,
+                                                bucket_size=config.bucket_size, seed=config.seed,
+                                                num_replicas=world_size, rank=rank)
+        data_loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                 **loader_options(config))
+    elif shuffle and config is not None and config.bucket_batching:
+        batch_sampler = BucketBatchSampler(dataset.lengths(), batch_size, bucket_size=config.bucket_size,
+                                           seed=config.seed, num_replicas=world_size, rank=rank)
+        data_loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                 **loader_options(config))
+    elif not shuffle and sort_by_length:
+        lengths = dataset.lengths()
+        # a single bucket sorts all the examples
+        batch_sampler = BucketBatchSampler(lengths, batch_size, shuffle=False, drop_last=False,
+                                           bucket_size=len(lengths) // batch_size + 1,
+                                           num_replicas=world_size, rank=rank)
+        data_loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                 **loader_options(config))
+    elif world_size > 1:
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle,
+                                     seed=config.seed if config is not None else 0)
+        data_loader = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn,
+                                 drop_last=True, **loader_options(config))
+    else:
+        # export and test loaders keep the last, partial batch
+        data_loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn, drop_last=shuffle,
+                                 **loader_options(config))
 
     return data_loader
+
+
+def get_stream_loader(shards, vocab, batch_size, shuffle, model, config):
+    """
+    DataLoader over a ConvStream of shards for DialoGPT or ZHENG/Transformer
+    :param shards: paths of the shards, see load_conversations
+    """
+    if model == "DialoGPT":
+        dataset_fn = partial(DialoGPTDataset, vocab=vocab, config=config)
+        collate_fn = DialoGPTDataset.collate
+        if shuffle and config.pack_sequences:
+            collate_fn = partial(DialoGPTDataset.collate_packed, max_length=config.max_seq_len)
+    else:
+        dataset_fn = partial(TransformerBasedConvDataset, vocab=vocab, config=config)
+        collate_fn = dataset_fn([]).collate
+
+    dataset = ConvStream(shards, dataset_fn, batch_size, shuffle=shuffle, shuffle_buffer=config.shuffle_buffer,
+                         seed=config.seed, num_workers=config.num_workers)
+    if model == "DialoGPT":
+        for shard_dataset in dataset.datasets():
+            shard_dataset.register_speakers()
+
+    options = loader_options(config)
+    # workers must be started again to see the epoch given to ConvStream.set_epoch
+    options.pop('persistent_workers', None)
+    # export and test loaders keep the last, partial batch of every worker
+    return StreamLoader(dataset=dataset, batch_size=batch_size, collate_fn=collate_fn, drop_last=shuffle, **options)
@@ -0,0 +1,33 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def distributed_rank():
+    """rank, world_size of this process, (0, 1) when torch.distributed is not initialized"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def is_main_process():
+    """Only rank 0 writes tensorboard logs and checkpoints"""
+    return distributed_rank()[0] == 0
+
+
+def init_distributed(config):
+    """
+    Join the process group of a torchrun launch (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT
+    in the environment), with nccl on GPUs and gloo on CPU unless config.dist_backend is set.
+    Each process uses the GPU of its local rank.
+    """
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        config.device = torch.device('cuda', local_rank)
+    backend = config.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    rank, world_size = distributed_rank()
+    print(f'Process {rank} of {world_size} ({backend}) on {config.device}')
+    return rank, world_size
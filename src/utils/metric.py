@@ -7,6 +7,7 @@ from rouge import Rouge
 import torch 
 import torch.nn.functional as F
 import math 
+from .distributed import distributed_rank
 
 
 def bleu_compute(ground_truth_utter, answer_sample):
@@ -45,3 +46,53 @@ def dist_compute(all_response, dist_n=1):
     return len(distinct_ngrams) / len(all_response)
 
 
+
+
+class LossMeter(object):
+    def __init__(self, names, device):
+        """
+        Losses summed on the device and read back only by read(), so that a step never waits for the device.
+        Every loss is summed with its number of tokens and read as a loss per token, and non-finite losses
+        are counted on the device and fail the next read.
+        Under distributed training read() sums over all ranks.
+        :param names: names of the losses
+        """
+        self.names = list(names)
+        self.device = device
+        # loss sums, then token counts, then the number of non-finite losses
+        self.totals = torch.zeros(2 * len(self.names) + 1, dtype=torch.float64, device=device)
+        self.previous = np.zeros(2 * len(self.names) + 1)
+        # number of tokens of each loss as of the last read
+        self.counts = {name: 0 for name in self.names}
+
+    def add(self, loss_sums, n_tokens):
+        """
+        :param loss_sums: summed (not averaged) loss of each name, tensors of one batch
+        :param n_tokens: number of tokens of each loss, or a single number for all of them
+        """
+        if not isinstance(n_tokens, (list, tuple)):
+            n_tokens = [n_tokens] * len(self.names)
+        loss_sums = torch.stack([loss.detach().to(torch.float64) for loss in loss_sums])
+        n_tokens = torch.stack([torch.as_tensor(n, device=self.device).to(torch.float64) for n in n_tokens])
+        n_nonfinite = (~torch.isfinite(loss_sums)).sum(dim=0, keepdim=True).to(torch.float64)
+        self.totals += torch.cat([loss_sums, n_tokens, n_nonfinite])
+
+    def read(self):
+        """
+        Copy the totals to the host, the only synchronization with the device
+        :return: {name: loss per token since the previous read}, {name: loss per token since the start}
+        """
+        totals = self.totals
+        rank, world_size = distributed_rank()
+        if world_size > 1:
+            totals = totals.clone()
+            torch.distributed.all_reduce(totals)
+        totals = np.array(totals.tolist())
+        assert totals[-1] == 0, 'non-finite loss'
+
+        n = len(self.names)
+        recent = totals - self.previous
+        self.previous = totals
+        self.counts = {name: int(totals[n + i]) for i, name in enumerate(self.names)}
+        per_token = lambda t: {name: t[i] / max(t[n + i], 1) for i, name in enumerate(self.names)}
+        return per_token(recent), per_token(totals)
@@ -0,0 +1,164 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def sequence_lengths(lengths):
+    """[num_examples, n_sequences] array of lengths given per example, or per sequence of each example"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return lengths if lengths.ndim > 1 else lengths.reshape(-1, 1)
+
+
+def padding_ratio(lengths, batches):
+    """
+    Fraction of padding when every batch is padded to its longest example
+    :param lengths: number of tokens of each example, or [num_examples, n_sequences] tokens of each of its
+                    sequences when they are padded separately (e.g. input and target)
+    :param batches: list of lists of example indices
+    """
+    lengths = sequence_lengths(lengths)
+    n_tokens = 0
+    n_padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        n_tokens += batch_lengths.sum()
+        n_padded += batch_lengths.max(axis=0).sum() * len(batch)
+    return float(1.0 - n_tokens / n_padded) if n_padded > 0 else 0.0
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=True, bucket_size=100, seed=0,
+                 num_replicas=1, rank=0):
+        """
+        Batch sampler that groups examples of similar length to reduce padding.
+        Examples are shuffled, split into buckets of bucket_size batches, sorted by length inside each bucket
+        and cut into batches. The order of the batches is shuffled again across the buckets.
+        :param lengths: number of tokens of each example, or [num_examples, n_sequences] tokens of each of its
+                        sequences when they are padded separately, sorted by their total
+        :param batch_size: number of examples per batch
+        :param bucket_size: number of batches per bucket
+        :param seed: batches of an epoch depend only on seed and the epoch given to set_epoch
+        :param num_replicas, rank: under distributed training, every rank builds the same batches and takes
+                                   every num_replicas-th one. Shuffled or with drop_last, the same number of
+                                   batches on each rank, otherwise (e.g. validation) none of them dropped
+        """
+        self.lengths = sequence_lengths(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def split(self, indices):
+        """Cut a sequence of example indices into batches"""
+        return [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+
+    def batches(self):
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        bucket_len = self.batch_size * self.bucket_size
+        for start in range(0, len(order), bucket_len):
+            bucket = order[start:start + bucket_len]
+            batches.extend(self.split(bucket[np.argsort(self.lengths[bucket].sum(axis=1), kind='stable')]))
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            n_batches = len(batches)
+            batches = batches[self.rank::self.num_replicas]
+            if self.shuffle or self.drop_last:
+                batches = batches[:n_batches // self.num_replicas]
+
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def padding_ratio(self):
+        """
+        :return: padding ratio of this epoch, padding ratio of the same epoch without bucketing
+        """
+        rng = np.random.RandomState(self.seed + self.epoch)
+        unbucketed = self.split(rng.permutation(len(self.lengths)))
+        return padding_ratio(self.lengths, self.batches()), padding_ratio(self.lengths, unbucketed)
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        if self.drop_last:
+            # only the last batch of each bucket can be short
+            n_full_buckets, rest = divmod(len(self.lengths), self.batch_size * self.bucket_size)
+            return (n_full_buckets * self.bucket_size + rest // self.batch_size) // self.num_replicas
+        n_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        if self.shuffle:
+            return n_batches // self.num_replicas
+        # the first n_batches % num_replicas ranks take one more batch
+        return (n_batches - self.rank + self.num_replicas - 1) // self.num_replicas
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    def __init__(self, lengths, max_tokens, batch_size, shuffle=True, bucket_size=100, seed=0,
+                 num_replicas=1, rank=0):
+        """
+        Bucketing batch sampler whose batches hold as many examples as fit in max_tokens,
+        counting every example as long as the longest one of its batch (i.e. the padded size),
+        and every sequence of an example as long as the longest one of its kind when there are several.
+        An example longer than max_tokens makes a batch of its own.
+        :param max_tokens: token budget of a batch
+        :param batch_size: average number of examples per batch, only sets the number of examples per bucket
+        """
+        super(TokenBudgetBatchSampler, self).__init__(lengths, batch_size, shuffle=shuffle, drop_last=False,
+                                                      bucket_size=bucket_size, seed=seed,
+                                                      num_replicas=num_replicas, rank=rank)
+        self.max_tokens = max_tokens
+
+    def split(self, indices):
+        batches = []
+        batch = []
+        max_lengths = np.zeros(self.lengths.shape[1], dtype=np.int64)
+        for index in indices.tolist():
+            lengths = np.maximum(self.lengths[index], 1)
+            if batch and np.maximum(max_lengths, lengths).sum() * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                max_lengths[:] = 0
+            batch.append(index)
+            max_lengths = np.maximum(max_lengths, lengths)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __len__(self):
+        # the number of batches changes with the epoch
+        return len(self.batches())
+
+
+def num_batches(data_loader, n_epoch, start_epoch=0, accum_steps=1):
+    """
+    Number of batches data_loader yields from start_epoch to n_epoch, e.g. the total steps of a schedule
+    when a TokenBudgetBatchSampler makes the number of batches vary between epochs
+    :param accum_steps: count steps of accum_steps batches instead, the last step of an epoch can have fewer
+    """
+    batch_sampler = getattr(data_loader, 'batch_sampler', None)
+    if not isinstance(batch_sampler, TokenBudgetBatchSampler):
+        return -(-len(data_loader) // accum_steps) * (n_epoch - start_epoch)
+
+    epoch = batch_sampler.epoch
+    total = 0
+    for epoch_i in range(start_epoch, n_epoch):
+        batch_sampler.set_epoch(epoch_i)
+        total += -(-len(batch_sampler) // accum_steps)
+    batch_sampler.set_epoch(epoch)
+    return total
@@ -0,0 +1,169 @@
+import os
+import glob
+import numpy as np
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from .load_save import load_pickle
+from .conv_store import ConvStore
+from .distributed import distributed_rank
+
+
+def shard_paths(data_dir, convs_path):
+    """
+    Shards of a split: every convs pickle (*.pkl) or conversation store directory in {split}/shards,
+    or convs.pkl itself if there is no shards directory
+    """
+    paths = sorted(glob.glob(os.path.join(str(data_dir), 'shards', '*')))
+    return paths if paths else [str(convs_path)]
+
+
+def open_shard(path):
+    """Conversations of a shard, memory-mapped if it is a conversation store"""
+    if os.path.isdir(path):
+        return ConvStore(path)
+    return load_pickle(path)
+
+
+class ConvStream(IterableDataset):
+    def __init__(self, shards, dataset_fn, batch_size, shuffle=True, shuffle_buffer=10000, seed=0, num_workers=0):
+        """
+        Conversations streamed from sharded files, one shard in memory at a time (per reader).
+        Conversations are dealt round-robin to every DataLoader worker of every distributed rank.
+        Shuffled, within a buffer of shuffle_buffer conversations, each reader gets the same number of them and
+        up to (number of readers - 1) are left out, otherwise every conversation is read.
+        The order depends only on seed and the epoch given to set_epoch.
+        :param shards: paths of the shards, each a convs pickle or a conversation store directory
+        :param dataset_fn: function(convs) -> map-style dataset that builds the examples of a shard,
+                           e.g. DialoGPTDataset or TransformerBasedConvDataset
+        :param batch_size: batch size of the DataLoader, used to resume from a number of batches
+        :param shuffle_buffer: number of conversations shuffled together
+        :param num_workers: number of workers of the DataLoader
+        """
+        self.shards = list(shards)
+        self.dataset_fn = dataset_fn
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.position = 0
+        self._shard_lengths = None
+
+    def set_epoch(self, epoch, position=0):
+        """
+        :param position: number of batches of the epoch that were already trained on, they are skipped
+                         without being built
+        """
+        self.epoch = epoch
+        self.position = position
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'position': self.position}
+
+    def load_state_dict(self, state_dict):
+        self.set_epoch(state_dict['epoch'], state_dict['position'])
+
+    @property
+    def shard_lengths(self):
+        if self._shard_lengths is None:
+            # one pass over the shards, before the workers copy the stream
+            self._shard_lengths = [len(open_shard(path)) for path in self.shards]
+        return self._shard_lengths
+
+    def datasets(self):
+        """Map-style dataset of every shard in order, e.g. for a pre-pass over the whole corpus"""
+        for path in self.shards:
+            yield self.dataset_fn(open_shard(path))
+
+    def consumers(self):
+        """index of this reader, number of readers over all workers and ranks, number of workers"""
+        rank, world_size = distributed_rank()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        # the DataLoader takes batch b from worker b % num_workers and starts with worker 0 again
+        # when resumed, so worker 0 takes over the part of the worker that would give the next batch
+        worker_id = (worker_id + self.position) % num_workers
+        return rank * num_workers + worker_id, world_size * num_workers, worker_id, num_workers
+
+    def consumer_lengths(self):
+        """Number of conversations of each reader of this rank"""
+        rank, world_size = distributed_rank()
+        num_workers = max(self.num_workers, 1)
+        n_consumers = world_size * num_workers
+        total = sum(self.shard_lengths)
+        if self.shuffle:
+            return [total // n_consumers] * num_workers
+        # reader c gets the conversations c, c + n_consumers, ... of the whole stream
+        return [(total - consumer + n_consumers - 1) // n_consumers
+                for consumer in range(rank * num_workers, (rank + 1) * num_workers)]
+
+    def __len__(self):
+        """Number of conversations of this rank"""
+        return sum(self.consumer_lengths())
+
+    def indices(self, consumer, n_consumers):
+        """(shard, conversation) of this reader, before shuffling"""
+        quota = sum(self.shard_lengths) // n_consumers if self.shuffle else None
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.shards))
+
+        position = 0
+        n_yielded = 0
+        for shard in order.tolist():
+            length = self.shard_lengths[shard]
+            # first conversation of the shard dealt to this reader
+            start = (consumer - position) % n_consumers
+            for index in range(start, length, n_consumers):
+                if n_yielded == quota:
+                    return
+                yield shard, index
+                n_yielded += 1
+            position += length
+
+    def shuffled(self, indices, rng):
+        buffer = []
+        for index in indices:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(index)
+                continue
+            i = rng.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = index
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        consumer, n_consumers, worker_id, num_workers = self.consumers()
+        indices = self.indices(consumer, n_consumers)
+        if self.shuffle:
+            rng = np.random.RandomState((self.seed, self.epoch, consumer))
+            indices = self.shuffled(indices, rng)
+
+        # batches of this worker among the first position batches
+        n_skip = max(self.position - worker_id + num_workers - 1, 0) // num_workers * self.batch_size
+
+        # a shuffle buffer can hold conversations of several shards, a shard is released when none is left
+        pending = np.zeros(len(self.shards), dtype=np.int64)
+        for shard, _ in self.indices(consumer, n_consumers):
+            pending[shard] += 1
+        datasets = {}
+
+        for i, (shard, index) in enumerate(indices):
+            if i >= n_skip:
+                if shard not in datasets:
+                    datasets[shard] = self.dataset_fn(open_shard(self.shards[shard]))
+                yield datasets[shard][index]
+            pending[shard] -= 1
+            if pending[shard] == 0:
+                datasets.pop(shard, None)
+
+
+class StreamLoader(DataLoader):
+    """DataLoader over a ConvStream, whose length counts the batches of each of its workers"""
+    def __len__(self):
+        lengths = self.dataset.consumer_lengths()
+        if self.drop_last:
+            return sum(length // self.batch_size for length in lengths)
+        # the last batch of every worker can be partial
+        return sum(-(-length // self.batch_size) for length in lengths)
@@ -2,14 +2,15 @@ from tensorboardX import SummaryWriter
 
 
 class TensorboardWriter(SummaryWriter):
-    def __init__(self, logdir):
+    def __init__(self, logdir, write_to_disk=True):
         """
         Extended SummaryWriter Class from tensorboard-pytorch (tensorbaordX)
         https://github.com/lanpa/tensorboard-pytorch/blob/master/tensorboardX/writer.py
 
         Internally calls self.file_writer
+        write_to_disk=False makes a writer that drops everything, e.g. on the other ranks than 0
         """
-        super(TensorboardWriter, self).__init__(logdir)
+        super(TensorboardWriter, self).__init__(logdir, write_to_disk=write_to_disk)
         self.logdir = self.file_writer.get_logdir()
 
     def update_parameters(self, module, step_i):
@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+from .load_save import load_pickle
+from .conv_store import ConvStore
+from .stream import shard_paths
+from .vocab import Vocab
+
+
+def tokenizer_fingerprint(vocab):
+    """
+    Identify a tokenizer by its class and base vocabulary (encoder and bpe merges).
+    Tokens added at runtime (e.g. speaker tokens) are not part of the fingerprint.
+    """
+    sha = hashlib.sha1(type(vocab).__name__.encode('utf-8'))
+    encoder = getattr(vocab, 'encoder', None)
+    if encoder is None:
+        encoder = vocab.word2id if isinstance(vocab, Vocab) else vocab.get_vocab()
+    for token, token_id in sorted(encoder.items(), key=lambda k_v: k_v[1]):
+        sha.update('{}\t{}\n'.format(token, token_id).encode('utf-8'))
+    bpe_ranks = getattr(vocab, 'bpe_ranks', None)
+    if bpe_ranks is not None:
+        for pair, rank in sorted(bpe_ranks.items(), key=lambda k_v: k_v[1]):
+            sha.update('{} {}\t{}\n'.format(pair[0], pair[1], rank).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def cache_key(meta):
+    return hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_token_cache(convs_path, meta, encode_fn, convs=None, prefix='tokens'):
+    """
+    Open the cache of `convs_path` that matches `meta`, building it first if it does not exist yet
+    :param convs_path: path of the convs.pkl the cache is compiled from
+    :param meta: everything that changes the encoded result (tokenizer, max_seq_len, ...)
+    :param encode_fn: function(utterance, conversation_length) -> list of token ids
+    :param convs: already loaded conversations of convs_path, loaded from disk if None
+    :return: ConvStore
+    """
+    cache_dir = os.path.join(os.path.dirname(str(convs_path)), 'cache')
+    path = os.path.join(cache_dir, '{}-{}'.format(prefix, cache_key(meta)[:16]))
+
+    if not os.path.exists(os.path.join(path, ConvStore.META)):
+        print(f'Build token cache {path}')
+        if convs is None:
+            convs = load_pickle(convs_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        conversations = ([(elem[0] if isinstance(elem, (list, tuple)) else None, encode_fn(elem, len(conv)))
+                          for elem in conv] for conv in convs)
+        return ConvStore.build(path, conversations, meta, total=len(convs))
+
+    print(f'Load token cache {path}')
+    return ConvStore(path)
+
+
+def conv_store_meta(vocab, conversations_length=False, utterances_length=False, users=False):
+    """Everything that changes the content of the conversation store of a convs.pkl"""
+    return {
+        'tokenizer': tokenizer_fingerprint(vocab),
+        'conversations_length': conversations_length,
+        'utterances_length': utterances_length,
+        'users': users,
+    }
+
+
+def conv_store_path(convs_path, meta):
+    """Directory of the conversation store of `convs_path` built with `meta`"""
+    cache_dir = os.path.join(os.path.dirname(str(convs_path)), 'cache')
+    return os.path.join(cache_dir, 'store-{}'.format(cache_key(meta)[:16]))
+
+
+def load_conv_store(convs_path, vocab, conversations_length_path=None, utterances_length_path=None,
+                    convs_users_path=None):
+    """
+    Open the conversation store of `convs_path`, converting the legacy pickles first if it does not exist yet.
+    Once converted, none of the pickles are read again.
+    :param convs_path: path of convs.pkl
+    :param vocab: Vocab for word-level datasets, a transformers tokenizer otherwise
+    :param conversations_length_path: conversations_length.pkl of word-level datasets
+    :param utterances_length_path: utterances_length.pkl of word-level datasets, padding is dropped with it
+    :param convs_users_path: convs_users.pkl with the speaker of each utterance
+    :return: ConvStore
+    """
+    optional_paths = [conversations_length_path, utterances_length_path, convs_users_path]
+    conversations_length, utterances_length, convs_users = [
+        str(path) if path is not None and os.path.exists(str(path)) else None for path in optional_paths]
+    meta = conv_store_meta(vocab, conversations_length is not None, utterances_length is not None,
+                           convs_users is not None)
+    cache_dir = os.path.join(os.path.dirname(str(convs_path)), 'cache')
+    path = conv_store_path(convs_path, meta)
+
+    if os.path.exists(os.path.join(path, ConvStore.META)):
+        print(f'Load conversation store {path}')
+        return ConvStore(path)
+
+    print(f'Convert {convs_path} to conversation store {path}')
+    convs = load_pickle(convs_path)
+    conversations_length = load_pickle(conversations_length) if conversations_length else None
+    utterances_length = load_pickle(utterances_length) if utterances_length else None
+    convs_users = load_pickle(convs_users) if convs_users else None
+
+    word_level = isinstance(vocab, Vocab)
+    if word_level and len(convs) > 0:
+        # utterances of word-level datasets are padded to the same length
+        meta['pad_length'] = len(convs[0][0])
+
+    def conversations():
+        for i, conv in enumerate(convs):
+            if conversations_length is not None:
+                conv = conv[:conversations_length[i]]
+            conversation = []
+            for j, elem in enumerate(conv):
+                if not word_level and isinstance(elem, (list, tuple)):
+                    speaker, utter = elem[0], elem[1]
+                else:
+                    speaker, utter = None, elem
+                if convs_users is not None:
+                    speaker = convs_users[i][j]
+
+                token_ids = vocab.sent2id(utter) if word_level else vocab.encode(utter)
+                if utterances_length is not None:
+                    token_ids = token_ids[:utterances_length[i][j]]
+                conversation.append((speaker, token_ids))
+            yield conversation
+
+    os.makedirs(cache_dir, exist_ok=True)
+    return ConvStore.build(path, conversations(), meta, total=len(convs))
+
+
+def load_conversations(config, vocab):
+    """
+    Read the conversations of config.data_dir as keyword arguments of get_loader
+    :param config: config, read from the memory-mapped store if config.conv_store, from the pickles otherwise
+    :param vocab: Vocab for word-level datasets, a transformers tokenizer otherwise
+    :return: dict of convs, convs_length, utterances_length, convs_users (the last three only for word-level datasets).
+             convs is the list of shard paths if config.streaming
+    """
+    word_level = isinstance(vocab, Vocab)
+    convs_users_path = config.convs_users_path if word_level and config.users else None
+
+    if config.streaming and not word_level:
+        # read shard by shard by get_loader
+        return dict(convs=shard_paths(config.data_dir, config.convs_path))
+
+    if config.conv_store:
+        if word_level:
+            convs = load_conv_store(config.convs_path, vocab, config.conversations_length_path,
+                                    config.utterances_length_path, convs_users_path)
+        else:
+            convs = load_conv_store(config.convs_path, vocab)
+        # lengths are read from the store by the dataset
+        return dict(convs=convs, convs_users=convs.users if convs_users_path else None)
+
+    if not word_level:
+        return dict(convs=load_pickle(config.convs_path))
+    return dict(convs=load_pickle(config.convs_path),
+                convs_length=load_pickle(config.conversations_length_path),
+                utterances_length=load_pickle(config.utterances_length_path),
+                convs_users=load_pickle(convs_users_path) if convs_users_path else None)
+
+
+def count_users(convs):
+    """Number of users of load_conversations(...) with users"""
+    if isinstance(convs['convs'], ConvStore):
+        return max(convs['convs'].speaker_labels) + 1
+    return max([x for xx in convs['convs_users'] for x in xx]) + 1
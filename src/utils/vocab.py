@@ -1,5 +1,8 @@
-from collections import defaultdict
 import pickle
+import heapq
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
 import torch
 from torch import Tensor
 from torch.autograd import Variable
@@ -15,66 +18,98 @@ SEP_TOKEN = '<sep>'
 PAD_ID, UNK_ID, SOS_ID, EOS_ID, SEP_ID = [0, 1, 2, 3, 4]
 
 
+class WordIndex(dict):
+    """word -> id with UNK_ID for unknown words, a picklable defaultdict(lambda: UNK_ID) that does not grow on lookups"""
+    def __missing__(self, word):
+        return UNK_ID
+
+
 class Vocab(object):
     def __init__(self, tokenizer=None, max_size=None, min_freq=1):
         self.vocab_size = 0
         self.freqdist = FreqDist()
         self.tokenizer = tokenizer
         self.pad_id = PAD_ID
+        self.set_words({}, {})
+
+    def set_words(self, word2id, id2word):
+        """
+        Store the vocabulary once as
+            index: WordIndex word -> id, looked up by sent2id
+            words: [num_ids] array of the word of each id
+            skip, is_eos: [num_ids] ids left out by id2sent, ids that end a sentence
+        :param word2id: dict word -> id
+        :param id2word: dict id -> word
+        """
+        self.index = WordIndex(word2id)
+        self.words = np.empty(max(id2word) + 1 if id2word else 0, dtype=object)
+        for i, word in id2word.items():
+            self.words[i] = word
+        self.skip = np.isin(self.words, [EOS_TOKEN, SOS_TOKEN, PAD_TOKEN])
+        self.is_eos = self.words == EOS_TOKEN
+
+    @property
+    def word2id(self):
+        return self.index
+
+    @property
+    def id2word(self):
+        return {i: word for i, word in enumerate(self.words.tolist()) if word is not None}
 
     def update(self, max_size=None, min_freq=1):
-        self.id2word = {
+        id2word = {
             PAD_ID: PAD_TOKEN, UNK_ID: UNK_TOKEN,
             SOS_ID: SOS_TOKEN, EOS_ID: EOS_TOKEN,
             SEP_ID: SEP_TOKEN,
         }
-        self.word2id = defaultdict(lambda: UNK_ID)  # Not in vocab => return UNK
-        self.word2id.update({
+        word2id = {
             PAD_TOKEN: PAD_ID, UNK_TOKEN: UNK_ID,
             SOS_TOKEN: SOS_ID, EOS_TOKEN: EOS_ID,
             SEP_TOKEN: SEP_ID,
-        })
+        }
 
         vocab_size = 5
         min_freq = max(min_freq, 1)
 
-        freqdist = self.freqdist.copy()
-        special_freqdist = {token: freqdist[token]
-                            for token in [PAD_TOKEN, UNK_TOKEN, SOS_TOKEN, EOS_TOKEN, SEP_TOKEN]}
-        freqdist.subtract(special_freqdist)
-
-        sorted_frequency_counter = sorted(freqdist.items(), key=lambda k_v: k_v[0])
-        sorted_frequency_counter.sort(key=lambda k_v: k_v[1], reverse=True)
-
-        for word, freq in sorted_frequency_counter:
-            if freq < min_freq or vocab_size == max_size:
-                break
-            self.id2word[vocab_size] = word
-            self.word2id[word] = vocab_size
+        # words by decreasing frequency, then alphabetically, without the special tokens
+        candidates = ((word, freq) for word, freq in self.freqdist.items()
+                      if freq >= min_freq and word not in word2id)
+        order = lambda k_v: (-k_v[1], k_v[0])
+        if max_size is not None and max_size >= vocab_size:
+            # only the max_size most frequent words are sorted
+            selected = heapq.nsmallest(max_size - vocab_size, candidates, key=order)
+        else:
+            selected = sorted(candidates, key=order)
+
+        for word, freq in selected:
+            id2word[vocab_size] = word
+            word2id[word] = vocab_size
             vocab_size += 1
 
         self.vocab_size = vocab_size
+        self.set_words(word2id, id2word)
 
     def __len__(self):
-        return len(self.id2word)
+        return len(self.words)
 
     def load(self, word2id_path=None, id2word_path=None, ptb=False):
+        word2id = dict(self.word2id)
+        id2word = self.id2word
         if word2id_path:
             with open(word2id_path, 'rb') as f:
-                word2id = pickle.load(f)
-            self.word2id = defaultdict(lambda: UNK_ID)
-            self.word2id.update(word2id)
-            self.vocab_size = len(self.word2id)
+                word2id = dict(pickle.load(f))
+            self.vocab_size = len(word2id)
 
         if id2word_path:
             with open(id2word_path, 'rb') as f:
-                id2word = pickle.load(f)
-            self.id2word = id2word
+                id2word = dict(pickle.load(f))
 
         if ptb:
-            self.word2id['<sep>'] = self.vocab_size 
-            self.id2word[self.vocab_size] = '<sep>'
-            self.vocab_size += 1 
+            word2id['<sep>'] = self.vocab_size
+            id2word[self.vocab_size] = '<sep>'
+            self.vocab_size += 1
+
+        self.set_words(word2id, id2word)
 
     def add_word(self, word):
         assert isinstance(word, str), 'Input should be str'
@@ -87,10 +122,29 @@ class Vocab(object):
             self.add_word(word)
 
     def add_dataframe(self, conversation_df, tokenized=True):
+        if tokenized:
+            self.freqdist.update(count_words(conversation_df))
+            return
         for conversation in conversation_df:
             for sentence in conversation:
                 self.add_sentence(sentence, tokenized=tokenized)
 
+    def add_conversations(self, conversations, num_workers=1, chunksize=1024):
+        """
+        add_dataframe of tokenized conversations, counted over chunks of conversations in a process pool
+        :param num_workers: number of processes, counted in this process if 1 or less
+        :param chunksize: number of conversations counted by a process at a time
+        """
+        chunks = (conversations[i:i + chunksize] for i in range(0, len(conversations), chunksize))
+        if num_workers <= 1:
+            for chunk in chunks:
+                self.freqdist.update(count_words(chunk))
+            return
+
+        with Pool(num_workers) as pool:
+            for counts in pool.imap_unordered(count_words, chunks):
+                self.freqdist.update(counts)
+
     def pickle(self, word2id_path, id2word_path):
         with open(word2id_path, 'wb') as f:
             pickle.dump(dict(self.word2id), f)
@@ -107,23 +161,57 @@ class Vocab(object):
         elif isinstance(list_like, Tensor):
             return list(list_like.numpy())
 
-    def id2sent(self, id_list):
-        id_list = self.to_list(id_list)
-        sentence = []
-        for id in id_list:
-            word = self.id2word[id]
-            if word not in [EOS_TOKEN, SOS_TOKEN, PAD_TOKEN]:
-                sentence.append(word)
-            if word == EOS_TOKEN:
-                break
-        return sentence
+    def lookup(self, words):
+        """Ids of a flat sequence of words as an int64 array, UNK_ID for unknown words"""
+        return np.fromiter(map(self.index.__getitem__, words), dtype=np.int64, count=len(words))
+
+    def sents2id(self, sentences):
+        """sent2id of several sentences, e.g. every utterance of a conversation"""
+        get = self.index.__getitem__
+        return [list(map(get, sentence)) for sentence in sentences]
 
     def sent2id(self, sentence, var=False):
-        id_list = [self.word2id[word] for word in sentence]
+        id_list = list(map(self.index.__getitem__, sentence))
         if var:
             id_list = to_var(torch.LongTensor(id_list), eval=True)
         return id_list
 
+    def id2sent(self, id_list):
+        return self.id2sents([self.to_list(id_list)])[0]
+
+    def id2sents(self, sequences):
+        """
+        id2sent of several sequences of ids at once
+        :param sequences: [..., max_len] array or tensor, or a list of id lists
+        :return: list of word lists
+        """
+        if isinstance(sequences, Tensor):
+            sequences = to_tensor(sequences).numpy()
+        elif not isinstance(sequences, np.ndarray):
+            max_len = max([len(ids) for ids in sequences], default=0)
+            sequences = np.array([list(ids) + [PAD_ID] * (max_len - len(ids)) for ids in sequences],
+                                 dtype=np.int64).reshape(len(sequences), max_len)
+        if sequences.size == 0:
+            return [[] for _ in range(int(np.prod(sequences.shape[:-1])))]
+        sequences = sequences.reshape(-1, sequences.shape[-1])
+        # words before the first <eos>, without <sos> and <pad>
+        keep = ~(self.skip[sequences] | (np.cumsum(self.is_eos[sequences], axis=1) > 0))
+        words = self.words[sequences]
+        return [row[row_keep].tolist() for row, row_keep in zip(words, keep)]
+
     def decode(self, id_list):
         sentence = self.id2sent(id_list)
         return ' '.join(sentence)
+
+    def batch_decode(self, sequences):
+        """decode of several sequences of ids at once, see id2sents"""
+        return [' '.join(sentence) for sentence in self.id2sents(sequences)]
+
+
+def count_words(conversations):
+    """Counter of the words of tokenized conversations"""
+    counts = Counter()
+    for conversation in conversations:
+        for sentence in conversation:
+            counts.update(sentence)
+    return counts